@@ -0,0 +1,91 @@
+"""Per-call overhead of the `Profiler.monitor` decorator at different stack depths and thread counts, enabled and
+disabled, and of the module-level `monitor`.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_decorator_overhead
+"""
+import threading
+import time
+
+import src.pygraphprofiler as pygraphprofiler
+from src.pygraphprofiler import Profiler
+from src.pygraphprofiler.utils.recorder import EventBuffer
+
+
+STACK_DEPTHS = (5, 50, 500)
+THREAD_COUNTS = (1, 4)
+N_CALLS = 20000
+
+
+def _at_depth(depth, func):
+    if depth <= 0:
+        return func()
+    return _at_depth(depth - 1, func)
+
+
+def _time_calls(func, n_calls):
+    start_time = time.perf_counter()
+    for _ in range(n_calls):
+        func()
+    return time.perf_counter() - start_time
+
+
+def _time_threads(func, n_calls, depth, n_threads):
+    """Return the wall time of n_threads threads each making n_calls calls of func at the given stack depth."""
+    if n_threads == 1:
+        return _at_depth(depth, lambda: _time_calls(func, n_calls))
+    barrier = threading.Barrier(n_threads + 1)
+
+    def run():
+        barrier.wait()
+        _at_depth(depth, lambda: _time_calls(func, n_calls))
+
+    threads = [threading.Thread(target=run) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    start_time = time.perf_counter()
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start_time
+
+
+def measure_overhead(depth, n_calls=N_CALLS, enabled=True, n_threads=1, module_level=False):
+    """Return the wall time added per call by the decorator, over every call of every thread."""
+    def noop():
+        pass
+
+    if module_level:
+        pygraphprofiler.profiling_data = EventBuffer()
+        monitored_noop = pygraphprofiler.monitor(noop)
+        if not enabled:
+            pygraphprofiler.disable()
+    else:
+        profiler = Profiler()
+        if not enabled:
+            profiler.disable()
+        monitored_noop = profiler.monitor(noop)
+    try:
+        baseline = _time_threads(noop, n_calls, depth, n_threads)
+        monitored = _time_threads(monitored_noop, n_calls, depth, n_threads)
+    finally:
+        if module_level:
+            pygraphprofiler.enable()
+            pygraphprofiler.profiling_data = EventBuffer()
+    return (monitored - baseline) / (n_calls * n_threads)
+
+
+def main():
+    for module_level in (False, True):
+        decorator = "monitor" if module_level else "Profiler.monitor"
+        for n_threads in THREAD_COUNTS:
+            for depth in STACK_DEPTHS:
+                overhead = measure_overhead(depth, n_threads=n_threads, module_level=module_level)
+                disabled = measure_overhead(depth, enabled=False, n_threads=n_threads, module_level=module_level)
+                print(f"{decorator:>16}, {n_threads} threads, stack depth {depth:>4}: {overhead * 1e6:8.3f} us/call, "
+                      f"disabled {disabled * 1e6:8.3f} us/call")
+
+
+if __name__ == '__main__':
+    main()
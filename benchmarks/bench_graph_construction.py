@@ -0,0 +1,95 @@
+"""Graph construction time of the legacy row-by-row path versus the groupby pipeline in `utils/graph`.
+
+Run from the repository root (the legacy path takes minutes at 1M events):
+
+    python -m benchmarks.bench_graph_construction [n_events ...]
+"""
+import random
+import sys
+import time
+
+import networkx as nx
+
+from src.pygraphprofiler.utils.graph import _add_graph_edges, _add_graph_nodes
+from src.pygraphprofiler.utils.recorder import EventBuffer
+
+
+EVENT_COUNTS = (10_000, 100_000, 1_000_000)
+N_TASKS = 200
+
+
+def _legacy_add_graph_edges(task_df, graph):
+    edge_counts = {}
+    for index, row in task_df.iterrows():
+        node = row['task']
+        parent = row['parent_task']
+        if parent:
+            if (parent, node) not in edge_counts:
+                edge_counts[(parent, node)] = 1
+            else:
+                edge_counts[(parent, node)] += 1
+            graph.add_edge(parent, node, calls=edge_counts[(parent, node)])
+    return graph
+
+
+def _legacy_add_graph_nodes(task_df, graph):
+    total_exec_time_dict = {}
+    count_dict = {}
+    for index, row in task_df.iterrows():
+        node = row['task']
+        exec_time = row['end_time'] - row['start_time']
+        if node not in total_exec_time_dict:
+            total_exec_time_dict[node] = exec_time
+            count_dict[node] = 1
+        else:
+            total_exec_time_dict[node] += exec_time
+            count_dict[node] += 1
+        graph.add_node(
+            node,
+            total_exec_time=total_exec_time_dict[node],
+            count=count_dict[node],
+            average_exec_time=total_exec_time_dict[node]/count_dict[node]
+        )
+    return graph
+
+
+def make_events(n_events, seed=0):
+    rng = random.Random(seed)
+    tasks = [f"task_{i}" for i in range(N_TASKS)]
+    buffer = EventBuffer()
+    for i in range(n_events):
+        start_time = i * 1000
+        buffer.append(rng.choice(tasks), rng.choice(tasks), start_time, start_time + rng.randrange(1, 1000))
+    return buffer.to_dataframe()
+
+
+def assert_same_statistics(legacy_graph, graph):
+    """Check that both graphs have the same nodes and edges, and equal values for every attribute of the legacy graph.
+
+    The vectorized graph also carries self times and percentiles, which the legacy path does not compute.
+    """
+    assert set(legacy_graph.nodes) == set(graph.nodes)
+    assert set(legacy_graph.edges) == set(graph.edges)
+    for legacy_items, items in ((legacy_graph.nodes, graph.nodes), (legacy_graph.edges, graph.edges)):
+        for key, attributes in legacy_items.items():
+            for name, value in attributes.items():
+                assert abs(items[key][name] - value) <= 1e-9 * max(1, abs(value)), (key, name)
+
+
+def _time_build(add_nodes, add_edges, task_df):
+    start_time = time.perf_counter()
+    graph = add_edges(task_df, add_nodes(task_df, nx.DiGraph()))
+    return time.perf_counter() - start_time, graph
+
+
+def main(event_counts=EVENT_COUNTS):
+    for n_events in event_counts:
+        task_df = make_events(n_events)
+        legacy, legacy_graph = _time_build(_legacy_add_graph_nodes, _legacy_add_graph_edges, task_df)
+        vectorized, graph = _time_build(_add_graph_nodes, _add_graph_edges, task_df)
+        assert_same_statistics(legacy_graph, graph)
+        print(f"{n_events:>9} events: legacy {legacy:8.3f}s, vectorized {vectorized:8.3f}s ({legacy / vectorized:6.1f}x)")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or EVENT_COUNTS)
@@ -0,0 +1,50 @@
+"""Cold import time of the package, and a check that recording pulls in no heavy dependency.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_import_time
+"""
+import subprocess
+import sys
+
+
+HEAVY_MODULES = ("pandas", "networkx", "matplotlib", "numpy")
+N_RUNS = 10
+
+_RECORD_SCRIPT = f"""
+import sys, time
+start_time = time.perf_counter()
+import src.pygraphprofiler as pygraphprofiler
+import_time = time.perf_counter() - start_time
+
+profiler = pygraphprofiler.Profiler()
+
+@profiler.monitor
+def test_func():
+    pass
+
+test_func()
+pygraphprofiler.monitor(test_func)()
+print(import_time, *[module for module in {HEAVY_MODULES!r} if module in sys.modules])
+"""
+
+
+def measure_import_time():
+    output = subprocess.run([sys.executable, "-c", _RECORD_SCRIPT], capture_output=True, text=True, check=True).stdout
+    import_time, *loaded = output.split()
+    return float(import_time), loaded
+
+
+def main():
+    import_times = []
+    for _ in range(N_RUNS):
+        import_time, loaded = measure_import_time()
+        if loaded:
+            raise SystemExit(f"Recording imported heavy dependencies: {', '.join(loaded)}")
+        import_times.append(import_time)
+    print(f"import pygraphprofiler: min {min(import_times) * 1e3:.1f} ms, "
+          f"median {sorted(import_times)[N_RUNS // 2] * 1e3:.1f} ms over {N_RUNS} runs")
+
+
+if __name__ == '__main__':
+    main()
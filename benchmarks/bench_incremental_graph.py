@@ -0,0 +1,53 @@
+"""Cost of polling `Profiler.to_graph` while recording goes on: full rebuild versus the incremental GraphCache.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_incremental_graph [n_events ...]
+"""
+import random
+import sys
+import time
+
+from src.pygraphprofiler import Profiler
+from src.pygraphprofiler.utils.incremental import GraphCache
+
+
+EVENT_COUNTS = (100_000, 1_000_000)
+NEW_EVENTS_PER_POLL = 1_000
+N_POLLS = 10
+N_TASKS = 200
+
+
+def _append_events(buffer, n_events, rng, tasks):
+    start = len(buffer)
+    for i in range(start, start + n_events):
+        # Calls follow a fixed binary call tree, as in a real program, rather than connecting any two tasks
+        task = rng.randrange(1, len(tasks))
+        start_time = i * 1000
+        buffer.append(tasks[task], tasks[task // 2], start_time, start_time + rng.randrange(1, 1000))
+
+
+def main(event_counts=EVENT_COUNTS):
+    rng = random.Random(0)
+    tasks = [f"task_{i}" for i in range(N_TASKS)]
+    for n_events in event_counts:
+        profiler = Profiler()
+        buffer = profiler.profiling_data
+        _append_events(buffer, n_events, rng, tasks)
+        cache = GraphCache()
+        cache.snapshot(buffer)
+        rebuild = incremental = 0
+        for _ in range(N_POLLS):
+            _append_events(buffer, NEW_EVENTS_PER_POLL, rng, tasks)
+            start_time = time.perf_counter()
+            Profiler._to_graph(buffer)
+            rebuild += time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            cache.snapshot(buffer)
+            incremental += time.perf_counter() - start_time
+        print(f"{n_events:>9} events, {NEW_EVENTS_PER_POLL} new per poll: "
+              f"rebuild {rebuild / N_POLLS * 1e3:8.2f}ms, incremental {incremental / N_POLLS * 1e3:8.2f}ms per poll")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or EVENT_COUNTS)
@@ -0,0 +1,69 @@
+"""Per-call overhead of `Profiler.trace` versus the `Profiler.monitor` decorator and cProfile.
+
+The workload is a binary recursion of small functions, as in typical hot paths, timed bare, with every function
+decorated, under `Profiler.trace` restricted to this module, and under cProfile. Run from the repository root:
+
+    python -m benchmarks.bench_trace_overhead [recursion_depth]
+"""
+import cProfile
+import sys
+import time
+
+from src.pygraphprofiler import Profiler
+
+
+RECURSION_DEPTH = 15
+N_REPEATS = 3
+
+
+def _call_tree(depth, wrap=lambda func: func):
+    """Return a function calling two copies of the function one level below, down to `depth` levels of leaves."""
+    if depth == 0:
+        def leaf():
+            return 1
+        return wrap(leaf)
+    child = _call_tree(depth - 1, wrap)
+
+    def node():
+        return child() + child()
+    return wrap(node)
+
+
+def _best_time(run, n_repeats=N_REPEATS):
+    best = float('inf')
+    for _ in range(n_repeats):
+        start_time = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def measure(depth=RECURSION_DEPTH):
+    n_calls = 2 ** (depth + 1) - 1
+    bare = _call_tree(depth)
+    baseline = _best_time(bare)
+
+    decorated = _best_time(_call_tree(depth, Profiler().monitor))
+
+    def traced():
+        with Profiler().trace(include=__name__):
+            bare()
+    traced = _best_time(traced)
+
+    def profiled():
+        cProfile.Profile().runcall(bare)
+    profiled = _best_time(profiled)
+
+    return {name: (elapsed - baseline) / n_calls
+            for name, elapsed in (('monitor', decorated), ('trace', traced), ('cProfile', profiled))}
+
+
+def main(depth=RECURSION_DEPTH):
+    backend = 'sys.monitoring' if hasattr(sys, 'monitoring') else 'sys.setprofile'
+    print(f"Python {sys.version.split()[0]}, trace backend {backend}, {2 ** (depth + 1) - 1} calls")
+    for name, overhead in measure(depth).items():
+        print(f"{name:>9}: {overhead * 1e6:8.3f} us/call")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
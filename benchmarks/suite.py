@@ -0,0 +1,173 @@
+"""Benchmark suite writing its results as JSON, one record per measurement, for tracking trends across commits.
+
+It measures the per-call overhead of `Profiler.monitor` and the module-level `monitor` at different stack depths and
+thread counts, the peak memory used per million recorded events, and the throughput of `to_dataframe`, `to_graph`,
+`to_json`, `from_json`, `merge_profiler_instances` and `plot_graph` as the profile grows. Run from the repository root:
+
+    python -m benchmarks.suite [--quick] [--output results.json]
+
+Records are {"benchmark", "params", "value", "unit"}; the run's environment is under "metadata". Without --output, the
+JSON is written to stdout and progress to stderr.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from src.pygraphprofiler import Profiler, merge_profiler_instances
+from src.pygraphprofiler.utils import plot
+
+from .bench_decorator_overhead import STACK_DEPTHS, THREAD_COUNTS, measure_overhead
+
+
+EVENT_COUNTS = (10_000, 100_000, 1_000_000)
+QUICK_EVENT_COUNTS = (10_000, 100_000)
+# Events recorded to measure memory, scaled to a million
+MEMORY_EVENTS = 200_000
+# Depth of the binary tree of monitored functions generating profiles, 2 ** TREE_DEPTH - 1 distinct tasks
+TREE_DEPTH = 6
+N_CALLS = 20000
+QUICK_N_CALLS = 5000
+
+
+def _call_tree(profiler, depth=TREE_DEPTH, index=1):
+    """Return a monitored function calling the two functions below it, each function being a distinct task."""
+    if depth == 1:
+        def leaf():
+            return 1
+        func = leaf
+    else:
+        left = _call_tree(profiler, depth - 1, 2 * index)
+        right = _call_tree(profiler, depth - 1, 2 * index + 1)
+
+        def node():
+            return left() + right()
+        func = node
+    func.__name__ = func.__qualname__ = f"task_{index}"
+    return profiler.monitor(func)
+
+
+def make_profiler(n_events, mode='events'):
+    """Return a Profiler that recorded at least n_events calls of a tree of monitored functions."""
+    profiler = Profiler(mode=mode)
+    root = _call_tree(profiler)
+    for _ in range(-(-n_events // (2 ** TREE_DEPTH - 1))):
+        root()
+    return profiler
+
+
+def _timed(func):
+    start_time = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start_time, result
+
+
+def bench_overhead(n_calls):
+    records = []
+    for module_level in (False, True):
+        decorator = "monitor" if module_level else "Profiler.monitor"
+        for n_threads in THREAD_COUNTS:
+            for depth in STACK_DEPTHS:
+                for enabled in (True, False):
+                    overhead = measure_overhead(depth, n_calls=n_calls, enabled=enabled, n_threads=n_threads,
+                                                module_level=module_level)
+                    records.append(_record("decorator_overhead", overhead * 1e9, "ns/call", decorator=decorator,
+                                           threads=n_threads, stack_depth=depth, enabled=enabled))
+    return records
+
+
+def bench_memory(n_events=MEMORY_EVENTS):
+    records = []
+    for mode in ('events', 'aggregate'):
+        tracemalloc.start()
+        try:
+            profiler = make_profiler(n_events, mode=mode)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        task_df = profiler.to_dataframe()
+        n_recorded = len(task_df) if mode == 'events' else int(task_df['count'].sum())
+        records.append(_record("peak_memory_per_million_events", peak / n_recorded * 1e6 / 2 ** 20, "MiB",
+                               mode=mode))
+    return records
+
+
+def bench_exports(event_counts):
+    records = []
+    with tempfile.TemporaryDirectory() as directory:
+        for n_events in event_counts:
+            profiler = make_profiler(n_events)
+            n_recorded = len(profiler.profiling_data)
+            timings = {
+                "to_dataframe": _timed(profiler.to_dataframe)[0],
+                # Without the profiler's graph cache, which would only fold in new events after the first call
+                "to_graph": _timed(lambda: Profiler._to_graph(profiler.profiling_data))[0],
+            }
+            timings["to_json"], json_str = _timed(profiler.to_json)
+            timings["from_json"] = _timed(lambda: Profiler.from_json(json_str))[0]
+            del json_str
+            timings["merge_profiler_instances"] = _timed(lambda: merge_profiler_instances(profiler, profiler))[0]
+            # Every profile has the same topology: without clearing the layout cache, only the first would be laid out
+            plot._layout_cache.clear()
+            path = os.path.join(directory, "graph.png")
+            timings["plot_graph"] = _timed(lambda: profiler.plot_graph(path))[0]
+            for operation, seconds in timings.items():
+                # Merging reads the events of both profilers
+                n_processed = 2 * n_recorded if operation == "merge_profiler_instances" else n_recorded
+                records.append(_record("export_throughput", n_processed / seconds, "events/s", operation=operation,
+                                       events=n_recorded))
+            print(f"{n_recorded:>9} events: " + ", ".join(f"{operation} {seconds:.3f}s"
+                                                          for operation, seconds in timings.items()), file=sys.stderr)
+    return records
+
+
+def _record(benchmark, value, unit, **params):
+    return {"benchmark": benchmark, "params": params, "value": value, "unit": unit}
+
+
+def _metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--quick", action="store_true", help="fewer calls and smaller profiles, for a smoke run")
+    parser.add_argument("--output", help="the JSON file to write, stdout if not provided")
+    args = parser.parse_args(argv)
+
+    records = []
+    print("decorator overhead", file=sys.stderr)
+    records += bench_overhead(QUICK_N_CALLS if args.quick else N_CALLS)
+    print("peak memory", file=sys.stderr)
+    records += bench_memory(MEMORY_EVENTS // 10 if args.quick else MEMORY_EVENTS)
+    print("export throughput", file=sys.stderr)
+    records += bench_exports(QUICK_EVENT_COUNTS if args.quick else EVENT_COUNTS)
+
+    results = {"metadata": _metadata(), "results": records}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
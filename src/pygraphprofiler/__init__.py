@@ -2,71 +2,199 @@ import json
 import time
 import functools
 import inspect
-import time
 
-from .profiler import Profiler, merge_profiler_instances
+from .profiler import PASSTHROUGH, PROFILERS, Profiler, _Block, diff_profiler_instances, merge_profiler_instances
 from . import utils
-from .utils.graph import _add_graph_edges, _add_graph_nodes
-from .utils.plot import _draw_graph_to_file, _set_edge_labels, _set_graph_layout, _set_node_labels, _set_node_sizes
+from .utils.sampling import EveryN, MinDuration, Probability, RateLimit, SamplingPolicy
+from .utils.breakdown import KeyedBreakdown
+from .utils.diff import ProfileDiff
+from .utils.incremental import GraphCache
+from .utils.recorder import EventBuffer
+from .utils.spill import SpillingBuffer
+from .utils.stack import _task_name
+from .utils.tracer import Tracer
 
 
 # initialize global, in-memory variables
-profiling_data = {
-    "task" : [],
-    "parent_task" : [],
-    "start_time" : [],
-    "end_time" : [],
-}
+profiling_data = EventBuffer()
+_graph_cache = GraphCache()
+breakdowns = KeyedBreakdown()
+
 
-PROFILERS = {}
+def __getattr__(name):
+    # MetricsExporter loads http.server, which is imported on first access only
+    if name == "MetricsExporter":
+        from .utils.exporter import MetricsExporter
+        return MetricsExporter
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def setProfiler(name, *args, **kwargs):
-    PROFILERS = {name: Profiler(name, *args, **kwargs)}
+    """Create a Profiler with the given name and options and register it under that name, replacing any profiler registered before.
+
+    Args:
+    name (str): The name of the profiler. Dotted names form a hierarchy: disabling 'app' also disables 'app.db' and 'app.http'.
+    *args, **kwargs: The other arguments of Profiler, e.g. timer or mode.
+
+    Returns:
+    Profiler instance
+    """
+    PROFILERS[name] = Profiler(name, *args, **kwargs)
+    Profiler._update_active()
     return PROFILERS[name]
 
-def getProfiler(name):
+def getProfiler(name='__main__'):
+    """Return the Profiler registered under the given name, creating and registering one with default options if there is none, as logging.getLogger does.
+
+    Args:
+    name (str, optional): The name of the profiler. If not provided, defaults to '__main__'.
+
+    Returns:
+    Profiler instance
+    """
+    if name not in PROFILERS:
+        return setProfiler(name)
     return PROFILERS[name]
 
 
-def monitor(func):
-    """The monitor function is a decorator that can be used to monitor a Python function and record its execution time, along with the function name and the parent function name. The decorated function is returned by the wrapper function wrapper, which records the start time of the function, runs the original function, records the end time of the function, and adds the relevant data to the global, in-memory variables _func_names_list, _parent_func_list, _start_time_list, and _end_time_list.
+def enable():
+    """Turn the global switch back on: profilers resume recording unless disabled themselves or through an ancestor."""
+    Profiler._globally_enabled = True
+    Profiler._update_active()
+
+def disable():
+    """Turn the global kill switch off: every monitored function, of every profiler and of the module-level monitor, calls straight through without recording anything until enable() is called."""
+    Profiler._globally_enabled = False
+    Profiler._update_active()
+
+
+def monitor(func=None, *, sampling=None, key=None, memory=False):
+    """The monitor function is a decorator that can be used to monitor a Python function and record its execution time, along with the function name and the parent function name. The decorated function is returned by the wrapper function wrapper, which records the start time of the function, runs the original function, records the end time of the function, and adds the relevant data to the global, in-memory event buffer profiling_data.
 
     Args:
     func (function): The function to be monitored.
+    sampling (SamplingPolicy, optional): Which calls to record, as in Profiler.monitor. If not provided, every call is recorded.
+    key (callable, optional): A function of the call's arguments to break execution time down by, as in Profiler.monitor; read the breakdown with `breakdown()`. If not provided, calls are not broken down.
+    memory (bool, optional): Whether to also record the bytes allocated by every recorded call with tracemalloc, as in Profiler.monitor. If not provided, defaults to False.
 
     Returns:
     wrapper function: A wrapped function that will record the function name, parent function name, start time, and end time of the decorated function when it is executed.
     """
+    if func is None:
+        return functools.partial(monitor, sampling=sampling, key=key, memory=memory)
+    if PASSTHROUGH:
+        return func
+    task = _task_name(func)
+
+    if inspect.isasyncgenfunction(func) or inspect.isgeneratorfunction(func):
+        monitor_generator = (Profiler._monitor_async_generator if inspect.isasyncgenfunction(func)
+                             else Profiler._monitor_generator)
+
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            if not Profiler._globally_enabled:
+                return func(*args, **kwargs)
+            return monitor_generator(lambda: profiling_data, func, args, kwargs, sampling=sampling, key=key,
+                                     breakdown=breakdowns, memory=memory, task=task)
+        return generator_wrapper
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            global profiling_data
+            if not Profiler._globally_enabled:
+                return await func(*args, **kwargs)
+            result, profiling_data = await Profiler._monitor_async(profiling_data, func, args, kwargs, sampling=sampling,
+                                                                   key=key, breakdown=breakdowns, memory=memory,
+                                                                   task=task)
+            return result
+        return async_wrapper
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         global profiling_data
-        result, profiling_data = Profiler._monitor(profiling_data, func)
+        if not Profiler._globally_enabled:
+            return func(*args, **kwargs)
+        result, profiling_data = Profiler._monitor(profiling_data, func, args, kwargs, sampling=sampling,
+                                                   key=key, breakdown=breakdowns, memory=memory, task=task)
         return result
     return wrapper
 
 
-def plot_graph(filename, weight_node_on: str = 'count', color_nodes:bool=False):
+def block(name):
+    """The block function returns a context manager recording the code of its `with` block as a call of the task `name` into the global, in-memory event buffer profiling_data, as in Profiler.block.
+
+    Args:
+    name (str): The name of the block's node in the graph.
+
+    Returns:
+    A context manager, used as `with block("parse headers"): ...`.
+    """
+    global profiling_data
+    return _Block(name, profiling_data, time.perf_counter_ns, Profiler._globally_enabled and not PASSTHROUGH)
+
+
+def trace(include=None, exclude=None):
+    """The trace function records every Python function called while it is active into the global, in-memory event buffer profiling_data, as in Profiler.trace.
+
+    Args:
+    include (str or list of str, optional): The modules or packages to trace. If not provided, every module is traced.
+    exclude (str or list of str, optional): The modules or packages not to trace.
+
+    Returns:
+    Tracer: A context manager tracing calls inside its `with` block.
+    """
+    global profiling_data
+    return Tracer(profiling_data, Profiler._record, time.perf_counter_ns, include=include, exclude=exclude)
+
+
+def serve_metrics(host='127.0.0.1', port=0):
+    """The serve_metrics function starts an HTTP server in a background thread exposing the live statistics of the global, in-memory event buffer profiling_data, as in Profiler.serve_metrics.
+
+    Args:
+    host (str, optional): The address to listen on. If not provided, defaults to '127.0.0.1'.
+    port (int, optional): The port to listen on. If not provided, a free port is picked.
+
+    Returns:
+    MetricsExporter: The running exporter.
+    """
+    from .utils.exporter import MetricsExporter
+
+    return MetricsExporter(lambda: profiling_data, host=host, port=port)
+
+
+def plot_graph(filename, weight_node_on: str = 'count', color_nodes:bool=False, top_k: int = None,
+               min_time: float = None, layout: str = None, format: str = None):
     """The plot_graph function generates a visualization of the function call graph created by the profiler and saves it to a file.
 
     Args:
     filename (str): The name of the file to save the plot to.
-    weight_node_on (str, optional): The column name of the dataframe that contains the weights of nodes, which are used to determine the size of the nodes in the plot (available options: 'count', 'total_exec_time', 'average_exec_time'). If not provided, defaults to 'count'.
+    weight_node_on (str, optional): The column name of the dataframe that contains the weights of nodes, which are used to determine the size of the nodes in the plot (available options: 'count', 'total_exec_time', 'average_exec_time', 'total_self_time', 'p50_exec_time', 'p90_exec_time', 'p99_exec_time', times in nanoseconds, and 'total_alloc_bytes' and 'peak_alloc_bytes' for functions monitored with memory=True). If not provided, defaults to 'count'.
     color_nodes (bool, optional): Wheter to apply affine colors for strongly connected groups using Kosaraju's algorithm. If not provided, defaults to 'False'.
+    top_k, min_time, layout, format (optional): Options for large graphs and other output formats, as in Profiler.plot_graph.
 
     Returns:
     None. The plot is saved to the file specified by filename.
     """
     global profiling_data
-    return Profiler._plot_graph(profiling_data, filename=filename, weight_node_on=weight_node_on, color_nodes=color_nodes)
+    return Profiler._plot_graph(profiling_data, filename=filename, weight_node_on=weight_node_on, color_nodes=color_nodes,
+                                graph_cache=_graph_cache, top_k=top_k, min_time=min_time, layout=layout, format=format)
 
 def to_graph():
     global profiling_data
-    return Profiler._to_graph(profiling_data)
+    return Profiler._to_graph(profiling_data, _graph_cache)
+
+def to_call_tree():
+    global profiling_data
+    return Profiler._to_call_tree(profiling_data)
 
 def to_dataframe():
     global profiling_data
     return Profiler._to_dataframe(profiling_data)
+
+def breakdown():
+    """Return the execution time statistics of the functions monitored with a `key`, per key bucket, as in Profiler.breakdown."""
+    return breakdowns.to_dataframe()
     
 def to_json(name=__name__):
     global profiling_data
@@ -80,4 +208,38 @@ def to_json(name=__name__):
         str: A JSON-encoded string representing the contents of the object.
     """
     return Profiler._to_json(profiling_data)
+
+def to_flamegraph(path):
+    """
+    Write the self time of every calling context of the module-level profiling data in collapsed-stack format, as in Profiler.to_flamegraph.
+
+    Args:
+    path (str): The path of the file to write.
+    """
+    global profiling_data
+    return Profiler._to_flamegraph(profiling_data, path)
+
+def to_chrome_trace(path):
+    """
+    Write every call of the module-level profiling data as a Chrome Trace Event JSON file, as in Profiler.to_chrome_trace.
+
+    Args:
+    path (str): The path of the file to write.
+    """
+    global profiling_data
+    return Profiler._to_chrome_trace(profiling_data, path)
+
+def to_file(path, format=None):
+    """
+    Write the module-level profiling data to a compact, compressed file that can be read back with `Profiler.from_file`.
+
+    Args:
+    path (str): The path of the file to write.
+    format (str, optional): The file format (available options: 'parquet', 'binary'). If not provided, defaults to 'parquet' when pyarrow is installed and 'binary' otherwise.
+
+    Returns:
+    None. The events are saved to the file specified by path.
+    """
+    global profiling_data
+    return Profiler._to_file(profiling_data, path, format=format)
     
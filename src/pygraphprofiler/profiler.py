@@ -2,42 +2,152 @@ import json
 import time
 import functools
 import inspect
-import networkx as nx
+import os
 import time
-import pandas as pd
+import weakref
 
-from .utils.graph import _add_graph_edges, _add_graph_nodes
-from .utils.plot import _draw_graph_to_file, _set_edge_labels, _set_graph_layout, _set_node_labels, _set_node_sizes
+from .utils.aggregate import AggregateBuffer
+from .utils.breakdown import KeyedBreakdown
+from .utils.chunked import ANALYSIS_CHUNK_SIZE, graph_from_files
+from .utils.diff import ProfileDiff
+from .utils.fileio import EventFileWriter, read_event_file
+from .utils.incremental import GraphCache
+from .utils.memory import _start_measure, _stop_measure
+from .utils.recorder import EventBuffer, _as_buffer
+from .utils.sink import FileSink, _load_directory
+from .utils.spill import SegmentDirectory, SpillingBuffer
+from .utils.stack import ROOT_PATH_ID, _caller_name, _charge_parent, _current_frame, _current_task, _pop_task, _push_task, _task_name
+from .utils.timeline import write_chrome_trace, write_collapsed_stacks
+from .utils.timers import DEFAULT_TIMER, _get_timer
+from .utils.tracer import Tracer
+
+
+# Recording modes: 'events' keeps every call, 'aggregate' keeps only running per-task and per-edge statistics.
+BUFFERS = {
+    'events': EventBuffer,
+    'aggregate': AggregateBuffer,
+}
+
+
+# Named profilers registered with setProfiler or getProfiler, by dotted name (e.g. 'app.db')
+PROFILERS = {}
+
+# Setting the PYGRAPHPROFILER_DISABLE environment variable to a non-empty value other than '0' makes every monitor
+# decorator return the function undecorated, for zero overhead in production; those functions are never recorded.
+PASSTHROUGH = os.environ.get('PYGRAPHPROFILER_DISABLE', '0') not in ('', '0')
+
+# Every live Profiler, whose effective on/off state is refreshed when any switch changes
+_instances = weakref.WeakSet()
+
+# Key of calls monitored without a key function, or whose key function raised: they are not broken down
+_NO_KEY = object()
 
 
 class Profiler:
 
+    # Global kill switch, see disable() and enable()
+    _globally_enabled = True
+
     @classmethod
-    def _to_graph(cls, data):
-        task_df = cls._to_dataframe(data)
+    def _update_active(cls):
+        # A registered profiler records when the global switch, itself and every registered ancestor are enabled
+        for profiler in list(_instances):
+            active = cls._globally_enabled and profiler.enabled
+            if active and PROFILERS.get(profiler.name) is profiler:
+                parts = profiler.name.split('.')
+                active = all(PROFILERS[ancestor].enabled
+                             for ancestor in ('.'.join(parts[:i]) for i in range(1, len(parts)))
+                             if ancestor in PROFILERS)
+            profiler._active = active
+
+    @classmethod
+    def _to_graph(cls, data, graph_cache=None):
+        # pandas, networkx and matplotlib are only imported on first export, so
+        # that importing the package and recording calls need the standard library only
+        import networkx as nx
+        if graph_cache is not None and isinstance(data, EventBuffer):
+            return graph_cache.snapshot(data)
+        if isinstance(data, SegmentDirectory):
+            # Spilled events are read back one chunk at a time rather than loaded
+            data.flush()
+            return graph_from_files(data.directory)
+        from .utils.graph import _add_aggregate_edges, _add_aggregate_nodes, _add_graph_edges, _add_graph_nodes
+
         graph = nx.DiGraph()
+        if isinstance(data, AggregateBuffer):
+            graph = _add_aggregate_nodes(data, graph)
+            graph = _add_aggregate_edges(data, graph)
+            return graph
+        task_df = cls._to_dataframe(data)
         graph = _add_graph_nodes(task_df, graph)
         graph = _add_graph_edges(task_df, graph)
         return graph
 
+    @classmethod
+    def _to_call_tree(cls, data):
+        import networkx as nx
+        from .utils.graph import _add_aggregate_call_tree, _add_call_tree
+
+        tree = nx.DiGraph()
+        if isinstance(data, AggregateBuffer):
+            return _add_aggregate_call_tree(data, tree)
+        return _add_call_tree(cls._to_dataframe(data), tree)
+
     @classmethod
     def _to_dataframe(cls, data):
-        return pd.DataFrame(data)
+        return _as_buffer(data).to_dataframe()
 
     @classmethod
-    def _plot_graph(cls, data, filename, weight_node_on, color_nodes):
-        graph = cls._to_graph(data)
-        pos = _set_graph_layout(graph)
-        node_labels = _set_node_labels(weight_node_on, graph)
-        edge_labels = _set_edge_labels(graph)
-        node_sizes = _set_node_sizes(weight_node_on, graph)
-        _draw_graph_to_file(filename, graph, pos,
-                            node_labels, edge_labels, node_sizes,
-                            color_nodes)
+    def _plot_graph(cls, data, filename, weight_node_on, color_nodes, graph_cache=None,
+                    top_k=None, min_time=None, layout=None, format=None):
+        from .utils.plot import _plot_graph_to_file
+
+        graph = cls._to_graph(data, graph_cache)
+        _plot_graph_to_file(graph, filename, weight_node_on, color_nodes, top_k=top_k, min_time=min_time, layout=layout,
+                            format=format)
 
     @classmethod
     def _to_json(cls, data):
-        return json.dumps(data)
+        return json.dumps(_as_buffer(data).to_dict())
+
+    @classmethod
+    def _stream_to_file(cls, data, path, format=None):
+        if isinstance(data, AggregateBuffer):
+            raise ValueError("Binary files can only be written in 'events' mode, use to_json instead")
+        if isinstance(data, (FileSink, SegmentDirectory)):
+            data = data.load()
+        return EventFileWriter(_as_buffer(data), path, format=format)
+
+    @classmethod
+    def _to_file(cls, data, path, format=None):
+        with cls._stream_to_file(data, path, format=format):
+            pass
+
+    @classmethod
+    def _to_flamegraph(cls, data, path):
+        if not isinstance(data, (AggregateBuffer, FileSink, SegmentDirectory)):
+            data = _as_buffer(data)
+        write_collapsed_stacks(data, path)
+
+    @classmethod
+    def _to_chrome_trace(cls, data, path):
+        if not isinstance(data, (AggregateBuffer, FileSink, SegmentDirectory)):
+            data = _as_buffer(data)
+        write_chrome_trace(data, path)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Returns a new instance of the Profiler class with the data from a file written by `to_file` or `stream_to_file`.
+
+        :param path: The path of a Parquet or binary event file.
+        :type path: str
+        :return: A new instance of the Profiler class.
+        :rtype: Profiler
+        """
+        profiler = cls()
+        profiler.profiling_data = read_event_file(path)
+        return profiler
 
     @classmethod
     def from_json(cls, json_str):
@@ -50,67 +160,402 @@ class Profiler:
         :rtype: Profiler
         """
         data = json.loads(json_str)
+        if "nodes" in data:
+            profiler = cls(mode='aggregate')
+            profiler.profiling_data = AggregateBuffer.from_dict(data)
+        else:
+            profiler = cls()
+            profiler.profiling_data = EventBuffer.from_dict(data)
+        return profiler
+
+    @classmethod
+    def graph_from_files(cls, *paths, chunk_size=ANALYSIS_CHUNK_SIZE, processes=None):
+        """
+        Returns the call graph of profiles too large to load, reading them from disk chunk by chunk.
+
+        Node and edge statistics are folded in one chunk at a time, so memory is bounded by one chunk plus the graph,
+        whatever the number of events; the graph has the same attributes as `to_graph` on the same events.
+
+        :param paths: Files written by `to_file` or `stream_to_file`, in either format, and sink directories, e.g. one per host.
+        :type paths: str
+        :param chunk_size: The maximum number of events read at once.
+        :type chunk_size: int
+        :param processes: The number of worker processes reading and aggregating chunks in parallel. If not provided, chunks are read in this process.
+        :type processes: int
+        :return: The call graph of every event in every path.
+        :rtype: networkx.DiGraph
+        """
+        return graph_from_files(paths, chunk_size=chunk_size, processes=processes)
+
+    @classmethod
+    def from_sink(cls, directory):
+        """
+        Returns a new instance of the Profiler class with the events written to a sink directory by every process.
+
+        :param directory: The directory passed as `sink` to the recording Profiler.
+        :type directory: str
+        :return: A new instance of the Profiler class, with additional `pid` and `worker` columns.
+        :rtype: Profiler
+        """
+        profiler = cls()
+        profiler.profiling_data = _load_directory(directory)
+        return profiler
+
+    @classmethod
+    def from_segments(cls, directory):
+        """
+        Returns a new instance of the Profiler class reading the segments spilled to a directory by every process, lazily.
+
+        No event is read until exported: to_graph, to_flamegraph, to_chrome_trace and diffs read one segment at a time,
+        other exports load every segment at once.
+
+        :param directory: The directory passed as `spill` to the recording Profiler.
+        :type directory: str
+        :return: A new instance of the Profiler class, with an additional `pid` column.
+        :rtype: Profiler
+        """
         profiler = cls()
-        profiler.profiling_data = {}
-        profiler.profiling_data["task"] = data['task']
-        profiler.profiling_data["parent_task"] = data['parent_task']
-        profiler.profiling_data["start_time"] = data['start_time']
-        profiler.profiling_data["end_time"] = data['end_time']
+        profiler.profiling_data = SegmentDirectory(directory)
         return profiler
 
     @classmethod
-    def _monitor(cls, profiling_data, func, *args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        profiling_data["task"].append(func.__name__)
-        profiling_data["parent_task"].append(inspect.stack()[2].function)
-        profiling_data["start_time"].append(start_time)
-        profiling_data["end_time"].append(end_time)
+    def _monitor(cls, profiling_data, func, args=(), kwargs=None, timer=time.perf_counter_ns, sampling=None,
+                 key=None, breakdown=None, memory=False, task=None):
+        # Arguments are passed as a tuple and a dict, so that the function's own keyword arguments can never clash with
+        # the wrapper's. The parent is the innermost active monitored call in this thread or asyncio
+        # task; for top-level calls fall back to the name of the frame calling the wrapper.
+        if kwargs is None:
+            kwargs = {}
+        parent_task = _current_task()
+        if parent_task is None:
+            parent_task = _caller_name(2)
+        frame, token = _push_task(_task_name(func) if task is None else task)
+        weight = 1 if sampling is None else sampling.before()
+        if weight is None:
+            # Not sampled: still tracked as the parent of the calls it makes, but neither timed nor recorded
+            try:
+                return func(*args, **kwargs), profiling_data
+            finally:
+                _pop_task(token)
+        # The key is computed before the call, which may consume or change its arguments. Allocations are measured
+        # around the timed section, so that starting and stopping tracemalloc does not count towards the time.
+        call_key = _call_key(key, args, kwargs)
+        measure = _start_measure() if memory else None
+        start_time = timer()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            _pop_task(token)
+            end_time = timer()
+            allocated = _stop_measure(measure) if memory else None
+        weight = cls._record(profiling_data, frame, parent_task, start_time, end_time, sampling, weight, allocated)
+        if call_key is not _NO_KEY and weight:
+            breakdown.add(frame[0], call_key, end_time - start_time, weight)
+        return result, profiling_data
+
+    @classmethod
+    async def _monitor_async(cls, profiling_data, func, args=(), kwargs=None, timer=time.perf_counter_ns, sampling=None,
+                             key=None, breakdown=None, memory=False, task=None):
+        # Same as _monitor for coroutine functions, timing the call across its awaits.
+        if kwargs is None:
+            kwargs = {}
+        parent_task = _current_task()
+        if parent_task is None:
+            parent_task = _caller_name(2)
+        frame, token = _push_task(_task_name(func) if task is None else task)
+        weight = 1 if sampling is None else sampling.before()
+        if weight is None:
+            try:
+                return await func(*args, **kwargs), profiling_data
+            finally:
+                _pop_task(token)
+        call_key = _call_key(key, args, kwargs)
+        measure = _start_measure() if memory else None
+        start_time = timer()
+        try:
+            result = await func(*args, **kwargs)
+        finally:
+            _pop_task(token)
+            end_time = timer()
+            allocated = _stop_measure(measure) if memory else None
+        weight = cls._record(profiling_data, frame, parent_task, start_time, end_time, sampling, weight, allocated)
+        if call_key is not _NO_KEY and weight:
+            breakdown.add(frame[0], call_key, end_time - start_time, weight)
         return result, profiling_data
 
+    @classmethod
+    def _monitor_generator(cls, get_data, func, args=(), kwargs=None, timer=time.perf_counter_ns, sampling=None,
+                           key=None, breakdown=None, memory=False, task=None):
+        # Same as _monitor for generator functions, as a generator delegating to the monitored one: each resume is
+        # timed, and the resumes made by each consumer are recorded as a single call. `get_data` returns the profiling
+        # data at that time, as the generator may outlive the buffer it was created with.
+        if kwargs is None:
+            kwargs = {}
+        call_key = _call_key(key, args, kwargs)
+        resumes = _Resumes(_task_name(func) if task is None else task, get_data, timer, sampling, call_key, breakdown,
+                           memory)
+        generator = func(*args, **kwargs)
+        method, value = generator.send, None
+        try:
+            while True:
+                resumes.start()
+                try:
+                    item = method(value)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    resumes.stop()
+                try:
+                    value = yield item
+                    method = generator.send
+                except GeneratorExit:
+                    # Closing runs the generator's own cleanup, timed as a last resume
+                    resumes.start()
+                    try:
+                        generator.close()
+                    finally:
+                        resumes.stop()
+                    raise
+                except BaseException as exception:
+                    method, value = generator.throw, exception
+        finally:
+            resumes.flush()
 
-    def __init__(self, name='__main__'):
+    @classmethod
+    async def _monitor_async_generator(cls, get_data, func, args=(), kwargs=None, timer=time.perf_counter_ns,
+                                       sampling=None, key=None, breakdown=None, memory=False, task=None):
+        # Same as _monitor_generator for async generator functions, each resume being timed across its awaits.
+        if kwargs is None:
+            kwargs = {}
+        call_key = _call_key(key, args, kwargs)
+        resumes = _Resumes(_task_name(func) if task is None else task, get_data, timer, sampling, call_key, breakdown,
+                           memory)
+        generator = func(*args, **kwargs)
+        method, value = generator.asend, None
+        try:
+            while True:
+                resumes.start()
+                try:
+                    item = await method(value)
+                except StopAsyncIteration:
+                    return
+                finally:
+                    resumes.stop()
+                try:
+                    value = yield item
+                    method = generator.asend
+                except GeneratorExit:
+                    resumes.start()
+                    try:
+                        await generator.aclose()
+                    finally:
+                        resumes.stop()
+                    raise
+                except BaseException as exception:
+                    method, value = generator.athrow, exception
+        finally:
+            resumes.flush()
+
+    @staticmethod
+    def _record(profiling_data, frame, parent_task, start_time, end_time, sampling, weight, allocated=None,
+                charge_parent=True):
+        # Returns the weight the call was recorded with, 0 if the sampling policy dropped it. `allocated` holds the net
+        # and peak bytes allocated by the call, when measured. Callers that already charged the parent frame for the
+        # call's time, as generators do on every resume, pass charge_parent=False.
+        task, parent_frame, depth, path_id, child_time = frame
+        exec_time = end_time - start_time
+        # Self time excludes the time spent in monitored children. A sampled call stands for `weight` calls of
+        # its function, so it charges its parent for all of them; extrapolated sampled children, or concurrent ones
+        # not covered by _charge_parent, may still exceed the parent's time, whose self time then stays at 0.
+        if parent_frame is not None and charge_parent:
+            _charge_parent(parent_frame, start_time, end_time, weight)
+        extra = {
+            "self_time": max(0, round(exec_time - child_time[0])),
+            "depth": depth,
+            "path_id": path_id,
+            "parent_path_id": parent_frame[3] if parent_frame is not None else ROOT_PATH_ID,
+        }
+        if allocated is not None:
+            extra["alloc_bytes"], extra["peak_alloc_bytes"] = allocated
+        if sampling is not None:
+            weight = sampling.after(weight, exec_time)
+            if not weight:
+                return 0
+            extra["weight"] = weight
+        profiling_data.append(task, parent_task, start_time, end_time, extra)
+        return weight
+
+
+    def __init__(self, name='__main__', timer=DEFAULT_TIMER, mode='events', sink=None, spill=None):
         """The __init__ method is the constructor of the Profiler class, initializing the instance variables of a new Profiler object.
 
         Args:
-        None
+        name (str, optional): The name of the profiler. Profilers registered under dotted names with `setProfiler` or `getProfiler` form a hierarchy, as in logging: disabling 'app' also disables 'app.db'. If not provided, defaults to '__main__'.
+        timer (str or callable, optional): The clock used to time monitored calls, all recorded as integer nanoseconds (available options: 'perf_counter' for wall time, 'process_time' and 'thread_time' for CPU time only, or a zero-argument callable returning nanoseconds). If not provided, defaults to 'perf_counter'.
+        mode (str, optional): How monitored calls are recorded (available options: 'events' to keep every call, 'aggregate' to keep only running count, total, min and max execution time per task and call counts per edge, in bounded memory). If not provided, defaults to 'events'.
+        sink (str, optional): A directory to stream events to as fixed-size binary records, one file per process, instead of keeping them in memory. A Profiler created before forking worker processes collects all of them; read everything back with `Profiler.from_sink` or this profiler's own export methods. Only available in 'events' mode. If not provided, events are kept in memory.
+        spill (str or SpillingBuffer, optional): A directory to which a background thread spills events, as rotating segment files, so that memory stays bounded by a few batches per thread; monitored code never waits on the disk. Pass a SpillingBuffer to choose what happens when the writer falls behind (policy 'drop' or 'block'), the segment size and how many segments to keep. Buffered events are written at process exit or on `profiling_data.close()`; read them back lazily with `Profiler.from_segments` or this profiler's own export methods. Only available in 'events' mode, and not along with `sink`. If not provided, events are kept in memory.
 
         Returns:
         Profiler instance
         """
-        self.profiling_data = {
-            "task" : [],
-            "parent_task" : [],
-            "start_time" : [],
-            "end_time" : [],
-        }
-
-    def monitor(self, func):
-        """The monitor function is a decorator that can be used to monitor a Python function and record its execution time, along with the function name and the parent function name. The decorated function is returned by the wrapper function wrapper, which records the start time of the function, runs the original function, records the end time of the function, and adds the relevant data to the Profiler instance's _func_names_list, _parent_func_list, _start_time_list, and _end_time_list.
+        if mode not in BUFFERS:
+            raise ValueError(f"Unknown mode {mode!r}, available options: {', '.join(BUFFERS)}")
+        if sink is not None and mode != 'events':
+            raise ValueError("A sink can only be used in 'events' mode")
+        if spill is not None and mode != 'events':
+            raise ValueError("Events can only be spilled in 'events' mode")
+        if spill is not None and sink is not None:
+            raise ValueError("Events can either be streamed to a sink or spilled, not both")
+        self.name = name
+        self.enabled = True
+        self._active = Profiler._globally_enabled
+        _instances.add(self)
+        self.mode = mode
+        if sink is not None:
+            self.profiling_data = FileSink(sink)
+        elif spill is not None:
+            self.profiling_data = spill if isinstance(spill, SpillingBuffer) else SpillingBuffer(spill)
+        else:
+            self.profiling_data = BUFFERS[mode]()
+        self.timer = _get_timer(timer)
+        self._graph_cache = GraphCache()
+        self.breakdowns = KeyedBreakdown()
+
+    def monitor(self, func=None, *, sampling=None, key=None, memory=False):
+        """The monitor function is a decorator that can be used to monitor a Python function and record its execution time, along with the function name and the parent function name. The decorated function is returned by the wrapper function wrapper, which records the start time of the function, runs the original function, records the end time of the function, and adds the relevant data to the Profiler instance's event buffer profiling_data.
 
         Args:
         func (function): The function to be monitored.
+        sampling (SamplingPolicy, optional): Which calls to record, for functions too hot to record every call (available options: EveryN(n), Probability(p), RateLimit(rate, burst) and MinDuration(threshold), one instance per function). Recorded calls carry a `weight` so that counts and total times in to_graph and plot_graph remain unbiased estimates. Use as `@profiler.monitor(sampling=EveryN(100))`. If not provided, every call is recorded.
+        key (callable, optional): A function called with the arguments of every recorded call, returning the key to break its execution time down by (e.g. `key=lambda rows, **kwargs: len(rows)` for the input size, or a tenant id). Numeric keys are bucketed to powers of two and at most 64 keys are kept per function, the rest being counted under 'other', so memory stays fixed; read the breakdown with `breakdown()`. Calls for which it raises or returns an unhashable value are still recorded, but not broken down. If not provided, calls are not broken down.
+        memory (bool, optional): Whether to also record the bytes allocated by every recorded call, as measured by tracemalloc: the net bytes still allocated when it returns ('alloc_bytes') and the highest allocation reached during the call ('peak_alloc_bytes'), which become the 'total_alloc_bytes' and 'peak_alloc_bytes' node attributes of to_graph and can be used as weight_node_on in plot_graph. Allocations are only traced while a measured call runs, so combine it with `sampling` to keep the overhead low on hot functions; peaks include the allocations made meanwhile by other threads. Not recorded by a sink. If not provided, defaults to False.
+
+        Functions are recorded under their module and qualified name, e.g. 'app.models:User.save', so that methods of different classes sharing a name are separate nodes; graph plots label them without the module. Coroutine functions get an async wrapper that times the whole call across its awaits. Generators and async generators are timed on every resume instead of only until they are created, and the resumes made by each consumer are recorded as one call of the generator by that consumer, lasting their total time. Parent functions are tracked separately for each thread and asyncio task. While the profiler is disabled the wrapper calls the function straight through; with the PYGRAPHPROFILER_DISABLE environment variable set, the function is returned undecorated.
 
         Returns:
         wrapper function: A wrapped function that will record the function name, parent function name, start time, and end time of the decorated function when it is executed.
         """
+        if func is None:
+            return functools.partial(self.monitor, sampling=sampling, key=key, memory=memory)
+        if PASSTHROUGH:
+            return func
+        task = _task_name(func)
+
+        if inspect.isasyncgenfunction(func) or inspect.isgeneratorfunction(func):
+            monitor_generator = (self._monitor_async_generator if inspect.isasyncgenfunction(func)
+                                 else self._monitor_generator)
+
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                if not self._active:
+                    return func(*args, **kwargs)
+                return monitor_generator(lambda: self.profiling_data, func, args, kwargs, timer=self.timer,
+                                         sampling=sampling, key=key, breakdown=self.breakdowns, memory=memory,
+                                         task=task)
+            return generator_wrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not self._active:
+                    return await func(*args, **kwargs)
+                result, self.profiling_data = await self._monitor_async(
+                    self.profiling_data, func, args, kwargs, timer=self.timer, sampling=sampling,
+                    key=key, breakdown=self.breakdowns, memory=memory, task=task)
+                return result
+            return async_wrapper
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            result, self.profiling_data = self._monitor(self.profiling_data, func)
+            if not self._active:
+                return func(*args, **kwargs)
+            result, self.profiling_data = self._monitor(
+                self.profiling_data, func, args, kwargs, timer=self.timer, sampling=sampling,
+                key=key, breakdown=self.breakdowns, memory=memory, task=task)
             return result
         return wrapper
 
+    def block(self, name):
+        """The block method returns a context manager recording the code of its `with` block as a call of the task `name`, for timing regions of code smaller than a function.
+
+        Args:
+        name (str): The name of the block's node in the graph, e.g. 'parse headers'.
+
+        Monitored calls made inside the block are its children, and the block is a child of the innermost monitored call around it, as if it were a monitored function.
+
+        Returns:
+        A context manager, used as `with profiler.block("parse headers"): ...`.
+        """
+        return _Block(name, self.profiling_data, self.timer, self._active and not PASSTHROUGH)
+
+    def enable(self):
+        """Resume recording the calls of functions monitored by this profiler, unless a registered ancestor or the global switch is disabled."""
+        self.enabled = True
+        self._update_active()
+
+    def disable(self):
+        """Stop recording the calls of functions monitored by this profiler and, for a registered profiler, by its descendants. Monitored functions then call straight through, at the cost of a single attribute check."""
+        self.enabled = False
+        self._update_active()
+
+    @property
+    def is_enabled(self):
+        """Whether calls are currently recorded, taking registered ancestors and the global switch into account."""
+        return self._active
+
+    def trace(self, include=None, exclude=None):
+        """The trace method records every Python function called while it is active, including library functions, without decorating them. Traced calls go through the same call stack and profiling_data as monitored ones, so they appear in to_graph, plot_graph and every export alongside them.
+
+        Args:
+        include (str or list of str, optional): The modules or packages to trace, a package covering every module below it (e.g. ['myapp', 'requests']). If not provided, every module is traced.
+        exclude (str or list of str, optional): The modules or packages not to trace, taking precedence over include (e.g. 'myapp.vendored'). This package is always excluded, and functions decorated with `monitor` are recorded by their decorator only.
+
+        On Python 3.12+ calls are observed with `sys.monitoring` in every thread, and excluded functions are switched off after their first call. Older versions fall back to `sys.setprofile`, covering the current thread and the threads it starts while tracing.
+
+        Returns:
+        Tracer: A context manager tracing calls inside its `with` block; also available as `tracer.start()` and `tracer.stop()`.
+        """
+        return Tracer(self.profiling_data, self._record, self.timer, include=include, exclude=exclude)
+
+    def serve_metrics(self, host='127.0.0.1', port=0):
+        """The serve_metrics method starts an HTTP server in a background thread exposing the live statistics of this profiler: `GET /metrics` returns per-task call, execution time and self time counters, per-edge call counters and per-task latency histograms in OpenMetrics (Prometheus) text format, and `GET /graph` a JSON snapshot of the call graph. Scrapes only copy the events recorded since the previous one, so they never stall monitored code for long.
+
+        Args:
+        host (str, optional): The address to listen on. If not provided, defaults to '127.0.0.1'.
+        port (int, optional): The port to listen on. If not provided, a free port is picked.
+
+        Returns:
+        MetricsExporter: The running exporter, whose `url` gives the address it listens on and whose `close()` method (also called when used as a context manager) stops it.
+        """
+        # Imported here, as http.server is only needed once metrics are served
+        from .utils.exporter import MetricsExporter
+
+        return MetricsExporter(lambda: self.profiling_data, host=host, port=port)
+
     def to_graph(self):
         """The to_graph method converts the profiling data of the Profiler instance into a directed graph and returns it.
 
         Args:
         None
 
+        In 'events' mode the graph is cached and only the events recorded since the previous call are folded into it, so that polling to_graph or plot_graph costs time proportional to the new events. Its `graph` attribute dict holds the snapshot `version`, which changes only when new events were folded in, and the number of `events` it covers.
+
         Returns:
         graph (networkx.DiGraph): A directed graph representing the execution order of t.
         """
-        return self._to_graph(self.profiling_data)
+        return self._to_graph(self.profiling_data, self._graph_cache)
+
+    def to_call_tree(self):
+        """The to_call_tree method builds the calling-context tree of the profiling data: unlike to_graph, which has one node per function, it has one node per distinct chain of monitored calls leading to a function.
+
+        Args:
+        None
+
+        Returns:
+        tree (networkx.DiGraph): A directed graph with one node per calling context, keyed by its path id and with the attributes 'task', 'depth', 'count', 'total_exec_time' and 'total_self_time' (time not spent in monitored children), and 'calls' edges from each context to the contexts it calls. Top-level calls are the roots.
+        """
+        return self._to_call_tree(self.profiling_data)
 
     def to_dataframe(self):
         """The to_dataframe method creates a pandas DataFrame object from the monitored function data stored in the Profiler object.
@@ -119,22 +564,39 @@ class Profiler:
         None
 
         Returns:
-        task_df (pandas DataFrame): A DataFrame object containing the monitored function data. Each row of the DataFrame represents a single function call and contains columns for the function name, its parent function name, the start time of the function call, and the end time of the function call.
+        task_df (pandas DataFrame): A DataFrame object containing the monitored function data. Each row of the DataFrame represents a single function call and contains columns for the function name, its parent function name, the start time of the function call, and the end time of the function call. In 'aggregate' mode each row represents a task instead, with its count, total, average, min and max execution time, self time and p50/p90/p99 latency.
         """
         return self._to_dataframe(self.profiling_data)
 
-    def plot_graph(self, filename, weight_node_on: str = 'count', color_nodes:bool=False):
+    def breakdown(self):
+        """The breakdown method returns the execution time statistics of the functions monitored with a `key`, per key bucket.
+
+        Args:
+        None
+
+        Returns:
+        breakdown_df (pandas DataFrame): A DataFrame with one row per task and key bucket, with columns 'task', 'key', 'count', 'total_exec_time', 'average_exec_time' and p50/p90/p99 latency. Numeric keys are the power of two at or below the keys of the calls in their bucket; calls beyond the 64 keys kept per task are under 'other'.
+        """
+        return self.breakdowns.to_dataframe()
+
+    def plot_graph(self, filename, weight_node_on: str = 'count', color_nodes:bool=False, top_k: int = None,
+                   min_time: float = None, layout: str = None, format: str = None):
         """The plot_graph function generates a visualization of the function call graph created by the profiler and saves it to a file.
 
         Args:
         filename (str): The name of the file to save the plot to.
-        weight_node_on (str, optional): The column name of the dataframe that contains the weights of nodes, which are used to determine the size of the nodes in the plot (available options: 'count', 'total_exec_time', 'average_exec_time'). If not provided, defaults to 'count'.
+        weight_node_on (str, optional): The column name of the dataframe that contains the weights of nodes, which are used to determine the size of the nodes in the plot (available options: 'count', 'total_exec_time', 'average_exec_time', 'total_self_time', 'p50_exec_time', 'p90_exec_time', 'p99_exec_time', times in nanoseconds, and 'total_alloc_bytes' and 'peak_alloc_bytes' for functions monitored with memory=True). If not provided, defaults to 'count'.
         color_nodes (bool, optional): Wheter to apply affine colors for strongly connected groups using Kosaraju's algorithm. If not provided, defaults to 'False'.
+        top_k (int, optional): Only draw the top_k nodes with the largest `weight_node_on` value. If not provided, every node is drawn.
+        min_time (float, optional): Collapse the functions whose total_exec_time is below min_time nanoseconds, and the functions they call, into a single '<parent>/<n collapsed>' node per caller. If not provided, nothing is collapsed.
+        layout (str, optional): The layout backend (available options: 'dot' for graphviz's hierarchical layout, 'sfdp' for its fast force-directed one, both requiring pygraphviz, and 'spring' for networkx's force-directed layout). If not provided, defaults to 'dot' up to DOT_MAX_NODES nodes, 'sfdp' above and 'spring' when pygraphviz is missing. Layouts are cached by graph topology, so replotting an unchanged graph skips this step.
+        format (str, optional): The output format (available options: any matplotlib format such as 'png', 'svg' or 'pdf', and 'dot' to write the graph in Graphviz DOT format without laying it out, for rendering out of process). If not provided, inferred from the extension of filename, defaulting to 'png'.
 
         Returns:
         None. The plot is saved to the file specified by filename.
         """
-        self._plot_graph(self.profiling_data, filename=filename, weight_node_on=weight_node_on, color_nodes=color_nodes)
+        self._plot_graph(self.profiling_data, filename=filename, weight_node_on=weight_node_on, color_nodes=color_nodes,
+                         graph_cache=self._graph_cache, top_k=top_k, min_time=min_time, layout=layout, format=format)
 
     def to_json(self):
         """
@@ -148,6 +610,172 @@ class Profiler:
         """
         return self._to_json(self.profiling_data)
 
+    def to_file(self, path, format=None):
+        """Write the recorded events to a compact, compressed file that can be read back with `Profiler.from_file`.
+
+        Args:
+        path (str): The path of the file to write.
+        format (str, optional): The file format (available options: 'parquet', which requires pyarrow, and 'binary', a zlib-compressed format needing only the standard library). If not provided, defaults to 'parquet' when pyarrow is installed and 'binary' otherwise.
+
+        Returns:
+        None. The events are saved to the file specified by path.
+        """
+        self._to_file(self.profiling_data, path, format=format)
+
+    def to_flamegraph(self, path):
+        """Write the self time of every calling context in collapsed-stack format, for flamegraph.pl (`flamegraph.pl out.folded > out.svg`) or speedscope.
+
+        Args:
+        path (str): The path of the file to write.
+
+        Returns:
+        None. Each line of the file is a `root;caller;callee <self time in nanoseconds>` stack. Only available in 'events' mode; events are read in chunks, without building a DataFrame.
+        """
+        self._to_flamegraph(self.profiling_data, path)
+
+    def to_chrome_trace(self, path):
+        """Write every recorded call as a Chrome Trace Event JSON file, to find latency spikes on a timeline in Perfetto (ui.perfetto.dev) or chrome://tracing.
+
+        Args:
+        path (str): The path of the file to write.
+
+        Returns:
+        None. Each call becomes a complete event on the track of its process and thread. Only available in 'events' mode; events are streamed to the file in chunks, without building a DataFrame.
+        """
+        self._to_chrome_trace(self.profiling_data, path)
+
+    def stream_to_file(self, path, format=None):
+        """Open a file to which recorded events can be written in chunks while recording goes on.
+
+        Args:
+        path (str): The path of the file to write.
+        format (str, optional): The file format, as in `to_file`.
+
+        Returns:
+        EventFileWriter: A writer whose `write()` method appends the events recorded since its previous call as one chunk, and whose `close()` method (also called when used as a context manager) writes the remaining events and closes the file.
+        """
+        return self._stream_to_file(self.profiling_data, path, format=format)
+
+
+def _call_key(key, args, kwargs):
+    # A failing key function, or one returning an unhashable value, only loses the breakdown of the call, which still
+    # runs and is recorded as usual
+    if key is None:
+        return _NO_KEY
+    try:
+        call_key = key(*args, **kwargs)
+        hash(call_key)
+    except Exception:
+        return _NO_KEY
+    return call_key
+
+
+class _Resumes:
+    """Resumes of a monitored generator, recorded as one call of the generator per consumer.
+
+    A consumer is the innermost monitored call resuming the generator, or the calling function at top level. When the
+    consumer changes and when the generator finishes, the resumes made by the previous consumer are recorded as a call
+    starting at the first of them and lasting their total time, so that time spent in a streaming pipeline is charged
+    to the stages consuming it rather than to the call creating the generator.
+    """
+
+    def __init__(self, task, get_data, timer, sampling, call_key, breakdown, memory):
+        self.task = task
+        self.get_data = get_data
+        self.timer = timer
+        self.sampling = sampling
+        self.call_key = call_key
+        self.breakdown = breakdown
+        self.memory = memory
+        # Sampling decides once per generator: unsampled generators are still tracked as the parent of their calls
+        self.weight = 1 if sampling is None else sampling.before()
+        self.consumer = None
+        self.parent_task = None
+        self.frame = None
+        self.token = None
+        self.measure = None
+        self.resume_time = None
+        self._reset()
+
+    def _reset(self):
+        self.start_time = None
+        self.exec_time = 0
+        self.child_time = 0
+        self.allocated = [0, 0] if self.memory else None
+
+    def start(self):
+        parent = _current_frame()
+        # Frames are compared by identity: two calls of the same function are two consumers
+        consumer = parent if parent is not None else _caller_name(2)
+        if consumer is not self.consumer and not (parent is None and consumer == self.consumer):
+            self.flush()
+            self.consumer = consumer
+            self.parent_task = parent[0] if parent is not None else consumer
+        self.frame, self.token = _push_task(self.task)
+        if self.weight is None:
+            return
+        self.measure = _start_measure() if self.memory else None
+        self.resume_time = self.timer()
+        if self.start_time is None:
+            self.start_time = self.resume_time
+
+    def stop(self):
+        _pop_task(self.token)
+        if self.weight is None:
+            return
+        exec_time = self.timer() - self.resume_time
+        if self.measure is not None:
+            net, peak = _stop_measure(self.measure)
+            self.allocated[0] += net
+            self.allocated[1] = max(self.allocated[1], peak)
+        self.exec_time += exec_time
+        self.child_time += self.frame[4][0]
+        # The consumer is charged as it goes, as it may return before the generator is finished
+        if self.frame[1] is not None:
+            _charge_parent(self.frame[1], self.resume_time, self.resume_time + exec_time, self.weight)
+
+    def flush(self):
+        if self.start_time is None:
+            return
+        task, parent_frame, depth, path_id, _ = self.frame
+        frame = (task, parent_frame, depth, path_id, [self.child_time])
+        end_time = self.start_time + self.exec_time
+        allocated = tuple(self.allocated) if self.memory else None
+        weight = Profiler._record(self.get_data(), frame, self.parent_task, self.start_time, end_time, self.sampling,
+                                  self.weight, allocated, charge_parent=False)
+        if self.call_key is not _NO_KEY and weight:
+            self.breakdown.add(task, self.call_key, self.exec_time, weight)
+        self._reset()
+
+
+class _Block:
+    """Context manager recording the code of its `with` block as a call of the task `name`, see Profiler.block."""
+
+    def __init__(self, name, profiling_data, timer, enabled):
+        self.name = name
+        self.profiling_data = profiling_data
+        self.timer = timer
+        self.enabled = enabled
+        self.token = None
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        parent_task = _current_task()
+        self.parent_task = parent_task if parent_task is not None else _caller_name(1)
+        self.frame, self.token = _push_task(self.name)
+        self.start_time = self.timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.token is None:
+            return False
+        _pop_task(self.token)
+        end_time = self.timer()
+        self.token = None
+        Profiler._record(self.profiling_data, self.frame, self.parent_task, self.start_time, end_time, None, 1)
+        return False
+
 
 
 
@@ -176,12 +804,43 @@ def merge_profiler_instances(*profilers):
 
         merged_profiler = merge_profiler_instances(profiler1, profiler2)
 
+    If any of the input profilers runs in 'aggregate' mode, the merged profiler does too.
     """
-    merged_profiler = Profiler()
+    mode = 'aggregate' if any(profiler.mode == 'aggregate' for profiler in profilers) else 'events'
+    merged_profiler = Profiler(mode=mode)
     for profiler in profilers:
-        merged_profiler.profiling_data["task"] += profiler.profiling_data["task"]
-        merged_profiler.profiling_data["parent_task"] += profiler.profiling_data["parent_task"]
-        merged_profiler.profiling_data["start_time"] += profiler.profiling_data["start_time"]
-        merged_profiler.profiling_data["end_time"] += profiler.profiling_data["end_time"]
+        data = profiler.profiling_data
+        if isinstance(data, (FileSink, SegmentDirectory)):
+            data = data.load()
+        merged_profiler.profiling_data.extend(data)
+        merged_profiler.breakdowns.extend(profiler.breakdowns)
     return merged_profiler
 
+
+
+def diff_profiler_instances(baseline, candidate, alpha=0.01, min_slowdown=0.05):
+    """Compare a baseline and a candidate Profiler instance, e.g. captured before and after a deploy, task by task.
+
+    Args:
+        baseline: the Profiler instance compared against, in any mode.
+        candidate: the Profiler instance to check for regressions, in any mode.
+        alpha: the false discovery rate below which a change in execution time is significant. Defaults to 0.01.
+        min_slowdown: the relative change in average execution time below which a significant change is not
+            flagged. Defaults to 0.05, i.e. 5%.
+
+    Returns:
+        A ProfileDiff whose `nodes` and `edges` DataFrames hold the baseline, candidate and delta count, total and
+        self time and p50/p90/p99 latency of every task and edge, along with the slowdown (ratio of average execution
+        times), Mann-Whitney p-value and Benjamini-Hochberg adjusted p-value of every task, and whether it is a
+        regression or an improvement. Its `regressions` property lists the regressions, `to_graph()` returns the diff
+        graph and `plot_graph()` draws it with nodes colored by slowdown.
+
+    Example:
+        diff = diff_profiler_instances(profiler_before, profiler_after)
+        print(diff.regressions[['task', 'slowdown', 'adjusted_p_value']])
+        diff.plot_graph("diff.png")
+
+    Both profiles are compared through their aggregates and latency sketches, so that profiles of millions of events
+    are compared in one chunked pass over each.
+    """
+    return ProfileDiff(baseline.profiling_data, candidate.profiling_data, alpha=alpha, min_slowdown=min_slowdown)
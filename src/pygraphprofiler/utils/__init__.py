@@ -1 +1,13 @@
-from . import graph, plot, scc
\ No newline at end of file
+import importlib
+
+from . import aggregate, breakdown, chunked, diff, incremental, recorder, sampling, sink, sketch, spill, stack, timeline, timers
+
+
+# Submodules depending on pandas, networkx, matplotlib or http.server are imported on first access
+_LAZY_SUBMODULES = ("exporter", "graph", "plot", "scc")
+
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
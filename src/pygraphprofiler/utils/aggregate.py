@@ -0,0 +1,268 @@
+import threading
+
+from .recorder import _ThreadShards
+from .sketch import LatencySketch
+
+
+class _AggregateShard:
+    """Statistics recorded by a single thread, guarded by a lock that only readers ever contend on."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # task -> [count, total_exec_time, min_exec_time, max_exec_time, total_self_time]
+        self.nodes = {}
+        # (parent_task, task) -> calls
+        self.edges = {}
+        # path_id -> [parent_path_id, task, depth, count, total_exec_time, total_self_time]
+        self.paths = {}
+        # task -> [total_alloc_bytes, peak_alloc_bytes], for tasks monitored with memory=True
+        self.allocations = {}
+        # task -> LatencySketch, (parent_task, task) -> LatencySketch
+        self.node_sketches = {}
+        self.edge_sketches = {}
+
+
+class _SharedShard:
+    """A single shard written by every thread, for buffers only ever written under a lock of their own owner."""
+
+    def __init__(self, factory):
+        self.shards = [factory()]
+
+    def get(self):
+        return self.shards[0]
+
+    def remove_dead(self):
+        return []
+
+
+class AggregateBuffer:
+    """Running per-task and per-edge statistics of monitored calls, kept without any raw events.
+
+    Exposes the same `append` interface as EventBuffer, so it can be used as a Profiler's profiling_data. Memory grows
+    with the number of distinct tasks, (parent_task, task) pairs and calling contexts, never with the number of calls.
+    Each thread updates its own shard; `nodes`, `edges`, `paths`, `allocations`, `node_sketches` and `edge_sketches`
+    (latency percentile sketches) return the statistics merged across threads. Sampled calls count `weight` times towards counts,
+    totals and percentiles. The shards of threads that have ended are folded into a shared one, so memory does not grow
+    with the number of threads either. With `shared`, every thread writes to a single shard instead, e.g. for a buffer
+    its owner only folds into under its own lock, from whichever thread.
+    """
+
+    def __init__(self, shared=False):
+        # Guards the shared shard of threads that have ended, and the shard list readers merge along with it
+        self._lock = threading.Lock()
+        self._retired = _AggregateShard()
+        if shared:
+            self._shards = _SharedShard(_AggregateShard)
+        else:
+            self._shards = _ThreadShards(_AggregateShard, retire=self._retire_dead)
+
+    def _retire_dead(self):
+        with self._lock:
+            for shard in self._shards.remove_dead():
+                with shard.lock:
+                    _merge_shard(self._retired, shard)
+
+    def _merged(self, attribute, merge):
+        self._retire_dead()
+        merged = {}
+        with self._lock:
+            for shard in [self._retired, *self._shards.shards]:
+                with shard.lock:
+                    merge(merged, getattr(shard, attribute))
+        return merged
+
+    def append(self, task, parent_task, start_time, end_time, extra=None):
+        exec_time = end_time - start_time
+        extra = extra or {}
+        weight = extra.get("weight", 1)
+        self_time = extra.get("self_time", exec_time)
+        shard = self._shards.get()
+        with shard.lock:
+            stats = shard.nodes.get(task)
+            if stats is None:
+                shard.nodes[task] = [weight, weight * exec_time, exec_time, exec_time, weight * self_time]
+            else:
+                stats[0] += weight
+                stats[1] += weight * exec_time
+                if exec_time < stats[2]:
+                    stats[2] = exec_time
+                if exec_time > stats[3]:
+                    stats[3] = exec_time
+                stats[4] += weight * self_time
+            sketch = shard.node_sketches.get(task)
+            if sketch is None:
+                sketch = shard.node_sketches[task] = LatencySketch()
+            sketch.add(exec_time, weight)
+            if "alloc_bytes" in extra:
+                allocation = shard.allocations.get(task)
+                if allocation is None:
+                    shard.allocations[task] = [weight * extra["alloc_bytes"], extra["peak_alloc_bytes"]]
+                else:
+                    allocation[0] += weight * extra["alloc_bytes"]
+                    if extra["peak_alloc_bytes"] > allocation[1]:
+                        allocation[1] = extra["peak_alloc_bytes"]
+            if parent_task:
+                edge = (parent_task, task)
+                shard.edges[edge] = shard.edges.get(edge, 0) + weight
+                sketch = shard.edge_sketches.get(edge)
+                if sketch is None:
+                    sketch = shard.edge_sketches[edge] = LatencySketch()
+                sketch.add(exec_time, weight)
+            path_id = extra.get("path_id")
+            if path_id is not None:
+                path = shard.paths.get(path_id)
+                if path is None:
+                    shard.paths[path_id] = [extra["parent_path_id"], task, extra["depth"],
+                                            weight, weight * exec_time, weight * self_time]
+                else:
+                    path[3] += weight
+                    path[4] += weight * exec_time
+                    path[5] += weight * self_time
+
+    @property
+    def nodes(self):
+        return self._merged('nodes', _merge_nodes)
+
+    @property
+    def edges(self):
+        return self._merged('edges', _merge_edges)
+
+    @property
+    def paths(self):
+        return self._merged('paths', _merge_paths)
+
+    @property
+    def allocations(self):
+        return self._merged('allocations', _merge_allocations)
+
+    @property
+    def node_sketches(self):
+        return self._merged('node_sketches', _merge_sketches)
+
+    @property
+    def edge_sketches(self):
+        return self._merged('edge_sketches', _merge_sketches)
+
+    def extend(self, other):
+        """Fold in another AggregateBuffer, or replay the events of an EventBuffer."""
+        if not isinstance(other, AggregateBuffer):
+            columns = [column for column in other.keys() if column not in ("task", "parent_task", "start_time", "end_time")]
+            for task, parent_task, start_time, end_time, *values in zip(
+                    other["task"], other["parent_task"], other["start_time"], other["end_time"],
+                    *(other[column] for column in columns)):
+                self.append(task, parent_task, start_time, end_time, dict(zip(columns, values)))
+            return
+        nodes, edges, paths, allocations = other.nodes, other.edges, other.paths, other.allocations
+        node_sketches, edge_sketches = other.node_sketches, other.edge_sketches
+        shard = self._shards.get()
+        with shard.lock:
+            _merge_nodes(shard.nodes, nodes)
+            _merge_edges(shard.edges, edges)
+            _merge_paths(shard.paths, paths)
+            _merge_allocations(shard.allocations, allocations)
+            _merge_sketches(shard.node_sketches, node_sketches)
+            _merge_sketches(shard.edge_sketches, edge_sketches)
+
+    def to_dict(self):
+        return {
+            "nodes": [[task, *stats] for task, stats in self.nodes.items()],
+            "edges": [[parent_task, task, calls] for (parent_task, task), calls in self.edges.items()],
+            "paths": [[path_id, *path] for path_id, path in self.paths.items()],
+            "allocations": [[task, *allocation] for task, allocation in self.allocations.items()],
+            "node_sketches": [[task, sketch.to_dict()] for task, sketch in self.node_sketches.items()],
+            "edge_sketches": [[parent_task, task, sketch.to_dict()]
+                              for (parent_task, task), sketch in self.edge_sketches.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        aggregates = cls()
+        shard = aggregates._shards.get()
+        for task, *stats in data["nodes"]:
+            shard.nodes[task] = stats
+        for parent_task, task, calls in data["edges"]:
+            shard.edges[(parent_task, task)] = calls
+        for path_id, *path in data.get("paths", []):
+            shard.paths[path_id] = path
+        for task, *allocation in data.get("allocations", []):
+            shard.allocations[task] = allocation
+        for task, sketch in data.get("node_sketches", []):
+            shard.node_sketches[task] = LatencySketch.from_dict(sketch)
+        for parent_task, task, sketch in data.get("edge_sketches", []):
+            shard.edge_sketches[(parent_task, task)] = LatencySketch.from_dict(sketch)
+        return aggregates
+
+    def to_dataframe(self):
+        import pandas as pd
+
+        task_df = pd.DataFrame(
+            [[task, *stats] for task, stats in self.nodes.items()],
+            columns=["task", "count", "total_exec_time", "min_exec_time", "max_exec_time", "total_self_time"],
+        )
+        task_df.insert(3, "average_exec_time", task_df["total_exec_time"] / task_df["count"])
+        allocations = self.allocations
+        if allocations:
+            task_df["total_alloc_bytes"] = [allocations.get(task, [0, 0])[0] for task in task_df["task"]]
+            task_df["peak_alloc_bytes"] = [allocations.get(task, [0, 0])[1] for task in task_df["task"]]
+        sketches = self.node_sketches
+        percentiles = pd.DataFrame([sketches[task].percentiles() for task in task_df["task"]], index=task_df.index)
+        return pd.concat([task_df, percentiles], axis=1)
+
+    def __len__(self):
+        return sum(stats[0] for stats in self.nodes.values())
+
+
+def _merge_shard(shard, other):
+    _merge_nodes(shard.nodes, other.nodes)
+    _merge_edges(shard.edges, other.edges)
+    _merge_paths(shard.paths, other.paths)
+    _merge_allocations(shard.allocations, other.allocations)
+    _merge_sketches(shard.node_sketches, other.node_sketches)
+    _merge_sketches(shard.edge_sketches, other.edge_sketches)
+
+
+def _merge_nodes(nodes, other_nodes):
+    for task, (count, total, minimum, maximum, self_total) in other_nodes.items():
+        stats = nodes.get(task)
+        if stats is None:
+            nodes[task] = [count, total, minimum, maximum, self_total]
+        else:
+            stats[0] += count
+            stats[1] += total
+            stats[2] = min(stats[2], minimum)
+            stats[3] = max(stats[3], maximum)
+            stats[4] += self_total
+
+
+def _merge_edges(edges, other_edges):
+    for edge, calls in other_edges.items():
+        edges[edge] = edges.get(edge, 0) + calls
+
+
+def _merge_allocations(allocations, other_allocations):
+    for task, (total, peak) in other_allocations.items():
+        allocation = allocations.get(task)
+        if allocation is None:
+            allocations[task] = [total, peak]
+        else:
+            allocation[0] += total
+            allocation[1] = max(allocation[1], peak)
+
+
+def _merge_sketches(sketches, other_sketches):
+    for key, other_sketch in other_sketches.items():
+        sketch = sketches.get(key)
+        if sketch is None:
+            sketch = sketches[key] = LatencySketch()
+        sketch.merge(other_sketch)
+
+
+def _merge_paths(paths, other_paths):
+    for path_id, (parent_path_id, task, depth, count, total, self_total) in other_paths.items():
+        path = paths.get(path_id)
+        if path is None:
+            paths[path_id] = [parent_path_id, task, depth, count, total, self_total]
+        else:
+            path[3] += count
+            path[4] += total
+            path[5] += self_total
@@ -0,0 +1,139 @@
+import numbers
+import threading
+
+from .recorder import _ThreadShards
+from .sketch import LatencySketch
+
+
+# Distinct keys kept per task; calls with any further key are counted under OTHER_KEY
+MAX_KEYS = 64
+OTHER_KEY = 'other'
+
+
+class _BreakdownShard:
+    """Breakdowns recorded by a single thread, guarded by a lock that only readers ever contend on."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # task -> {key: [count, total_exec_time, LatencySketch]}
+        self.tasks = {}
+
+
+class KeyedBreakdown:
+    """Execution time statistics of monitored calls split by a key computed from their arguments, in fixed memory.
+
+    Numeric keys (e.g. an input size) are bucketed to the power of two at or below them, so that a bucket `512` holds
+    the calls with keys from 512 to 1023; any other hashable key (e.g. a tenant id) is its own bucket. At most MAX_KEYS
+    buckets are kept per task, OTHER_KEY included, the calls with any further key being counted under OTHER_KEY.
+    """
+
+    def __init__(self):
+        # Guards the shared shard of threads that have ended, and the shard list readers merge along with it
+        self._lock = threading.Lock()
+        self._retired = _BreakdownShard()
+        self._shards = _ThreadShards(_BreakdownShard, retire=self._retire_dead)
+
+    def _retire_dead(self):
+        with self._lock:
+            for shard in self._shards.remove_dead():
+                with shard.lock:
+                    _merge_tasks(self._retired.tasks, shard.tasks)
+                for task, buckets in self._retired.tasks.items():
+                    self._retired.tasks[task] = _cap(buckets)
+
+    def add(self, task, key, exec_time, weight=1):
+        shard = self._shards.get()
+        key = _bucket(key)
+        with shard.lock:
+            buckets = shard.tasks.get(task)
+            if buckets is None:
+                buckets = shard.tasks[task] = {}
+            stats = buckets.get(key)
+            if stats is None:
+                if len(buckets) >= MAX_KEYS - 1 and key != OTHER_KEY:
+                    key = OTHER_KEY
+                    stats = buckets.get(key)
+                if stats is None:
+                    stats = buckets[key] = [0, 0, LatencySketch()]
+            stats[0] += weight
+            stats[1] += weight * exec_time
+            stats[2].add(exec_time, weight)
+
+    def extend(self, other):
+        """Add the breakdowns of another KeyedBreakdown to this one."""
+        tasks = other.tasks
+        shard = self._shards.get()
+        with shard.lock:
+            _merge_tasks(shard.tasks, tasks)
+
+    @property
+    def tasks(self):
+        """Return {task: {key: [count, total_exec_time, LatencySketch]}} merged across threads."""
+        self._retire_dead()
+        tasks = {}
+        with self._lock:
+            for shard in [self._retired, *self._shards.shards]:
+                with shard.lock:
+                    _merge_tasks(tasks, shard.tasks)
+        return {task: _cap(buckets) for task, buckets in tasks.items()}
+
+    def to_dataframe(self):
+        import pandas as pd
+
+        rows = [
+            [task, key, count, total, total / count, *sketch.percentiles().values()]
+            for task, buckets in self.tasks.items()
+            for key, (count, total, sketch) in sorted(buckets.items(), key=lambda item: _sort_key(item[0]))
+        ]
+        return pd.DataFrame(rows, columns=["task", "key", "count", "total_exec_time", "average_exec_time",
+                                           "p50_exec_time", "p90_exec_time", "p99_exec_time"])
+
+    def __len__(self):
+        return sum(len(buckets) for buckets in self.tasks.values())
+
+
+def _merge_tasks(tasks, other_tasks):
+    for task, buckets in other_tasks.items():
+        merged = tasks.setdefault(task, {})
+        for key, (count, total, sketch) in buckets.items():
+            stats = merged.get(key)
+            if stats is None:
+                stats = merged[key] = [0, 0, LatencySketch()]
+            stats[0] += count
+            stats[1] += total
+            stats[2].merge(sketch)
+
+
+def _cap(buckets):
+    # Threads may each have kept different keys: keep the most called ones overall
+    if len(buckets) <= MAX_KEYS:
+        return buckets
+    keys = sorted((key for key in buckets if key != OTHER_KEY), key=lambda key: buckets[key][0], reverse=True)
+    kept = keys[:MAX_KEYS - 1]
+    other = [0, 0, LatencySketch()]
+    for key in set(buckets) - set(kept):
+        count, total, sketch = buckets[key]
+        other[0] += count
+        other[1] += total
+        other[2].merge(sketch)
+    capped = {key: buckets[key] for key in kept}
+    capped[OTHER_KEY] = other
+    return capped
+
+
+def _bucket(key):
+    """Return the bucket of a key: the signed power of two at or below a number's magnitude, 0 below 1."""
+    if isinstance(key, bool) or not isinstance(key, numbers.Real) or key != key or key in (float('inf'), float('-inf')):
+        return key
+    magnitude = int(abs(key))
+    if magnitude == 0:
+        return 0
+    bucket = 1 << (magnitude.bit_length() - 1)
+    return bucket if key > 0 else -bucket
+
+
+def _sort_key(key):
+    # Numbers in increasing order, then any other key in order of its string
+    if isinstance(key, numbers.Real) and not isinstance(key, bool):
+        return (0, key, "")
+    return (1, 0, str(key))
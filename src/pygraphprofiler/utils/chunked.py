@@ -0,0 +1,234 @@
+import glob
+import os
+import tempfile
+import zlib
+from collections import deque
+
+from .fileio import CHUNK, MAGIC, PARQUET_MAGIC, _decode_names
+from .recorder import COLUMNS
+from .sink import RECORD, RECORD_DTYPE, _read_names
+from .spill import _segment_paths
+
+
+# Number of events analyzed at once, about 64 MB of columns. Larger chunks amortize the per-task and per-edge work
+# done for every chunk, which dominates for profiles with many distinct edges.
+ANALYSIS_CHUNK_SIZE = 1 << 20
+
+# Bytes read and decompressed at once when spilling a binary events chunk to disk
+SPILL_SIZE = 1 << 20
+
+
+def graph_from_files(paths, chunk_size=ANALYSIS_CHUNK_SIZE, processes=None):
+    """Build the call graph of every event in event files and sink directories, reading at most chunk_size events at once.
+
+    `paths` are files written by `to_file` or `stream_to_file`, in either format, and directories written by a FileSink
+    or a SpillingBuffer, e.g. one per host. They are split into jobs of at most chunk_size events each (Parquet row groups and slices of
+    binary events chunks or sink records files), each folded into per-task and per-edge sums and latency sketches.
+    Binary events chunks larger than chunk_size are first decompressed to a temporary file, piecewise.
+    Memory is bounded by one chunk plus the graph itself, whatever the number of events. With `processes`, jobs run in a
+    pool of that many worker processes, each reading its own chunks from disk, at most two per process being queued.
+
+    The graph has the same node and edge attributes as the one `to_graph` builds from the same events held in memory.
+    """
+    from .graph import _aggregates_graph
+
+    return _aggregates_graph(aggregate_files(paths, chunk_size=chunk_size, processes=processes))
+
+
+def aggregate_files(paths, chunk_size=ANALYSIS_CHUNK_SIZE, processes=None):
+    """Return the aggregates (nodes, edges, node_sketches, edge_sketches) of event files and sink directories, as
+    folded by graph._fold_aggregates, reading them as graph_from_files does."""
+    from .graph import _merge_aggregates
+
+    aggregates = ({}, {}, {}, {})
+    with tempfile.TemporaryDirectory(prefix="pygraphprofiler-") as spill_directory:
+        # Jobs are generated as they run, so that their number does not weigh on memory either
+        jobs = (job for path in _as_paths(paths) for job in _jobs(path, chunk_size, spill_directory))
+        results = map(_run_job, jobs) if processes is None else _run_jobs(jobs, processes)
+        for job_aggregates in results:
+            _merge_aggregates(aggregates, job_aggregates)
+    return aggregates
+
+
+def _run_jobs(jobs, processes):
+    """Yield the aggregates of every job, in order, from a pool of worker processes never queued more than two jobs
+    per process."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        running = deque()
+        for job in jobs:
+            running.append(executor.submit(_run_job, job))
+            if len(running) >= 2 * processes:
+                yield running.popleft().result()
+        while running:
+            yield running.popleft().result()
+
+
+def _as_paths(paths):
+    if isinstance(paths, (str, os.PathLike)):
+        return [paths]
+    return list(paths)
+
+
+def _jobs(path, chunk_size, spill_directory):
+    """Split a file, sink or segment directory into picklable job tuples, read back by _job_chunks in a worker."""
+    if os.path.isdir(path):
+        for events_path in sorted(glob.glob(os.path.join(path, "events-*.bin"))):
+            pid = int(os.path.basename(events_path)[len("events-"):-len(".bin")])
+            # Ignore a trailing partial record from a process that is still writing
+            n_records = os.path.getsize(events_path) // RECORD.size
+            for start in range(0, n_records, chunk_size):
+                yield ('sink', path, pid, start, min(start + chunk_size, n_records))
+        for _, segment_path in _segment_paths(path):
+            yield from _jobs(segment_path, chunk_size, spill_directory)
+        return
+    with open(path, 'rb') as file:
+        magic = file.read(len(MAGIC))
+        if magic.startswith(PARQUET_MAGIC):
+            import pyarrow.parquet as pq
+
+            for row_group in range(pq.ParquetFile(path).num_row_groups):
+                yield ('parquet', path, row_group, chunk_size)
+            return
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a pygraphprofiler event file or sink directory")
+        # Events chunks small enough are left to the job reading them, larger ones spilled to disk and sliced. Every job
+        # refers to the same name table, only ever appended to: ids of earlier chunks stay valid as it grows, and names
+        # without events are never folded into nodes.
+        names, specs = [], [(column, 'q') for column in COLUMNS]
+        file_size = os.fstat(file.fileno()).st_size
+        offset = len(MAGIC)
+        while True:
+            header = file.read(CHUNK.size)
+            if len(header) < CHUNK.size:
+                return
+            tag, count, size = CHUNK.unpack(header)
+            offset += CHUNK.size
+            if offset + size > file_size:
+                # Ignore a trailing chunk still being written
+                return
+            if tag == b'NAME':
+                names += _decode_names(zlib.decompress(file.read(size)))
+            elif tag == b'COLS':
+                specs = [spec.rsplit(':', 1) for spec in zlib.decompress(file.read(size)).decode('utf-8').split('\n')]
+            elif tag == b'EVTS':
+                if count <= chunk_size:
+                    yield ('binary', path, offset, size, count, specs, names)
+                    file.seek(size, os.SEEK_CUR)
+                else:
+                    spill_path = os.path.join(spill_directory, f"events-{len(os.listdir(spill_directory))}.bin")
+                    _spill(file, size, spill_path)
+                    for start in range(0, count, chunk_size):
+                        yield ('columns', spill_path, count, specs, names, start, min(start + chunk_size, count))
+            else:
+                raise ValueError(f"Unknown chunk {tag!r} in {path}")
+            offset += size
+
+
+def _spill(file, size, spill_path):
+    """Decompress the next `size` bytes of a file to spill_path, never holding more than a few SPILL_SIZE at once."""
+    decompressor = zlib.decompressobj()
+    remaining = size
+    with open(spill_path, 'wb') as spill:
+        while remaining or decompressor.unconsumed_tail:
+            data = decompressor.unconsumed_tail
+            if not data:
+                data = file.read(min(remaining, SPILL_SIZE))
+                remaining -= len(data)
+            spill.write(decompressor.decompress(data, SPILL_SIZE))
+        spill.write(decompressor.flush())
+
+
+def _run_job(job):
+    """Return the per-task sums, per-edge call counts and node and edge LatencySketches of the events of a job."""
+    aggregates = ({}, {}, {}, {})
+    for names, columns in _job_chunks(job):
+        _fold_chunk(names, columns, aggregates)
+    return aggregates
+
+
+def _fold_chunk(names, columns, aggregates):
+    """Fold a (names, columns) chunk of events into aggregates, updated in place."""
+    import pandas as pd
+    from .graph import _fold_aggregates
+
+    categories = pd.Index(names, dtype=object)
+    task_df = pd.DataFrame({
+        "task": pd.Categorical.from_codes(columns.pop('task'), categories=categories),
+        "parent_task": pd.Categorical.from_codes(columns.pop('parent_task'), categories=categories),
+        **columns,
+    })
+    return _fold_aggregates(task_df, aggregates)
+
+
+def _job_chunks(job):
+    """Yield (names, columns) for the chunks of a job, columns being numpy arrays as in timeline._event_chunks."""
+    import numpy as np
+
+    kind = job[0]
+    if kind == 'sink':
+        _, directory, pid, start, stop = job
+        names = _read_names(directory, pid)
+        records = np.memmap(os.path.join(directory, f"events-{pid}.bin"), dtype=RECORD_DTYPE, mode='r',
+                            shape=(stop,))[start:stop]
+        columns = {column: np.ascontiguousarray(records[column]).astype(np.float64 if column == 'weight' else np.int64)
+                   for column, _ in RECORD_DTYPE}
+        del records
+        # As when loading a sink directory, unsampled events have no weight column
+        if (columns['weight'] == 1).all():
+            del columns['weight']
+        yield names, columns
+    elif kind == 'parquet':
+        yield from _parquet_chunks(*job[1:])
+    elif kind == 'binary':
+        yield from _binary_chunks(*job[1:])
+    else:
+        yield from _spilled_chunks(*job[1:])
+
+
+def _parquet_chunks(path, row_group, chunk_size):
+    import numpy as np
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, row_groups=[row_group]):
+        if batch.num_rows == 0:
+            continue
+        name_ids, columns = {}, {}
+        for column in batch.schema.names:
+            values = batch.column(column)
+            if column in ("task", "parent_task"):
+                # Both name columns index a single name list; the extra trailing entry maps null indices to -1
+                id_map = np.array([name_ids.setdefault(name, len(name_ids)) for name in values.dictionary.to_pylist()]
+                                  + [-1], dtype=np.int64)
+                columns[column] = id_map[pc.fill_null(values.indices, -1).to_numpy()]
+            else:
+                columns[column] = values.to_numpy()
+        yield list(name_ids), columns
+
+
+def _binary_chunks(path, offset, size, count, specs, names):
+    import numpy as np
+
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        payload = zlib.decompress(file.read(size))
+    # Columns are little-endian 8-byte values, one after the other
+    yield names, {column: np.frombuffer(payload, dtype='<f8' if typecode == 'd' else '<i8', count=count,
+                                        offset=i * 8 * count).astype(np.float64 if typecode == 'd' else np.int64)
+                  for i, (column, typecode) in enumerate(specs)}
+
+
+def _spilled_chunks(path, count, specs, names, start, stop):
+    import numpy as np
+
+    # Read rows start to stop of every column of an events chunk decompressed to disk by _spill
+    columns = {}
+    with open(path, 'rb') as spill:
+        for i, (column, typecode) in enumerate(specs):
+            spill.seek((i * count + start) * 8)
+            values = np.fromfile(spill, dtype='<f8' if typecode == 'd' else '<i8', count=stop - start)
+            columns[column] = values.astype(np.float64 if typecode == 'd' else np.int64)
+    yield names, columns
+
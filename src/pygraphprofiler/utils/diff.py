@@ -0,0 +1,239 @@
+import math
+
+from .aggregate import AggregateBuffer
+from .chunked import ANALYSIS_CHUNK_SIZE, _fold_chunk, aggregate_files
+from .recorder import _as_buffer
+from .sink import FileSink
+from .sketch import PERCENTILES
+from .spill import SegmentDirectory
+from .timeline import _event_chunks
+
+
+# Node statistics compared between profiles, when either profile has them
+NODE_STATISTICS = ('count', 'total_exec_time', 'total_self_time', 'average_exec_time',
+                   *(f"p{p}_exec_time" for p in PERCENTILES), 'total_alloc_bytes', 'peak_alloc_bytes')
+EDGE_STATISTICS = ('calls', *(f"p{p}_exec_time" for p in PERCENTILES))
+
+
+class ProfileDiff:
+    """Per-task and per-edge comparison of a baseline and a candidate profile, e.g. captured before and after a deploy.
+
+    Both profiles are reduced to their node and edge aggregates and latency sketches, so comparing profiles of millions
+    of events costs one pass over each plus time proportional to the number of distinct tasks and edges.
+
+    Each task common to both profiles is tested for a change in execution time with a Mann-Whitney U test on the
+    buckets of its two latency sketches, calls in the same bucket (within 1%) counting as ties, and each sampled call
+    as a single observation however many calls its weight stands for. P-values are adjusted for the number of tasks
+    tested (Benjamini-Hochberg). As any slowdown becomes significant with enough calls, a task is only flagged as a
+    regression when its average execution time also grew by at least `min_slowdown`, and as an improvement when it
+    shrank by as much.
+    """
+
+    def __init__(self, baseline, candidate, alpha=0.01, min_slowdown=0.05):
+        self.alpha = alpha
+        self.min_slowdown = min_slowdown
+        self._baseline = _profile_aggregates(baseline)
+        self._candidate = _profile_aggregates(candidate)
+        self.nodes = self._node_diff()
+        self.edges = self._edge_diff()
+
+    @property
+    def regressions(self):
+        """Return the rows of `nodes` flagged as regressions, the largest slowdown first."""
+        return self.nodes[self.nodes['regression']].sort_values('slowdown', ascending=False)
+
+    @property
+    def improvements(self):
+        """Return the rows of `nodes` flagged as improvements, the largest speedup first."""
+        return self.nodes[self.nodes['improvement']].sort_values('slowdown')
+
+    def _node_diff(self):
+        import pandas as pd
+
+        baseline_nodes, _, baseline_sketches, _ = self._baseline
+        candidate_nodes, _, candidate_sketches, _ = self._candidate
+        statistics = [statistic for statistic in NODE_STATISTICS
+                      if any(statistic in stats for nodes in (baseline_nodes, candidate_nodes)
+                             for stats in nodes.values())]
+        rows = []
+        for task in _union(baseline_nodes, candidate_nodes):
+            baseline, candidate = baseline_nodes.get(task), candidate_nodes.get(task)
+            row = {'task': task, 'status': _status(baseline, candidate)}
+            row.update(_compare(baseline, candidate, statistics))
+            if baseline is not None and candidate is not None:
+                row['slowdown'] = _ratio(candidate['average_exec_time'], baseline['average_exec_time'])
+                p_value, superiority = _mann_whitney(baseline_sketches[task], candidate_sketches[task])
+            else:
+                row['slowdown'], p_value, superiority = math.nan, math.nan, math.nan
+            row['p_value'], row['superiority'] = p_value, superiority
+            rows.append(row)
+        columns = ['task', 'status', *(f"{side}_{statistic}" for statistic in statistics
+                                       for side in ('baseline', 'candidate', 'delta')),
+                   'slowdown', 'p_value', 'superiority']
+        node_df = pd.DataFrame(rows, columns=columns)
+        node_df['adjusted_p_value'] = _benjamini_hochberg(node_df['p_value'].tolist())
+        significant = node_df['adjusted_p_value'] < self.alpha
+        node_df['regression'] = significant & (node_df['slowdown'] >= 1 + self.min_slowdown)
+        node_df['improvement'] = significant & (node_df['slowdown'] <= 1 / (1 + self.min_slowdown))
+        return node_df
+
+    def _edge_diff(self):
+        import pandas as pd
+
+        _, baseline_edges, _, baseline_sketches = self._baseline
+        _, candidate_edges, _, candidate_sketches = self._candidate
+        rows = []
+        for edge in _union(baseline_edges, candidate_edges):
+            baseline, candidate = (
+                None if edge not in edges else {'calls': edges[edge], **sketches[edge].percentiles()}
+                for edges, sketches in ((baseline_edges, baseline_sketches), (candidate_edges, candidate_sketches))
+            )
+            rows.append({'parent_task': edge[0], 'task': edge[1], 'status': _status(baseline, candidate),
+                         **_compare(baseline, candidate, EDGE_STATISTICS)})
+        columns = ['parent_task', 'task', 'status', *(f"{side}_{statistic}" for statistic in EDGE_STATISTICS
+                                                      for side in ('baseline', 'candidate', 'delta'))]
+        return pd.DataFrame(rows, columns=columns)
+
+    def to_graph(self):
+        """Return the union of both call graphs, with the comparison of each node and edge as attributes.
+
+        Nodes and edges carry the statistics of the candidate profile under the names `to_graph` uses (of the baseline
+        for those only in the baseline), along with their 'baseline_*' and 'delta_*' counterparts and 'status'
+        ('added', 'removed' or 'common'); nodes also carry 'slowdown', 'p_value', 'adjusted_p_value', 'superiority',
+        'regression' and 'improvement'. The graph attribute 'diff' tells plot_graph to color nodes by slowdown.
+        """
+        import networkx as nx
+
+        graph = nx.DiGraph(diff=True)
+        for frame, add in ((self.nodes, graph.add_node), (self.edges, graph.add_edge)):
+            keys = ['task'] if frame is self.nodes else ['parent_task', 'task']
+            for row in frame.to_dict('records'):
+                side = 'baseline' if row['status'] == 'removed' else 'candidate'
+                attributes = {}
+                for column, value in row.items():
+                    if column in keys:
+                        continue
+                    if column.startswith(f"{side}_"):
+                        attributes[column[len(side) + 1:]] = value
+                    if not column.startswith('candidate_'):
+                        attributes[column] = value
+                attributes = {name: value for name, value in attributes.items()
+                              if not (isinstance(value, float) and math.isnan(value))}
+                add(*(row[key] for key in keys), **attributes)
+        return graph
+
+    def plot_graph(self, filename, weight_node_on='total_exec_time', top_k=None, min_time=None, layout=None,
+                   format=None):
+        """Plot the diff graph as Profiler.plot_graph does, nodes colored from green (faster) to red (slower) by
+        slowdown and labeled with it; nodes only in one profile are grey."""
+        from .plot import _plot_graph_to_file
+
+        _plot_graph_to_file(self.to_graph(), filename, weight_node_on, False, top_k=top_k, min_time=min_time,
+                            layout=layout, format=format)
+
+
+def _profile_aggregates(data):
+    """Return the aggregates (nodes, edges, node_sketches, edge_sketches) of profiling data, as graph._fold_aggregates.
+
+    In-memory events are folded ANALYSIS_CHUNK_SIZE at a time and sink and segment directories read from disk, chunk by chunk.
+    """
+    if isinstance(data, AggregateBuffer):
+        nodes, allocations = {}, data.allocations
+        for task, (count, total, _, _, self_total) in data.nodes.items():
+            nodes[task] = {'total_exec_time': total, 'count': count, 'total_self_time': self_total}
+            if task in allocations:
+                nodes[task]['total_alloc_bytes'], nodes[task]['peak_alloc_bytes'] = allocations[task]
+        aggregates = (nodes, data.edges, data.node_sketches, data.edge_sketches)
+    elif isinstance(data, (FileSink, SegmentDirectory)):
+        data.flush()
+        aggregates = aggregate_files(data.directory)
+    else:
+        aggregates = ({}, {}, {}, {})
+        for names, columns in _event_chunks(_as_buffer(data), ANALYSIS_CHUNK_SIZE):
+            _fold_chunk(names, columns, aggregates)
+    nodes, edges, node_sketches, edge_sketches = aggregates
+    for task, stats in nodes.items():
+        stats['average_exec_time'] = stats['total_exec_time'] / stats['count']
+        stats.update(node_sketches[task].percentiles())
+    return aggregates
+
+
+def _union(baseline, candidate):
+    return list(baseline) + [key for key in candidate if key not in baseline]
+
+
+def _status(baseline, candidate):
+    if baseline is None:
+        return 'added'
+    return 'removed' if candidate is None else 'common'
+
+
+def _compare(baseline, candidate, statistics):
+    row = {}
+    for statistic in statistics:
+        baseline_value = math.nan if baseline is None else baseline.get(statistic, math.nan)
+        candidate_value = math.nan if candidate is None else candidate.get(statistic, math.nan)
+        row[f"baseline_{statistic}"] = baseline_value
+        row[f"candidate_{statistic}"] = candidate_value
+        row[f"delta_{statistic}"] = _difference(candidate_value, baseline_value)
+    return row
+
+
+def _difference(value, other):
+    # Percentiles of tasks without calls are None
+    if value is None or other is None:
+        return math.nan
+    return value - other
+
+
+def _ratio(value, other):
+    if other == 0:
+        return math.inf if value > 0 else math.nan
+    return value / other
+
+
+def _mann_whitney(baseline, candidate):
+    """Return the two-sided p-value of a Mann-Whitney U test between the calls of two LatencySketches, and the
+    probability that a candidate call takes longer than a baseline call (ties counting half).
+
+    Each bucket is a group of tied values; the U statistic, its tie-corrected variance and thus the normal approximation
+    of its distribution are computed from the bucket counts alone, whatever the number of calls. Sampled calls weigh
+    more than one call in the counts but are a single observation each: the counts of each sketch are scaled down to
+    its number of recorded calls, which sets the sample sizes and the variance.
+    """
+    n_baseline, n_candidate = baseline.samples, candidate.samples
+    if n_baseline <= 0 or n_candidate <= 0 or baseline.count <= 0 or candidate.count <= 0:
+        return math.nan, math.nan
+    baseline_scale, candidate_scale = n_baseline / baseline.count, n_candidate / candidate.count
+    indices = sorted(set(baseline.buckets) | set(candidate.buckets))
+    groups = [(baseline.zero_count * baseline_scale, candidate.zero_count * candidate_scale)]
+    groups += [(baseline.buckets.get(index, 0) * baseline_scale, candidate.buckets.get(index, 0) * candidate_scale)
+               for index in indices]
+    u_statistic = 0
+    tie_sum = 0
+    below = 0
+    for baseline_count, candidate_count in groups:
+        u_statistic += candidate_count * (below + baseline_count / 2)
+        below += baseline_count
+        ties = baseline_count + candidate_count
+        tie_sum += ties ** 3 - ties
+    superiority = u_statistic / (n_baseline * n_candidate)
+    n = n_baseline + n_candidate
+    variance = n_baseline * n_candidate / 12 * ((n + 1) - tie_sum / (n * (n - 1))) if n > 1 else 0
+    if variance <= 0:
+        # Every call in the same bucket: nothing tells both profiles apart
+        return 1.0, superiority
+    z = abs(u_statistic - n_baseline * n_candidate / 2) / math.sqrt(variance)
+    return min(1.0, math.erfc(z / math.sqrt(2))), superiority
+
+
+def _benjamini_hochberg(p_values):
+    """Return the Benjamini-Hochberg adjusted p-values, NaN p-values (untested tasks) being left out of the count."""
+    tested = sorted((p, i) for i, p in enumerate(p_values) if not math.isnan(p))
+    adjusted = [math.nan] * len(p_values)
+    smallest = 1.0
+    for rank in range(len(tested), 0, -1):
+        p, i = tested[rank - 1]
+        smallest = min(smallest, p * len(tested) / rank)
+        adjusted[i] = smallest
+    return adjusted
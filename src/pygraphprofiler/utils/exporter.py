@@ -0,0 +1,182 @@
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .aggregate import AggregateBuffer
+from .sink import FileSink
+from .spill import SegmentDirectory
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+HISTOGRAM_BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0)
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+class MetricsExporter:
+    """Serve the live statistics of profiling data over HTTP from a background thread.
+
+    `GET /metrics` returns per-task call and time counters, per-edge call counters and per-task latency histograms in
+    OpenMetrics text format, and `GET /graph` a JSON snapshot of the call graph. Both are derived from aggregates only:
+    in 'events' mode the exporter folds the events recorded since the previous scrape into its own AggregateBuffer,
+    holding the buffer's lock just long enough to copy them, so that scrapes never stall monitored code for long.
+    Events written to a FileSink or spilled to segments are read back in full on every scrape.
+
+    `get_data` is called on every scrape and returns the current profiling data, which may be replaced over time.
+    """
+
+    def __init__(self, get_data, host='127.0.0.1', port=0):
+        self._get_data = get_data
+        self._lock = threading.Lock()
+        self._buffer = None
+        self._cursor = 0
+        self._aggregates = AggregateBuffer(shared=True)
+        self.version = 0
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="pygraphprofiler-exporter", daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def close(self):
+        """Stop serving and release the port."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def aggregates(self):
+        """Return an AggregateBuffer with the statistics of every call recorded so far."""
+        data = self._get_data()
+        if isinstance(data, AggregateBuffer):
+            return data
+        if isinstance(data, (FileSink, SegmentDirectory)):
+            aggregates = AggregateBuffer(shared=True)
+            aggregates.extend(data.load())
+            return aggregates
+        with self._lock:
+            if data is not self._buffer or len(data) < self._cursor:
+                self._buffer, self._cursor, self._aggregates = data, 0, AggregateBuffer(shared=True)
+            events = data.slice(self._cursor)
+            if len(events):
+                self._aggregates.extend(events)
+                self._cursor += len(events)
+                self.version += 1
+            return self._aggregates
+
+    def metrics(self):
+        """Return the statistics of every task and edge in OpenMetrics text format."""
+        aggregates = self.aggregates()
+        nodes, edges, sketches = aggregates.nodes, aggregates.edges, aggregates.node_sketches
+        lines = [
+            "# TYPE pygraphprofiler_calls counter",
+            "# HELP pygraphprofiler_calls Monitored calls of each task.",
+        ]
+        lines += [f"pygraphprofiler_calls_total{{task={_label(task)}}} {_number(stats[0])}"
+                  for task, stats in nodes.items()]
+        lines += [
+            "# TYPE pygraphprofiler_exec_time_seconds counter",
+            "# HELP pygraphprofiler_exec_time_seconds Total execution time of each task.",
+        ]
+        lines += [f"pygraphprofiler_exec_time_seconds_total{{task={_label(task)}}} {_number(stats[1] / 1e9)}"
+                  for task, stats in nodes.items()]
+        lines += [
+            "# TYPE pygraphprofiler_self_time_seconds counter",
+            "# HELP pygraphprofiler_self_time_seconds Total execution time of each task outside its monitored callees.",
+        ]
+        lines += [f"pygraphprofiler_self_time_seconds_total{{task={_label(task)}}} {_number(stats[4] / 1e9)}"
+                  for task, stats in nodes.items()]
+        lines += [
+            "# TYPE pygraphprofiler_edge_calls counter",
+            "# HELP pygraphprofiler_edge_calls Calls of each task by each parent task.",
+        ]
+        lines += [f"pygraphprofiler_edge_calls_total{{parent_task={_label(parent_task)},task={_label(task)}}} "
+                  f"{_number(calls)}" for (parent_task, task), calls in edges.items()]
+        lines += [
+            "# TYPE pygraphprofiler_latency_seconds histogram",
+            "# HELP pygraphprofiler_latency_seconds Execution time of each task.",
+        ]
+        for task, stats in nodes.items():
+            sketch = sketches[task]
+            label = _label(task)
+            counts = sketch.cumulative_counts([bound * 1e9 for bound in HISTOGRAM_BUCKETS])
+            lines += [f"pygraphprofiler_latency_seconds_bucket{{task={label},le=\"{bound}\"}} {_number(count)}"
+                      for bound, count in zip(HISTOGRAM_BUCKETS, counts)]
+            lines += [
+                f"pygraphprofiler_latency_seconds_bucket{{task={label},le=\"+Inf\"}} {_number(sketch.count)}",
+                f"pygraphprofiler_latency_seconds_count{{task={label}}} {_number(sketch.count)}",
+                f"pygraphprofiler_latency_seconds_sum{{task={label}}} {_number(stats[1] / 1e9)}",
+            ]
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def graph(self):
+        """Return a JSON-serializable snapshot of the call graph, with the node and edge attributes of to_graph."""
+        aggregates = self.aggregates()
+        node_sketches, edge_sketches = aggregates.node_sketches, aggregates.edge_sketches
+        return {
+            "version": self.version,
+            "nodes": [
+                {
+                    "task": task,
+                    "count": count,
+                    "total_exec_time": total,
+                    "average_exec_time": total / count,
+                    "min_exec_time": minimum,
+                    "max_exec_time": maximum,
+                    "total_self_time": self_total,
+                    **node_sketches[task].percentiles(),
+                }
+                for task, (count, total, minimum, maximum, self_total) in aggregates.nodes.items()
+            ],
+            "edges": [
+                {"parent_task": parent_task, "task": task, "calls": calls, **edge_sketches[parent_task, task].percentiles()}
+                for (parent_task, task), calls in aggregates.edges.items()
+            ],
+        }
+
+
+def _handler(exporter):
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path == '/metrics':
+                self._send(exporter.metrics().encode('utf-8'), OPENMETRICS_CONTENT_TYPE)
+            elif path == '/graph':
+                self._send(json.dumps(exporter.graph()).encode('utf-8'), 'application/json')
+            else:
+                self.send_error(404)
+
+        def _send(self, body, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def _label(value):
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'"{escaped}"'
+
+
+def _number(value):
+    if isinstance(value, float) and not math.isfinite(value):
+        return "NaN" if math.isnan(value) else ("+Inf" if value > 0 else "-Inf")
+    return repr(value) if isinstance(value, float) else str(value)
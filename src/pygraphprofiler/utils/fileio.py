@@ -0,0 +1,292 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+from .recorder import COLUMNS, EXTRA_DEFAULTS, EventBuffer
+
+
+# Binary format: MAGIC followed by chunks, each a CHUNK header (tag, count, payload size) and a zlib payload.
+#   b'NAME': `count` new task names, one utf-8 JSON string per line as names may hold newlines, extending the file's
+#            name table
+#   b'COLS': `count` `name:typecode` column specs, newline separated, describing the following event chunks
+#   b'EVTS': `count` events, as the 8-byte little-endian columns ('q' for int64, 'd' for float64) one after the
+#            other; name ids index the name table
+MAGIC = b'PGPROF1\n'
+PARQUET_MAGIC = b'PAR1'
+CHUNK = struct.Struct('<4sII')
+
+FORMATS = ('parquet', 'binary')
+
+
+def _default_format():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return 'binary'
+    return 'parquet'
+
+
+def _le_bytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _encode_names(names):
+    return ''.join(f"{json.dumps(name)}\n" for name in names).encode('utf-8')
+
+
+def _decode_names(payload):
+    return [json.loads(line) for line in payload.decode('utf-8').split('\n')[:-1]]
+
+
+class EventFileWriter:
+    """Append the events of an EventBuffer to a file in chunks, each `write()` adding the events recorded since the
+    previous one.
+
+    Writes Parquet row groups when format is 'parquet' (requires pyarrow), or zlib-compressed chunks of the stdlib
+    binary format described by MAGIC and CHUNK when format is 'binary'.
+    """
+
+    def __init__(self, buffer: EventBuffer, path, format=None, compression_level=1):
+        self.format = format or _default_format()
+        if self.format not in FORMATS:
+            raise ValueError(f"Unknown format {format!r}, available options: {', '.join(FORMATS)}")
+        self.buffer = buffer
+        self.path = path
+        self.compression_level = compression_level
+        self._n_events = 0
+        self._n_names = 0
+        self._columns = None
+        self._file = None
+        self._parquet_writer = None
+        # The file being written: a copy next to `path` once a new column made the row groups written so far be copied
+        self._parquet_path = path
+        if self.format == 'binary':
+            self._file = open(path, 'wb')
+            self._file.write(MAGIC)
+
+    def write(self):
+        """Write the events recorded since the previous call as one chunk and return how many were written."""
+        buffer = self.buffer
+        buffer.flush()
+        with buffer._lock:
+            start, stop = self._n_events, len(buffer.task_ids)
+            if start == stop:
+                return 0
+            columns = buffer.keys()
+            if self.format == 'parquet':
+                self._write_parquet(start, stop, columns)
+            else:
+                self._write_binary(start, stop, columns)
+            self._n_events = stop
+            self._n_names = len(buffer.names)
+        return stop - start
+
+    def _write_binary(self, start, stop, columns):
+        buffer = self.buffer
+        if self._n_names < len(buffer.names):
+            self._write_chunk(b'NAME', len(buffer.names) - self._n_names, _encode_names(buffer.names[self._n_names:]))
+        if columns != self._columns:
+            specs = [f"{column}:{_column_values(buffer, column).typecode}" for column in columns]
+            self._write_chunk(b'COLS', len(columns), '\n'.join(specs).encode('utf-8'))
+            self._columns = columns
+        payload = b''.join(_le_bytes(_column_values(buffer, column)[start:stop]) for column in columns)
+        self._write_chunk(b'EVTS', stop - start, payload)
+
+    def _write_chunk(self, tag, count, payload):
+        payload = zlib.compress(payload, self.compression_level)
+        self._file.write(CHUNK.pack(tag, count, len(payload)))
+        self._file.write(payload)
+
+    def _write_parquet(self, start, stop, columns):
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        buffer = self.buffer
+        names = pa.array(buffer.names, type=pa.string())
+        arrays = []
+        for column in columns:
+            # Copy out of the array('q') so that the buffer is free to grow again after this write
+            column_values = _column_values(buffer, column)
+            values = pa.array(np.frombuffer(column_values, dtype=column_values.typecode)[start:stop].copy())
+            if column in ("task", "parent_task"):
+                # -1 marks a missing name: store it as a null dictionary index
+                indices = pc.if_else(pc.less(values, 0), pa.scalar(None, pa.int64()), values)
+                values = pa.DictionaryArray.from_arrays(indices, names)
+            arrays.append(values)
+        table = pa.Table.from_arrays(arrays, names=list(columns))
+        if self._parquet_writer is None:
+            self._columns = columns
+            self._parquet_path = self.path
+            self._parquet_writer = pq.ParquetWriter(self.path, table.schema, compression='zstd')
+        elif columns != self._columns:
+            schema = self._parquet_writer.schema
+            new_fields = [field for field in table.schema if field.name not in self._columns]
+            if new_fields:
+                # An extra column first recorded after a previous write (e.g. the weight of a sampled function called
+                # later): the schema of a Parquet file is fixed, so the row groups written so far are copied to a new
+                # file with that column set to its default
+                for field in new_fields:
+                    schema = schema.append(field)
+                self._rewrite_parquet(schema)
+            table = _with_defaults(table, schema)
+        self._parquet_writer.write_table(table)
+
+    def _rewrite_parquet(self, schema):
+        import pyarrow.parquet as pq
+
+        self._parquet_writer.close()
+        source = self._parquet_path
+        self._parquet_path = f"{self.path}.rewrite" if source == self.path else self.path
+        self._parquet_writer = pq.ParquetWriter(self._parquet_path, schema, compression='zstd')
+        written = pq.ParquetFile(source)
+        for row_group in range(written.num_row_groups):
+            self._parquet_writer.write_table(_with_defaults(written.read_row_group(row_group), schema))
+        written.close()
+        os.remove(source)
+        self._columns = tuple(schema.names)
+
+    def close(self):
+        self.write()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            if self._parquet_path != self.path:
+                os.replace(self._parquet_path, self.path)
+        elif self.format == 'parquet':
+            # Nothing was ever recorded: still produce a valid, empty file
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            names = pa.array([], pa.string())
+            pq.write_table(pa.table({
+                column: (pa.DictionaryArray.from_arrays(pa.array([], pa.int64()), names)
+                         if column in ("task", "parent_task") else pa.array([], pa.int64()))
+                for column in COLUMNS
+            }), self.path)
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _with_defaults(table, schema):
+    """Return the columns of a pyarrow table in the order of `schema`, those it lacks set to their default value."""
+    import pyarrow as pa
+
+    for field in schema:
+        if field.name not in table.column_names:
+            default = EXTRA_DEFAULTS.get(field.name, 0)
+            table = table.append_column(field, pa.array([default] * len(table), type=field.type))
+    return table.select(schema.names)
+
+
+def _column_values(buffer, column):
+    if column == "task":
+        return buffer.task_ids
+    if column == "parent_task":
+        return buffer.parent_ids
+    if column == "start_time":
+        return buffer.start_times
+    if column == "end_time":
+        return buffer.end_times
+    return buffer.extras[column]
+
+
+def read_event_file(path):
+    """Load a file written by EventFileWriter, in either format, into an EventBuffer using memory-mapped reads."""
+    with open(path, 'rb') as file:
+        magic = file.read(len(MAGIC))
+    if magic.startswith(PARQUET_MAGIC):
+        return _read_parquet(path)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a pygraphprofiler event file")
+    return _read_binary(path)
+
+
+def _read_binary(path):
+    buffer = EventBuffer()
+    specs = [(column, 'q') for column in COLUMNS]
+    extras = {}
+    n_events = 0
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        offset = len(MAGIC)
+        while offset + CHUNK.size <= len(view):
+            tag, count, size = CHUNK.unpack_from(view, offset)
+            offset += CHUNK.size
+            if offset + size > len(view):
+                # Ignore a trailing chunk still being written, e.g. to a spilled segment
+                break
+            payload = zlib.decompress(view[offset:offset + size])
+            offset += size
+            if tag == b'NAME':
+                for name in _decode_names(payload):
+                    buffer.intern(name)
+            elif tag == b'COLS':
+                specs = [spec.rsplit(':', 1) for spec in payload.decode('utf-8').split('\n')]
+            elif tag == b'EVTS':
+                for i, (column, typecode) in enumerate(specs):
+                    values = array(typecode)
+                    values.frombytes(payload[i * 8 * count:(i + 1) * 8 * count])
+                    if sys.byteorder == 'big':
+                        values.byteswap()
+                    if column in COLUMNS:
+                        _column_values(buffer, column).extend(values)
+                        continue
+                    if column not in extras:
+                        # First recorded after earlier chunks were written: their events read as the default
+                        extras[column] = array(typecode)
+                        EventBuffer._pad(column, extras[column], n_events)
+                    elif extras[column].typecode != typecode:
+                        extras[column] = array('d', extras[column])
+                        values = array('d', values)
+                    extras[column].extend(values)
+                n_events += count
+                # And the other way around, for columns missing from this chunk
+                for column, values in extras.items():
+                    EventBuffer._pad(column, values, n_events)
+            else:
+                raise ValueError(f"Unknown chunk {tag!r} in {path}")
+        view.release()
+    for column, values in extras.items():
+        buffer.set_extra(column, values)
+    return buffer
+
+
+def _read_parquet(path):
+    import numpy as np
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    buffer = EventBuffer()
+    table = pq.read_table(path, memory_map=True)
+    for column in table.column_names:
+        chunked = table.column(column)
+        if column in ("task", "parent_task"):
+            values = array('q')
+            for chunk in chunked.chunks:
+                # The extra trailing entry maps null (filled as -1) indices to -1
+                id_map = np.array([buffer.intern(name) for name in chunk.dictionary.to_pylist()] + [-1], dtype=np.int64)
+                indices = pc.fill_null(chunk.indices, -1).to_numpy()
+                values.frombytes(id_map[indices].tobytes())
+        else:
+            values = chunked.to_numpy()
+            typecode = 'd' if values.dtype.kind == 'f' else 'q'
+            values = array(typecode, values.astype(f"={typecode}").tobytes())
+        if column in COLUMNS:
+            _column_values(buffer, column).extend(values)
+        else:
+            buffer.set_extra(column, values)
+    return buffer
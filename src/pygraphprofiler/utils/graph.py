@@ -1,45 +1,296 @@
 import networkx as nx
-import matplotlib.dates as mdates
 import pandas as pd
 
-
-date_format = mdates.DateFormatter('%m/%d/%Y %H:%M')
+from .sketch import _ZERO_INDEX, LatencySketch, _bucket_indices
+from .stack import ROOT_PATH_ID
 
 
 def _add_graph_edges(task_df: pd.DataFrame, graph: nx.Graph):
-    edge_counts = {}
-    for index, row in task_df.iterrows():
-        node = row['task']
-        parent = row['parent_task']
-        if parent:
-            if (parent, node) not in edge_counts:
-                edge_counts[(parent, node)] = 1
-            else:
-                edge_counts[(parent, node)] += 1
-            graph.add_edge(parent, node, calls=edge_counts[(parent, node)])
+    parents = task_df['parent_task']
+    has_parent = parents.notna() & (parents != '')
+    if 'weight' in task_df:
+        # Sampled calls stand for `weight` calls each
+        edge_df = task_df.loc[has_parent, ['parent_task', 'task', 'weight']]
+        edge_counts = edge_df.groupby(['parent_task', 'task'], observed=True, sort=False)['weight'].sum()
+    else:
+        edge_df = task_df.loc[has_parent, ['parent_task', 'task']]
+        edge_counts = edge_df.groupby(['parent_task', 'task'], observed=True, sort=False).size()
+    edge_percentiles = _percentiles(task_df.loc[has_parent], ['parent_task', 'task'])
+    graph.add_edges_from(
+        (parent, node, {'calls': calls, **edge_percentiles[parent, node]})
+        for (parent, node), calls in zip(edge_counts.index, edge_counts.tolist())
+    )
+
+    return graph
+
+
+def _add_aggregate_edges(aggregates, graph: nx.Graph):
+    sketches = aggregates.edge_sketches
+    graph.add_edges_from(
+        (parent, node, {'calls': calls, **sketches[parent, node].percentiles()})
+        for (parent, node), calls in aggregates.edges.items()
+    )
+    return graph
 
+
+def _add_aggregate_nodes(aggregates, graph: nx.Graph):
+    sketches = aggregates.node_sketches
+    allocations = aggregates.allocations
+    graph.add_nodes_from(
+        (node, {
+            'total_exec_time': total,
+            'count': count,
+            'average_exec_time': total / count,
+            'min_exec_time': minimum,
+            'max_exec_time': maximum,
+            'total_self_time': self_total,
+            **sketches[node].percentiles(),
+        })
+        for node, (count, total, minimum, maximum, self_total) in aggregates.nodes.items()
+    )
+    if allocations:
+        # As in 'events' mode, every node gets the attributes once any task was measured
+        for node, attributes in graph.nodes.items():
+            attributes['total_alloc_bytes'], attributes['peak_alloc_bytes'] = allocations.get(node, (0, 0))
     return graph
 
 
+def _add_aggregate_call_tree(aggregates, tree: nx.DiGraph):
+    paths = aggregates.paths
+    tree.add_nodes_from(
+        (path_id, {
+            'task': task,
+            'depth': depth,
+            'count': count,
+            'total_exec_time': total,
+            'total_self_time': self_total,
+        })
+        for path_id, (parent_path_id, task, depth, count, total, self_total) in paths.items()
+    )
+    tree.add_edges_from(
+        (parent_path_id, path_id, {'calls': path[3]})
+        for path_id, (parent_path_id, *path) in paths.items()
+        if parent_path_id != ROOT_PATH_ID
+    )
+    return tree
+
+
+def _weighted_stats(task_df: pd.DataFrame):
+    # Sampled calls stand for `weight` calls each: weighted sums are unbiased estimates of the true ones
+    weight = task_df['weight'] if 'weight' in task_df else pd.Series(1, index=task_df.index)
+    stats = {
+        'total_exec_time': (task_df['end_time'] - task_df['start_time']) * weight,
+        'count': weight,
+    }
+    if 'self_time' in task_df:
+        stats['total_self_time'] = task_df['self_time'] * weight
+    if 'alloc_bytes' in task_df:
+        stats['total_alloc_bytes'] = task_df['alloc_bytes'] * weight
+    return pd.DataFrame(stats)
+
+
+def _node_stats(task_df: pd.DataFrame):
+    """Return the summed statistics of each task, along with its highest peak_alloc_bytes when allocations were measured."""
+    node_stats = _weighted_stats(task_df).groupby(task_df['task'], observed=True, sort=False).sum()
+    if 'peak_alloc_bytes' in task_df:
+        node_stats['peak_alloc_bytes'] = task_df['peak_alloc_bytes'].groupby(task_df['task'], observed=True, sort=False).max()
+    return node_stats
+
+
 def _add_graph_nodes(task_df: pd.DataFrame, graph: nx.Graph):
-    total_exec_time_dict = {}
-    count_dict = {}
-    for index, row in task_df.iterrows():
-        node = row['task']
-        start_time = row['start_time']
-        end_time = row['end_time']
-        exec_time = end_time - start_time
-        if node not in total_exec_time_dict:
-            total_exec_time_dict[node] = exec_time
-            count_dict[node] = 1
+    node_stats = _node_stats(task_df)
+    node_stats.insert(2, 'average_exec_time', node_stats['total_exec_time'] / node_stats['count'])
+    node_percentiles = _percentiles(task_df, ['task'])
+    graph.add_nodes_from(
+        (node, {**stats, **node_percentiles[node]})
+        for node, stats in zip(node_stats.index, node_stats.to_dict('records'))
+    )
+
+    return graph
+
+
+def _update_graph_nodes(task_df: pd.DataFrame, graph: nx.Graph, sketches: dict):
+    """Fold the calls of `task_df` into the node attributes of a graph built from earlier calls.
+
+    `sketches` holds the LatencySketch of every node from the earlier calls and is updated in place. Only the nodes
+    called in `task_df` are touched, so the cost is proportional to the new calls rather than to all of them.
+    """
+    node_stats = _node_stats(task_df)
+    _merge_sketches(sketches, _sketches(task_df, ['task']))
+    for node, stats in zip(node_stats.index, node_stats.to_dict('records')):
+        if node not in graph:
+            graph.add_node(node)
+        _merge_node_stats(graph.nodes[node], stats)
+        attributes = graph.nodes[node]
+        attributes['average_exec_time'] = attributes['total_exec_time'] / attributes['count']
+        attributes.update(sketches[node].percentiles())
+
+    return graph
+
+
+def _update_graph_edges(task_df: pd.DataFrame, graph: nx.Graph, sketches: dict):
+    """Fold the calls of `task_df` into the edge attributes of a graph built from earlier calls, as _update_graph_nodes."""
+    parents = task_df['parent_task']
+    task_df = task_df.loc[parents.notna() & (parents != '')]
+    weight = task_df['weight'] if 'weight' in task_df else pd.Series(1, index=task_df.index)
+    edge_counts = weight.groupby([task_df['parent_task'], task_df['task']], observed=True, sort=False).sum()
+    _merge_sketches(sketches, _sketches(task_df, ['parent_task', 'task']))
+    for (parent, node), calls in zip(edge_counts.index, edge_counts.tolist()):
+        if not graph.has_edge(parent, node):
+            graph.add_edge(parent, node, calls=0)
+        attributes = graph.edges[parent, node]
+        attributes['calls'] += calls
+        attributes.update(sketches[parent, node].percentiles())
+
+    return graph
+
+
+def _fold_aggregates(task_df: pd.DataFrame, aggregates: tuple):
+    """Fold the calls of `task_df` into aggregates (nodes, edges, node_sketches, edge_sketches), updated in place.
+
+    `nodes` maps each task to its summed statistics and `edges` each (parent_task, task) pair to its calls: the same
+    sums and sketches as _update_graph_nodes and _update_graph_edges, without a graph to update, so that partial
+    aggregates of separate chunks can be merged and their percentiles computed once, by _aggregates_graph.
+    """
+    nodes, edges, node_sketches, edge_sketches = aggregates
+    node_stats = _node_stats(task_df)
+    for node, stats in zip(node_stats.index, node_stats.to_dict('records')):
+        _merge_node_stats(nodes.setdefault(node, {}), stats)
+    _merge_sketches(node_sketches, _sketches(task_df, ['task']))
+    parents = task_df['parent_task']
+    task_df = task_df.loc[parents.notna() & (parents != '')]
+    weight = task_df['weight'] if 'weight' in task_df else pd.Series(1, index=task_df.index)
+    edge_counts = weight.groupby([task_df['parent_task'], task_df['task']], observed=True, sort=False).sum()
+    for edge, calls in zip(edge_counts.index, edge_counts.tolist()):
+        edges[edge] = edges.get(edge, 0) + calls
+    _merge_sketches(edge_sketches, _sketches(task_df, ['parent_task', 'task']))
+    return aggregates
+
+
+def _merge_aggregates(aggregates: tuple, other_aggregates: tuple):
+    nodes, edges, node_sketches, edge_sketches = aggregates
+    other_nodes, other_edges, other_node_sketches, other_edge_sketches = other_aggregates
+    for node, stats in other_nodes.items():
+        _merge_node_stats(nodes.setdefault(node, {}), stats)
+    for edge, calls in other_edges.items():
+        edges[edge] = edges.get(edge, 0) + calls
+    _merge_sketches(node_sketches, other_node_sketches)
+    _merge_sketches(edge_sketches, other_edge_sketches)
+    return aggregates
+
+
+def _aggregates_graph(aggregates: tuple):
+    """Build the call graph of aggregates, with the node and edge attributes of _add_graph_nodes and _add_graph_edges."""
+    nodes, edges, node_sketches, edge_sketches = aggregates
+    graph = nx.DiGraph()
+    graph.add_nodes_from(
+        (node, {
+            **stats,
+            'average_exec_time': stats['total_exec_time'] / stats['count'],
+            **node_sketches[node].percentiles(),
+        })
+        for node, stats in nodes.items()
+    )
+    graph.add_edges_from(
+        (parent, node, {'calls': calls, **edge_sketches[parent, node].percentiles()})
+        for (parent, node), calls in edges.items()
+    )
+    return graph
+
+
+def _merge_node_stats(stats: dict, other_stats: dict):
+    # Every statistic adds up, except peaks
+    for key, value in other_stats.items():
+        if key == 'peak_alloc_bytes':
+            stats[key] = max(stats.get(key, value), value)
         else:
-            total_exec_time_dict[node] += exec_time
-            count_dict[node] += 1
-        graph.add_node(
-            node,
-            total_exec_time=total_exec_time_dict[node],
-            count=count_dict[node],
-            average_exec_time=total_exec_time_dict[node]/count_dict[node]
+            stats[key] = stats.get(key, 0) + value
+
+
+def _merge_sketches(sketches: dict, other_sketches: dict):
+    for key, other_sketch in other_sketches.items():
+        sketch = sketches.get(key)
+        if sketch is None:
+            sketches[key] = other_sketch
+        else:
+            sketch.merge(other_sketch)
+
+
+def _percentiles(task_df: pd.DataFrame, keys: list):
+    """Return the percentile attributes of the calls of each group of `keys` columns, as {key: attributes}."""
+    return {key: sketch.percentiles() for key, sketch in _sketches(task_df, keys).items()}
+
+
+def _sketches(task_df: pd.DataFrame, keys: list):
+    """Return the LatencySketch of the calls of each group of `keys` columns, as {key: sketch}.
+
+    Bucket counts are computed in one vectorized pass, then fed to one LatencySketch per group in a single call.
+    """
+    import numpy as np
+
+    # Number the groups from the codes of each key column, -1 for a missing key, which leaves the row out
+    factorized = [pd.factorize(task_df[key]) for key in keys]
+    grouped = np.logical_and.reduce([codes >= 0 for codes, _ in factorized])
+    if not grouped.any():
+        return {}
+    key_codes = factorized[0][0][grouped]
+    for codes, uniques in factorized[1:]:
+        key_codes = key_codes * len(uniques) + codes[grouped]
+    group_ids, group_codes = pd.factorize(key_codes)
+    buckets = _bucket_indices((task_df['end_time'] - task_df['start_time']).to_numpy()[grouped])
+    weights = task_df['weight'].to_numpy()[grouped] if 'weight' in task_df else np.ones(len(group_ids), dtype=np.int64)
+    # Count every (group, bucket) pair at once, encoded as group_id * span + bucket offset, offset 0 standing for
+    # _ZERO_INDEX: sorted pair codes leave the buckets of each group contiguous. Hash-based grouping only sorts the
+    # distinct pairs rather than every row.
+    positive = buckets != _ZERO_INDEX
+    lowest = buckets[positive].min() if positive.any() else 0
+    offsets = np.where(positive, buckets - lowest + 1, 0)
+    span = int(offsets.max()) + 1
+    pair_counts = pd.Series(weights).groupby(group_ids * span + offsets, sort=True).sum()
+    group_samples = np.bincount(group_ids)
+    pairs, counts = pair_counts.index.to_numpy(), pair_counts.to_numpy()
+    pair_groups, pair_offsets = pairs // span, pairs % span
+    pair_buckets = np.where(pair_offsets == 0, _ZERO_INDEX, pair_offsets + lowest - 1)
+    starts = np.flatnonzero(np.diff(pair_groups, prepend=-1))
+    stops = np.append(starts[1:], len(pairs))
+    # Decode the key values of each group from its combined code, last key first
+    key_values = []
+    for _, uniques in reversed(factorized):
+        group_codes, key_index = np.divmod(group_codes, len(uniques))
+        key_values.insert(0, np.asarray(uniques, dtype=object)[key_index].tolist())
+    group_keys = list(zip(*key_values)) if len(keys) > 1 else key_values[0]
+    sketches = {}
+    for group_id, start, stop in zip(pair_groups[starts].tolist(), starts.tolist(), stops.tolist()):
+        sketch = sketches[group_keys[group_id]] = LatencySketch()
+        sketch.add_buckets(pair_buckets[start:stop].tolist(), counts[start:stop].tolist(),
+                           samples=int(group_samples[group_id]))
+    return sketches
+
+
+def _add_call_tree(task_df: pd.DataFrame, tree: nx.DiGraph):
+    """Add one node per calling context (path_id) and an edge from each context to the contexts it calls."""
+    if 'path_id' not in task_df:
+        return tree
+    path_df = _weighted_stats(task_df)
+    for column in ('path_id', 'parent_path_id', 'task', 'depth'):
+        path_df[column] = task_df[column]
+    path_stats = path_df.groupby('path_id', sort=False).agg(
+        parent_path_id=('parent_path_id', 'first'),
+        task=('task', 'first'),
+        depth=('depth', 'first'),
+        count=('count', 'sum'),
+        total_exec_time=('total_exec_time', 'sum'),
+        total_self_time=('total_self_time', 'sum'),
+    )
+    tree.add_nodes_from(zip(path_stats.index.tolist(), path_stats.drop(columns='parent_path_id').to_dict('records')))
+    has_parent = path_stats['parent_path_id'] != ROOT_PATH_ID
+    tree.add_edges_from(
+        (parent_path_id, path_id, {'calls': calls})
+        for path_id, parent_path_id, calls in zip(
+            path_stats.index[has_parent].tolist(),
+            path_stats.loc[has_parent, 'parent_path_id'].tolist(),
+            path_stats.loc[has_parent, 'count'].tolist(),
         )
+    )
 
-    return graph
+    return tree
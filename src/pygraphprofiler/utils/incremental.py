@@ -0,0 +1,45 @@
+import threading
+
+
+class GraphCache:
+    """Call graph of an EventBuffer, kept up to date from only the events appended since the previous snapshot.
+
+    Every `snapshot()` that finds new events folds them into the cached graph and bumps its `version`; a snapshot
+    without new events returns the cached graph as is. The graph's `version` and `events` (number of events it covers)
+    are stored in its `graph` attribute dict, so that a poller can skip work when nothing changed. The cache starts over
+    when given a different buffer, or when the buffer shrank.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, buffer):
+        self._buffer = buffer
+        self._cursor = 0
+        self._graph = None
+        self._node_sketches = {}
+        self._edge_sketches = {}
+
+    def snapshot(self, buffer):
+        """Return a copy of the call graph of every event in `buffer`, after folding in the events it did not cover yet."""
+        import networkx as nx
+        from .graph import _update_graph_edges, _update_graph_nodes
+
+        with self._lock:
+            n_events = len(buffer)
+            if buffer is not self._buffer or n_events < self._cursor:
+                self._reset(buffer)
+            if self._graph is None or n_events > self._cursor:
+                graph = self._graph if self._graph is not None else nx.DiGraph()
+                if n_events > self._cursor:
+                    task_df = buffer.to_dataframe(self._cursor, n_events)
+                    graph = _update_graph_nodes(task_df, graph, self._node_sketches)
+                    graph = _update_graph_edges(task_df, graph, self._edge_sketches)
+                self.version += 1
+                self._cursor = n_events
+                graph.graph.update(version=self.version, events=n_events)
+                self._graph = graph
+            # Callers get their own copy, so that changing it leaves the cache intact
+            return self._graph.copy()
@@ -0,0 +1,50 @@
+import threading
+import tracemalloc
+
+
+# Calls being measured, in every thread: tracemalloc has a single, process-wide peak, which each measured call resets
+# when it starts, so the peak seen until then is first handed to every call still open.
+_open_calls = []
+_lock = threading.Lock()
+# Whether tracemalloc was started here, and is to be stopped when the last measured call returns
+_started = False
+
+
+def _start_measure():
+    """Start measuring the memory allocated by a call, tracing allocations from now on if nothing traces them yet.
+
+    Returns the measure to pass to _stop_measure: [bytes traced at start, highest peak seen since].
+    """
+    global _started
+    with _lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started = True
+        current, peak = tracemalloc.get_traced_memory()
+        for measure in _open_calls:
+            if peak > measure[1]:
+                measure[1] = peak
+        tracemalloc.reset_peak()
+        measure = [current, current]
+        _open_calls.append(measure)
+        return measure
+
+
+def _stop_measure(measure):
+    """Return (net, peak) bytes allocated by a call since _start_measure, both relative to the bytes traced at start.
+
+    Net bytes are still allocated when the call returns; the peak is the highest allocation reached during the call,
+    and includes allocations made meanwhile by other threads.
+    """
+    global _started
+    with _lock:
+        current, peak = tracemalloc.get_traced_memory()
+        _open_calls.remove(measure)
+        for other in _open_calls:
+            if peak > other[1]:
+                other[1] = peak
+        if not _open_calls and _started:
+            # Tracing only while measured calls run keeps every other allocation at full speed
+            tracemalloc.stop()
+            _started = False
+        return current - measure[0], max(peak, measure[1]) - measure[0]
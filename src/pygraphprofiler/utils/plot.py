@@ -1,28 +1,105 @@
+import heapq
+import math
+import importlib.util
+import os
+import threading
+from collections import OrderedDict
+
 import networkx as nx
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from .scc import assign_scc
+from .stack import _short_name
+
+
+# Layout backends: graphviz's hierarchical 'dot' and force-directed 'sfdp' (both need pygraphviz), and networkx's
+# force-directed 'spring', which needs nothing else.
+LAYOUTS = ('dot', 'sfdp', 'spring')
+# Largest graph laid out with 'dot' by default: it takes minutes with a few thousand nodes, 'sfdp' seconds
+DOT_MAX_NODES = 300
+# Number of layouts kept, keyed by graph topology, so that replotting an unchanged graph skips the layout
+LAYOUT_CACHE_SIZE = 32
+
+_layout_cache = OrderedDict()
+_layout_cache_lock = threading.Lock()
 
 
-def _draw_graph_to_file(filename: str, graph: nx.Graph, pos: nx.nx_agraph.graphviz_layout, node_labels: dict, edge_labels: dict, node_sizes: dict,  color_nodes: bool = False):
+def _plot_graph_to_file(graph: nx.DiGraph, filename: str, weight_node_on: str, color_nodes: bool, top_k: int = None,
+                        min_time: float = None, layout: str = None, format: str = None):
+    graph = _prune_graph(graph, weight_node_on, top_k=top_k, min_time=min_time)
+    node_labels = _set_node_labels(weight_node_on, graph)
+    edge_labels = _set_edge_labels(graph)
+    node_sizes = _set_node_sizes(weight_node_on, graph)
+    if (format or _file_format(filename)) == 'dot':
+        _write_dot_file(filename, graph, node_labels, edge_labels, node_sizes, color_nodes)
+        return
+    pos = _set_graph_layout(graph, layout)
+    _draw_graph_to_file(filename, graph, pos, node_labels, edge_labels, node_sizes, color_nodes, format=format)
+
+
+def _draw_graph_to_file(filename: str, graph: nx.Graph, pos: nx.nx_agraph.graphviz_layout, node_labels: dict, edge_labels: dict, node_sizes: dict,  color_nodes: bool = False, format: str = None):
     
-    if color_nodes:
-        graph = assign_scc(graph)
-        node_colors = [node['color'] for node in graph.nodes.values()]
-    else:
-        node_colors = ['lightblue' for node in graph.nodes.values()]
+    node_colors = _set_node_colors(graph, color_nodes)
     
     nx.draw_networkx(graph, pos, labels=node_labels, with_labels=True, font_size=10, node_size=node_sizes, node_color=node_colors)
     nx.draw_networkx_edge_labels(graph, pos, edge_labels=edge_labels, font_size=10, label_pos=0.5)
     
-    plt.savefig(filename, format='png', dpi=300, bbox_inches='tight')
+    plt.savefig(filename, format=format or _file_format(filename), dpi=300, bbox_inches='tight')
     plt.close()
 
 
+def _write_dot_file(filename: str, graph: nx.Graph, node_labels: dict, edge_labels: dict, node_sizes: dict, color_nodes: bool = False):
+    """Write the graph in Graphviz DOT format, to be laid out and rendered out of process (e.g. `sfdp -Tsvg`)."""
+    node_colors = _set_node_colors(graph, color_nodes)
+    node_sizes = node_sizes if node_sizes is not None else [0] * graph.number_of_nodes()
+    lines = ["digraph {", "    node [style=filled];"]
+    for node, color, size in zip(graph.nodes, node_colors, node_sizes):
+        # Node sizes are matplotlib marker areas up to 1000, drawn here as widths of 0.5 to 1.5 inches
+        lines.append(f"    {_dot_id(node)} [label={_dot_id(node_labels[node])}, fillcolor={_dot_id(color)}, "
+                     f"width={0.5 + size / 1000:.2f}];")
+    for (parent, node), calls in edge_labels.items():
+        lines.append(f"    {_dot_id(parent)} -> {_dot_id(node)} [label={_dot_id(f'{calls:g}')}];")
+    lines.append("}")
+    with open(filename, 'w') as dot_file:
+        dot_file.write("\n".join(lines) + "\n")
+
+
+def _dot_id(value):
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'"{escaped}"'
+
+
+def _file_format(filename: str):
+    """Return the output format given by the extension of filename (e.g. 'svg', 'dot'), 'png' if it has none."""
+    return os.path.splitext(filename)[1][1:].lower() or 'png'
+
+
+def _set_node_colors(graph: nx.Graph, color_nodes: bool = False):
+    if graph.graph.get('diff'):
+        return _slowdown_colors(graph)
+    if color_nodes:
+        graph = assign_scc(graph)
+        return [node['color'] for node in graph.nodes.values()]
+    return ['lightblue' for node in graph.nodes.values()]
+
+
+def _slowdown_colors(graph: nx.Graph):
+    # Diverging colors on a log scale, from green at half the baseline time to red at twice, grey without a baseline
+    cmap = mpl.colormaps['RdYlGn_r']
+    colors = []
+    for node in graph.nodes.values():
+        slowdown = node.get('slowdown')
+        if slowdown is None or not slowdown > 0:
+            colors.append('lightgrey')
+        else:
+            position = min(max(math.log2(slowdown), -1), 1)
+            colors.append(mpl.colors.to_hex(cmap((position + 1) / 2)))
+    return colors
+
 
 def _set_node_sizes(weight_node_on: str, graph: nx.Graph):
     node_sizes = None
-    if weight_node_on:
+    if weight_node_on and graph.number_of_nodes():
         values = [node.get(weight_node_on, 1)
                 for node in graph.nodes.values()]
         norm = mpl.colors.Normalize(vmin=min(values), vmax=max(values))
@@ -41,13 +118,84 @@ def _set_node_labels(weight_node_on: str, graph: nx.Graph):
     node_labels = {}
     for node in graph.nodes:
         weight_value = graph.nodes[node].get(weight_node_on, 0)
+        # Nodes are keyed by module and qualified name, labeled without them
+        name = _short_name(node)
         if weight_node_on == 'count':
-            node_labels[node] = f"{node}\n{weight_value}"
+            node_labels[node] = f"{name}\n{weight_value:.0f}"
+        elif weight_node_on and weight_node_on.endswith('_alloc_bytes'):
+            node_labels[node] = f"{name}\n{_format_bytes(weight_value)}"
         else:
-            node_labels[node] = f"{node}\n{weight_value:.2f}s"
+            node_labels[node] = f"{name}\n{weight_value / 1e9:.2f}s"
+        slowdown = graph.nodes[node].get('slowdown')
+        if slowdown is not None and math.isfinite(slowdown):
+            node_labels[node] += f"\n{slowdown - 1:+.0%}"
     return node_labels
 
 
-def _set_graph_layout(graph: nx.Graph):
-    pos = nx.nx_agraph.graphviz_layout(graph, prog='dot')
+def _format_bytes(value: float):
+    for unit in ('B', 'kB', 'MB'):
+        if abs(value) < 1000:
+            return f"{value:.0f}{unit}" if unit == 'B' else f"{value:.1f}{unit}"
+        value /= 1000
+    return f"{value:.2f}GB"
+
+
+def _set_graph_layout(graph: nx.Graph, layout: str = None):
+    if layout is None:
+        if importlib.util.find_spec("pygraphviz") is None:
+            layout = 'spring'
+        else:
+            layout = 'dot' if graph.number_of_nodes() <= DOT_MAX_NODES else 'sfdp'
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout!r}, available options: {', '.join(LAYOUTS)}")
+    key = (layout, frozenset(graph.nodes), frozenset(graph.edges))
+    with _layout_cache_lock:
+        pos = _layout_cache.get(key)
+        if pos is not None:
+            _layout_cache.move_to_end(key)
+            return pos
+    if layout == 'spring':
+        pos = nx.spring_layout(graph, seed=0)
+    else:
+        pos = nx.nx_agraph.graphviz_layout(graph, prog=layout)
+    with _layout_cache_lock:
+        _layout_cache[key] = pos
+        if len(_layout_cache) > LAYOUT_CACHE_SIZE:
+            _layout_cache.popitem(last=False)
     return pos
+
+
+def _prune_graph(graph: nx.DiGraph, weight_node_on: str, top_k: int = None, min_time: float = None):
+    """Reduce a large graph to its most relevant nodes before drawing it.
+
+    With `min_time`, the callees of each node whose total_exec_time is below min_time nanoseconds are collapsed into
+    a single '<parent>/<n collapsed>' node carrying their calls and time; nodes below the threshold are dropped along
+    with their own callees. With `top_k`, only the top_k nodes with the largest `weight_node_on` attribute are kept.
+    """
+    if min_time is not None:
+        graph = _collapse_graph(graph, min_time)
+    if top_k is not None and graph.number_of_nodes() > top_k:
+        kept = heapq.nlargest(top_k, graph.nodes, key=lambda node: graph.nodes[node].get(weight_node_on, 0))
+        graph = graph.subgraph(kept).copy()
+    return graph
+
+
+def _collapse_graph(graph: nx.DiGraph, min_time: float):
+    # Nodes without statistics are callers that were not monitored themselves, and always kept
+    small = {node for node, attributes in graph.nodes.items()
+             if attributes.get('total_exec_time', min_time) < min_time}
+    if not small:
+        return graph
+    collapsed = graph.subgraph(set(graph.nodes) - small).copy()
+    for parent in list(collapsed.nodes):
+        children = [node for node in graph.successors(parent) if node in small]
+        if not children:
+            continue
+        calls = sum(graph.edges[parent, node]['calls'] for node in children)
+        # Each collapsed callee is charged its average time for every call made by this parent
+        total = sum(graph.edges[parent, node]['calls'] * graph.nodes[node]['average_exec_time'] for node in children)
+        node = f"{parent}/<{len(children)} collapsed>"
+        collapsed.add_node(node, count=calls, total_exec_time=total, average_exec_time=total / calls,
+                           total_self_time=total)
+        collapsed.add_edge(parent, node, calls=calls)
+    return collapsed
@@ -0,0 +1,295 @@
+import threading
+from array import array
+from collections import deque
+
+
+COLUMNS = ("task", "parent_task", "start_time", "end_time")
+
+# Number of events a thread buffers locally before moving them into the shared columns.
+FLUSH_SIZE = 4096
+
+# Value of an extra column for events recorded without it, when not 0; e.g. unsampled calls stand for one call each.
+EXTRA_DEFAULTS = {
+    "weight": 1.0,
+}
+
+# Array typecode of extra columns appended per event, when not 'q'.
+EXTRA_TYPECODES = {
+    "weight": 'd',
+}
+
+
+class _ThreadShards:
+    """Lazily created per-thread objects, registered so that readers can visit the shards of every thread.
+
+    Shards outlive their thread until unregistered by `remove_dead()`, which owners call to fold the shards of threads
+    that have ended into shared state, so that memory does not grow with the number of threads ever started. `retire`,
+    if given, is called whenever a new thread registers its shard, for owners to do so.
+    """
+
+    def __init__(self, factory, retire=None):
+        self._factory = factory
+        self._retire = retire
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.shards = []
+        self._threads = []
+
+    def get(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._factory()
+            with self._lock:
+                self.shards.append(shard)
+                self._threads.append(threading.current_thread())
+            if self._retire is not None:
+                self._retire()
+            return shard
+
+    def remove_dead(self):
+        """Unregister and return the shards of threads that have ended, which will never be written to again."""
+        with self._lock:
+            if all(thread.is_alive() for thread in self._threads):
+                return []
+            dead = [shard for shard, thread in zip(self.shards, self._threads) if not thread.is_alive()]
+            alive = [(shard, thread) for shard, thread in zip(self.shards, self._threads) if thread.is_alive()]
+            # Readers iterate over a copy of `shards`, so it is replaced rather than changed in place
+            self.shards = [shard for shard, _ in alive]
+            self._threads = [thread for _, thread in alive]
+            return dead
+
+
+class _PendingRows(deque):
+    """Rows recorded by one thread and not flushed yet, tagged with the native id of that thread."""
+
+    def __init__(self):
+        super().__init__()
+        self.thread_id = threading.get_native_id()
+
+
+class EventBuffer:
+    """Columnar store of monitored calls.
+
+    Task and parent task names are interned into integer ids (-1 stands for a missing name) and every column is
+    kept in a compact `array('q')`, so a recorded call costs four machine integers instead of four boxed objects.
+    Indexing the buffer by column name (e.g. `buffer["task"]`) returns the decoded column as a list. Optional integer
+    or float columns (e.g. the `pid` of the recording process, or the `weight` of a sampled call) live in `extras` and
+    read as their EXTRA_DEFAULTS value, or 0, for events recorded without them.
+
+    Recording threads append whole rows to their own pending deque, without taking any lock; pending rows are moved
+    into the shared columns under a lock when a thread's deque fills up and before every read, along with a
+    `thread_id` extra column holding the native id of the recording thread. The deques of threads that have ended are
+    dropped on the next read or when another thread starts recording.
+    """
+
+    def __init__(self):
+        self.names = []
+        self._name_ids = {}
+        self.task_ids = array('q')
+        self.parent_ids = array('q')
+        self.start_times = array('q')
+        self.end_times = array('q')
+        self.extras = {}
+        self._lock = threading.RLock()
+        self._pending = _ThreadShards(_PendingRows, retire=self._retire_dead)
+
+    def intern(self, name):
+        if name is None:
+            return -1
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def append(self, task, parent_task, start_time, end_time, extra=None):
+        pending = self._pending.get()
+        pending.append((task, parent_task, start_time, end_time, extra))
+        if len(pending) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Move the rows buffered by every thread into the shared columns."""
+        with self._lock:
+            # The deques of threads that have ended are drained one last time and dropped
+            for pending in self._pending.remove_dead() + list(self._pending.shards):
+                # popleft is atomic, so rows appended concurrently by the owning thread are never lost
+                rows = [pending.popleft() for _ in range(len(pending))]
+                if rows:
+                    self._append_rows(rows, pending.thread_id)
+            self._pad_extras()
+
+    def _retire_dead(self):
+        # Called when a thread records its first row: move the rows of threads that have ended and drop their deques
+        with self._lock:
+            dead = self._pending.remove_dead()
+            for pending in dead:
+                if pending:
+                    self._append_rows(list(pending), pending.thread_id)
+            if dead:
+                self._pad_extras()
+
+    def _append_rows(self, rows, thread_id):
+        tasks, parent_tasks, start_times, end_times, extras = zip(*rows)
+        n_events = len(self.task_ids)
+        self._extra_column("thread_id", n_events).extend(array('q', [thread_id]) * len(rows))
+        first = extras[0]
+        if first and all(extra is not None and extra.keys() == first.keys() for extra in extras):
+            # Common case of every row carrying the same extra columns: extend them column by column
+            for column in first:
+                values = self._extra_column(column, n_events)
+                values.extend([extra[column] for extra in extras])
+        else:
+            for i, extra in enumerate(extras):
+                for column, value in (extra or {}).items():
+                    self._extra_column(column, n_events + i).append(value)
+        self.task_ids.extend(map(self.intern, tasks))
+        self.parent_ids.extend(map(self.intern, parent_tasks))
+        self.start_times.extend(start_times)
+        self.end_times.extend(end_times)
+
+    def _extra_column(self, column, n_events):
+        """Return the extra column `column`, created or padded to `n_events` values."""
+        values = self.extras.get(column)
+        if values is None:
+            values = self.extras[column] = array(EXTRA_TYPECODES.get(column, 'q'))
+        if len(values) != n_events:
+            self._pad(column, values, n_events)
+        return values
+
+    def set_extra(self, column, values):
+        """Set the optional integer column `column` to `values`, one per recorded event."""
+        with self._lock:
+            self.flush()
+            if not isinstance(values, array):
+                values = list(values)
+                values = array('d' if any(isinstance(value, float) for value in values) else 'q', values)
+            if len(values) != len(self.task_ids):
+                raise ValueError(f"Column {column!r} has {len(values)} values for {len(self.task_ids)} events")
+            self.extras[column] = values
+
+    def _pad_extras(self):
+        for column, values in self.extras.items():
+            self._pad(column, values, len(self.task_ids))
+
+    @staticmethod
+    def _pad(column, values, length):
+        missing = length - len(values)
+        if missing > 0:
+            values.extend(array(values.typecode, [EXTRA_DEFAULTS.get(column, 0)]) * missing)
+
+    def extend(self, other):
+        """Append all events of another EventBuffer, remapping its name ids onto this buffer's."""
+        other.flush()
+        with self._lock:
+            self.flush()
+            id_map = [self.intern(name) for name in other.names]
+            self.task_ids.extend(id_map[i] if i >= 0 else -1 for i in other.task_ids)
+            self.parent_ids.extend(id_map[i] if i >= 0 else -1 for i in other.parent_ids)
+            self.start_times.extend(other.start_times)
+            n_before = len(self.end_times)
+            self.end_times.extend(other.end_times)
+            for column, values in other.extras.items():
+                if column not in self.extras:
+                    self.extras[column] = array(values.typecode)
+                    self._pad(column, self.extras[column], n_before)
+                elif self.extras[column].typecode != values.typecode:
+                    self.extras[column] = array('d', self.extras[column])
+                    values = array('d', values)
+                self.extras[column].extend(values)
+            self._pad_extras()
+
+    def slice(self, start, stop=None, share_names=False):
+        """Return a new EventBuffer holding a copy of the events from index `start` to `stop` (by default the last).
+
+        With `share_names`, the slice refers to this buffer's name table instead of a copy, for readers of many slices
+        that never add events to them: the table keeps growing with the names recorded afterwards.
+        """
+        with self._lock:
+            self.flush()
+            events = EventBuffer()
+            if share_names:
+                events.names, events._name_ids = self.names, self._name_ids
+            else:
+                events.names = list(self.names)
+                events._name_ids = dict(self._name_ids)
+            events.task_ids = self.task_ids[start:stop]
+            events.parent_ids = self.parent_ids[start:stop]
+            events.start_times = self.start_times[start:stop]
+            events.end_times = self.end_times[start:stop]
+            events.extras = {column: values[start:stop] for column, values in self.extras.items()}
+            return events
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a buffer from a dict of equally long lists keyed by COLUMNS."""
+        buffer = cls()
+        buffer.task_ids.extend(buffer.intern(name) for name in data["task"])
+        buffer.parent_ids.extend(buffer.intern(name) for name in data["parent_task"])
+        buffer.start_times.extend(_as_nanoseconds(data["start_time"]))
+        buffer.end_times.extend(_as_nanoseconds(data["end_time"]))
+        for column in data.keys() - set(COLUMNS):
+            buffer.set_extra(column, data[column])
+        return buffer
+
+    def to_dict(self):
+        with self._lock:
+            return {column: self[column] for column in self.keys()}
+
+    def to_dataframe(self, start=0, stop=None):
+        """Return the events from index `start` to `stop` (by default all of them) as a DataFrame."""
+        import numpy as np
+        import pandas as pd
+
+        # Name columns become categoricals directly from the interned codes; time columns are copied out of the
+        # arrays with a single memcpy so that the buffer can keep growing afterwards.
+        with self._lock:
+            self.flush()
+            rows = slice(start, stop)
+            categories = pd.Index(self.names, dtype=object)
+            return pd.DataFrame({
+                "task": pd.Categorical.from_codes(np.frombuffer(self.task_ids, dtype=np.int64)[rows], categories=categories),
+                "parent_task": pd.Categorical.from_codes(np.frombuffer(self.parent_ids, dtype=np.int64)[rows], categories=categories),
+                "start_time": np.frombuffer(self.start_times, dtype=np.int64)[rows].copy(),
+                "end_time": np.frombuffer(self.end_times, dtype=np.int64)[rows].copy(),
+                **{column: np.frombuffer(values, dtype=values.typecode)[rows].copy() for column, values in self.extras.items()},
+            })
+
+    def keys(self):
+        return COLUMNS + tuple(self.extras)
+
+    def __getitem__(self, column):
+        with self._lock:
+            self.flush()
+            if column == "task":
+                return self._decode(self.task_ids)
+            if column == "parent_task":
+                return self._decode(self.parent_ids)
+            if column == "start_time":
+                return self.start_times.tolist()
+            if column == "end_time":
+                return self.end_times.tolist()
+            if column in self.extras:
+                return self.extras[column].tolist()
+        raise KeyError(column)
+
+    def __len__(self):
+        self.flush()
+        return len(self.task_ids)
+
+    def _decode(self, ids):
+        names = self.names
+        return [names[i] if i >= 0 else None for i in ids]
+
+
+def _as_buffer(data):
+    """Accept either a recorder buffer or a plain dict of lists keyed by COLUMNS."""
+    if isinstance(data, dict):
+        return EventBuffer.from_dict(data)
+    return data
+
+
+def _as_nanoseconds(values):
+    # Captures recorded before the nanosecond timers stored float seconds from time.time()
+    return [round(value * 1e9) if isinstance(value, float) else value for value in values]
@@ -0,0 +1,90 @@
+import itertools
+import random
+import threading
+import time
+
+
+class SamplingPolicy:
+    """Decide which calls of a monitored function are recorded, and how many calls each recorded one stands for.
+
+    `before()` is called when the function is entered and returns None to let the call run untimed and unrecorded,
+    or a provisional weight. `after(weight, exec_time)` is called once a timed call returns and gives the final weight,
+    0 to drop it. Weights are chosen so that summing `weight` and `weight * exec_time` over recorded calls gives
+    unbiased estimates of the true call count and total execution time. Use one instance per monitored function.
+    """
+
+    def before(self):
+        return 1.0
+
+    def after(self, weight, exec_time):
+        return weight
+
+
+class EveryN(SamplingPolicy):
+    """Record one call in every `n`, weighted `n`."""
+
+    def __init__(self, n: int):
+        if n < 1:
+            raise ValueError("n must be at least 1")
+        self.n = n
+        self._calls = itertools.count()
+
+    def before(self):
+        return float(self.n) if next(self._calls) % self.n == 0 else None
+
+
+class Probability(SamplingPolicy):
+    """Record each call independently with probability `p`, weighted `1 / p`."""
+
+    def __init__(self, p: float):
+        if not 0 < p <= 1:
+            raise ValueError("p must be in (0, 1]")
+        self.p = p
+
+    def before(self):
+        return 1 / self.p if random.random() < self.p else None
+
+
+class RateLimit(SamplingPolicy):
+    """Record at most `rate` calls per second, with bursts of up to `burst` calls, through a token bucket.
+
+    Each recorded call is weighted by the number of calls since the previously recorded one, itself included.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._skipped = 0
+        self._lock = threading.Lock()
+
+    def before(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self._tokens < 1:
+                self._skipped += 1
+                return None
+            self._tokens -= 1
+            weight, self._skipped = self._skipped + 1.0, 0
+            return weight
+
+
+class MinDuration(SamplingPolicy):
+    """Record every call lasting at least `threshold` nanoseconds.
+
+    Shorter calls are kept with probability `exec_time / threshold` and weighted `threshold / exec_time`, so that they
+    still count towards unbiased call counts and total times while costing few records.
+    """
+
+    def __init__(self, threshold: int):
+        self.threshold = threshold
+
+    def after(self, weight, exec_time):
+        if exec_time >= self.threshold:
+            return weight
+        if exec_time <= 0 or random.random() * self.threshold >= exec_time:
+            return 0
+        return weight * self.threshold / exec_time
@@ -0,0 +1,164 @@
+import atexit
+import glob
+import json
+import os
+import struct
+import threading
+from array import array
+from collections import deque
+
+from .recorder import FLUSH_SIZE, EventBuffer, _ThreadShards
+
+
+# Every event is stored as little-endian int64 task id, parent task id (-1 if missing), start time and end time, its
+# float64 sampling weight, then int64 self time, depth, path id and parent path id.
+RECORD_DTYPE = [
+    ('task', '<i8'), ('parent_task', '<i8'), ('start_time', '<i8'), ('end_time', '<i8'), ('weight', '<f8'),
+    ('self_time', '<i8'), ('depth', '<i8'), ('path_id', '<i8'), ('parent_path_id', '<i8'),
+]
+RECORD = struct.Struct('<qqqqdqqqq')
+# Call context columns, stored as -1 for events recorded without them
+CONTEXT_COLUMNS = ('self_time', 'depth', 'path_id', 'parent_path_id')
+
+
+class FileSink:
+    """Stream monitored calls of every process to fixed-size binary records in a shared directory.
+
+    Each process writes to its own `events-<pid>.bin` file, with the task names its records refer to appended, one
+    JSON string per line (so that names may contain newlines), to `names-<pid>.txt`. Files are opened lazily after a fork, so a single sink created before starting
+    multiprocessing or gunicorn workers collects all of them. Events are buffered per thread and written in batches
+    of FLUSH_SIZE, on `flush()` and at process exit.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pending = None
+        self._open()
+
+    def _open(self):
+        # (Re)initialize the per-process state; called again in a forked child on its first event.
+        self._pid = os.getpid()
+        self._pending = _ThreadShards(deque)
+        self._name_ids = {}
+        self._events_path = os.path.join(self.directory, f"events-{self._pid}.bin")
+        self._names_path = os.path.join(self.directory, f"names-{self._pid}.txt")
+        atexit.register(self.flush)
+        from multiprocessing import util
+
+        # multiprocessing children leave through os._exit, which skips atexit but runs these finalizers
+        util.Finalize(self, self.flush, exitpriority=10)
+
+    def append(self, task, parent_task, start_time, end_time, extra=None):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._open()
+        pending = self._pending.get()
+        pending.append((task, parent_task, start_time, end_time, extra))
+        if len(pending) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write the events buffered by every thread of this process to its records file."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            records = []
+            new_names = []
+            # The deques of threads that have ended are drained one last time and dropped
+            for pending in self._pending.remove_dead() + list(self._pending.shards):
+                # popleft is atomic, so rows appended concurrently by the owning thread are never lost
+                rows = [pending.popleft() for _ in range(len(pending))]
+                for task, parent_task, start_time, end_time, extra in rows:
+                    extra = extra or {}
+                    records.append(RECORD.pack(
+                        self._intern(task, new_names), self._intern(parent_task, new_names), start_time, end_time,
+                        extra.get("weight", 1.0), *(extra.get(column, -1) for column in CONTEXT_COLUMNS)))
+            if not records:
+                return
+            # Names go first, so that a concurrent reader never sees a record referring to an unknown name.
+            if new_names:
+                with open(self._names_path, 'a') as names_file:
+                    names_file.write(''.join(f"{json.dumps(name)}\n" for name in new_names))
+            with open(self._events_path, 'ab') as events_file:
+                events_file.write(b''.join(records))
+
+    def _intern(self, name, new_names):
+        if name is None:
+            return -1
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self._name_ids)
+            new_names.append(name)
+        return name_id
+
+    def load(self):
+        """Merge the events written so far by every process into an EventBuffer with `pid` and `worker` columns."""
+        self.flush()
+        return _load_directory(self.directory)
+
+    def keys(self):
+        return self.load().keys()
+
+    def __getitem__(self, column):
+        return self.load()[column]
+
+    def to_dict(self):
+        return self.load().to_dict()
+
+    def to_dataframe(self):
+        return self.load().to_dataframe()
+
+    def __len__(self):
+        return len(self.load())
+
+
+def _read_names(directory, pid):
+    """Return the task names written by process `pid` to a sink directory, in order of their ids."""
+    with open(os.path.join(directory, f"names-{pid}.txt")) as names_file:
+        # A trailing line without its newline is still being written, and no record refers to it yet
+        return [json.loads(line) for line in names_file.read().split('\n')[:-1]]
+
+
+def _load_directory(directory):
+    """Read every process' records file in `directory`, memory-mapped, into a single EventBuffer.
+
+    Workers are numbered 0, 1, ... in order of pid.
+    """
+    import numpy as np
+
+    buffer = EventBuffer()
+    pids = sorted(int(os.path.basename(path)[len("events-"):-len(".bin")])
+                  for path in glob.glob(os.path.join(directory, "events-*.bin")))
+    pid_column, worker_column, weight_column = array('q'), array('q'), array('d')
+    context_columns = {column: array('q') for column in CONTEXT_COLUMNS}
+    for worker, pid in enumerate(pids):
+        events_path = os.path.join(directory, f"events-{pid}.bin")
+        # Ignore a trailing partial record from a process that is still writing
+        n_records = os.path.getsize(events_path) // RECORD.size
+        if n_records == 0:
+            continue
+        names = _read_names(directory, pid)
+        records = np.memmap(events_path, dtype=RECORD_DTYPE, mode='r', shape=(n_records,))
+        # Map the process-local name ids onto the buffer's; the extra trailing entry maps -1 to -1
+        id_map = np.array([buffer.intern(name) for name in names] + [-1], dtype=np.int64)
+        buffer.task_ids.frombytes(id_map[records['task']].tobytes())
+        buffer.parent_ids.frombytes(id_map[records['parent_task']].tobytes())
+        buffer.start_times.frombytes(records['start_time'].astype(np.int64).tobytes())
+        buffer.end_times.frombytes(records['end_time'].astype(np.int64).tobytes())
+        weight_column.frombytes(records['weight'].astype(np.float64).tobytes())
+        for column, values in context_columns.items():
+            values.frombytes(records[column].astype(np.int64).tobytes())
+        pid_column.frombytes(np.full(n_records, pid, dtype=np.int64).tobytes())
+        worker_column.frombytes(np.full(n_records, worker, dtype=np.int64).tobytes())
+        del records
+    buffer.set_extra("pid", pid_column)
+    buffer.set_extra("worker", worker_column)
+    if any(weight != 1 for weight in weight_column):
+        buffer.set_extra("weight", weight_column)
+    for column, values in context_columns.items():
+        buffer.set_extra(column, values)
+    return buffer
@@ -0,0 +1,142 @@
+import math
+
+
+# Percentiles exposed as '<p>_exec_time' node and edge attributes, e.g. 'p99_exec_time'.
+PERCENTILES = (50, 90, 99)
+
+RELATIVE_ACCURACY = 0.01
+MAX_BUCKETS = 2048
+
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+# Bucket index standing for values <= 0 in `_bucket_indices`
+_ZERO_INDEX = -2 ** 63
+
+
+class LatencySketch:
+    """Mergeable, fixed-memory latency histogram answering quantile queries within RELATIVE_ACCURACY (DDSketch).
+
+    Values x > 0 fall in the logarithmic bucket ceil(log(x) / log(gamma)); values <= 0 are counted apart. Counts may
+    be fractional weights of sampled calls, `samples` counting the values actually added. When more than MAX_BUCKETS
+    buckets are in use, the lowest ones are collapsed, trading accuracy on the fastest calls for bounded memory.
+    """
+
+    __slots__ = ('buckets', 'zero_count', 'count', 'samples')
+
+    def __init__(self):
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.samples = 0
+
+    def add(self, value, weight=1):
+        self.count += weight
+        self.samples += 1
+        if value <= 0:
+            self.zero_count += weight
+            return
+        index = math.ceil(math.log(value) / _LOG_GAMMA)
+        self.buckets[index] = self.buckets.get(index, 0) + weight
+        if len(self.buckets) > MAX_BUCKETS:
+            self._collapse()
+
+    def add_buckets(self, indices, counts, samples=None):
+        """Add precomputed bucket counts, for bucket indices as produced by `_bucket_indices`, of `samples` values (as
+        many as the counts add up to if not provided)."""
+        self.samples += sum(counts) if samples is None else samples
+        for index, count in zip(indices, counts):
+            self.count += count
+            if index == _ZERO_INDEX:
+                self.zero_count += count
+            else:
+                self.buckets[index] = self.buckets.get(index, 0) + count
+        if len(self.buckets) > MAX_BUCKETS:
+            self._collapse()
+
+    def merge(self, other):
+        self.count += other.count
+        self.samples += other.samples
+        self.zero_count += other.zero_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        if len(self.buckets) > MAX_BUCKETS:
+            self._collapse()
+        return self
+
+    def _collapse(self):
+        indices = sorted(self.buckets)
+        n_extra = len(indices) - MAX_BUCKETS
+        target = indices[n_extra]
+        for index in indices[:n_extra]:
+            self.buckets[target] += self.buckets.pop(index)
+
+    def quantile(self, q):
+        """Return an estimate of the q-quantile (0 <= q <= 1) of the added values, or None if empty."""
+        return self.quantiles((q,))[0]
+
+    def quantiles(self, qs):
+        """Return estimates of several quantiles, given in increasing order, in a single pass over the buckets."""
+        if self.count <= 0:
+            return [None] * len(qs)
+        values = []
+        ranks = iter(q * self.count for q in qs)
+        rank = next(ranks)
+        cumulative = self.zero_count
+        while cumulative > rank:
+            values.append(0)
+            rank = next(ranks, None)
+            if rank is None:
+                return values
+        for index in sorted(self.buckets):
+            cumulative += self.buckets[index]
+            while cumulative > rank:
+                values.append(2 * _GAMMA ** index / (_GAMMA + 1))
+                rank = next(ranks, None)
+                if rank is None:
+                    return values
+        # Rounding left the highest ranks just above the total count
+        highest = 2 * _GAMMA ** max(self.buckets) / (_GAMMA + 1) if self.buckets else 0
+        return values + [highest] * (len(qs) - len(values))
+
+    def cumulative_counts(self, bounds):
+        """Return the count of added values <= each of `bounds`, given in increasing order, within RELATIVE_ACCURACY."""
+        counts = []
+        indices = sorted(self.buckets)
+        position = 0
+        cumulative = self.zero_count
+        for bound in bounds:
+            # A bucket counts towards the bound when its representative value does
+            while position < len(indices) and 2 * _GAMMA ** indices[position] / (_GAMMA + 1) <= bound:
+                cumulative += self.buckets[indices[position]]
+                position += 1
+            counts.append(cumulative)
+        return counts
+
+    def percentiles(self):
+        """Return the PERCENTILES as a dict of attributes like {'p99_exec_time': ...}."""
+        values = self.quantiles([p / 100 for p in PERCENTILES])
+        return {f"p{p}_exec_time": value for p, value in zip(PERCENTILES, values)}
+
+    def to_dict(self):
+        return {"zero_count": self.zero_count, "buckets": [[index, count] for index, count in self.buckets.items()],
+                "samples": self.samples}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls()
+        sketch.zero_count = data["zero_count"]
+        sketch.buckets = {index: count for index, count in data["buckets"]}
+        sketch.count = sketch.zero_count + sum(sketch.buckets.values())
+        sketch.samples = data.get("samples", sketch.count)
+        return sketch
+
+
+def _bucket_indices(values):
+    """Vectorized bucket index of every value of a numpy array, _ZERO_INDEX standing for values <= 0."""
+    import numpy as np
+
+    values = np.asarray(values, dtype=np.float64)
+    indices = np.full(values.shape, _ZERO_INDEX, dtype=np.int64)
+    positive = values > 0
+    indices[positive] = np.ceil(np.log(values[positive]) / _LOG_GAMMA)
+    return indices
@@ -0,0 +1,324 @@
+import atexit
+import glob
+import os
+import queue
+import threading
+import time
+import zlib
+from array import array
+
+from .fileio import CHUNK, MAGIC, _column_values, _encode_names, _le_bytes, read_event_file
+from .recorder import FLUSH_SIZE, EventBuffer, _PendingRows, _ThreadShards
+
+
+# What recording threads do when the writer thread falls behind and the queue of batches is full: 'drop' discards
+# the batch, counting its events in `dropped`, and 'block' waits for the writer to make room.
+SPILL_POLICIES = ('drop', 'block')
+
+# Queued by close() to stop the writer thread
+_STOP = object()
+
+
+class SegmentDirectory:
+    """Events spilled to rotating segment files by a SpillingBuffer, read lazily.
+
+    Each process writes `segment-<pid>-<sequence>.bin` files in the binary format of `stream_to_file`, every segment
+    holding its own name table so that the oldest ones can be deleted. Nothing is read until the events are: exports
+    that work chunk by chunk (to_graph, to_flamegraph, to_chrome_trace, diffs) read one segment at a time, the others
+    load every segment into a single EventBuffer with an additional `pid` column. A trailing chunk still being written
+    is ignored, so a directory can be read while processes keep recording to it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def flush(self):
+        """Nothing is buffered when reading a directory; a SpillingBuffer writes its pending events first."""
+
+    def segments(self):
+        """Return the paths of the segment files, in order of pid then sequence."""
+        return [path for _, path in _segment_paths(self.directory)]
+
+    def buffers(self):
+        """Yield an EventBuffer with the events of each segment, in order, along with a `pid` column."""
+        self.flush()
+        for pid, path in _segment_paths(self.directory):
+            try:
+                events = read_event_file(path)
+            except FileNotFoundError:
+                # Deleted since listed, by a process keeping at most max_segments
+                continue
+            events.set_extra("pid", array('q', [pid]) * len(events))
+            yield events
+
+    def load(self):
+        """Merge the events of every segment into an EventBuffer with a `pid` column."""
+        buffer = EventBuffer()
+        for events in self.buffers():
+            buffer.extend(events)
+        return buffer
+
+    def keys(self):
+        return self.load().keys()
+
+    def __getitem__(self, column):
+        return self.load()[column]
+
+    def to_dict(self):
+        return self.load().to_dict()
+
+    def to_dataframe(self):
+        return self.load().to_dataframe()
+
+    def __len__(self):
+        # Counted from the chunk headers, without decompressing any events
+        self.flush()
+        return sum(_count_events(path) for _, path in _segment_paths(self.directory))
+
+
+class SpillingBuffer(SegmentDirectory):
+    """Record monitored calls in bounded memory, a background thread spilling them to rotating segment files.
+
+    Recording threads append rows to their own pending deque, without taking any lock, and hand every FLUSH_SIZE rows
+    to a queue of at most `queue_size` batches; a daemon writer thread drains that queue, and every `interval` seconds
+    the rows still pending in every thread, into `segment-<pid>-<sequence>.bin` files of the directory. Monitored code
+    never touches the disk: when the writer falls behind, policy 'drop' discards the batch (counted in `dropped`) and
+    policy 'block' waits for room in the queue. A segment is closed once it reaches `segment_size` bytes, and with
+    `max_segments` the oldest segments of the process are deleted beyond that many.
+
+    Events still buffered are written by `close()`, called at process exit. As with FileSink, the writer is started
+    again in a forked child on its first event, so a buffer created before forking workers collects all of them.
+    """
+
+    def __init__(self, directory, policy='drop', queue_size=64, interval=1.0, segment_size=64 << 20, max_segments=None,
+                 compression_level=1):
+        if policy not in SPILL_POLICIES:
+            raise ValueError(f"Unknown policy {policy!r}, available options: {', '.join(SPILL_POLICIES)}")
+        super().__init__(directory)
+        os.makedirs(directory, exist_ok=True)
+        self.policy = policy
+        self.queue_size = queue_size
+        self.interval = interval
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.compression_level = compression_level
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._open()
+
+    def _open(self):
+        # (Re)initialize the per-process state; called again in a forked child, where the writer thread is gone.
+        self._pid = os.getpid()
+        self._pending = _ThreadShards(_PendingRows)
+        self._queue = queue.Queue(self.queue_size)
+        self._write_lock = threading.Lock()
+        self._segment = None
+        self._sequence = 0
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name="pygraphprofiler-spill", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+        from multiprocessing import util
+
+        # multiprocessing children leave through os._exit, which skips atexit but runs these finalizers
+        util.Finalize(self, self.close, exitpriority=10)
+
+    def append(self, task, parent_task, start_time, end_time, extra=None):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._open()
+        pending = self._pending.get()
+        pending.append((task, parent_task, start_time, end_time, extra))
+        if len(pending) >= FLUSH_SIZE:
+            self._enqueue(_drain(pending), pending.thread_id)
+
+    def _enqueue(self, rows, thread_id):
+        if not rows:
+            return
+        if not self._closed:
+            if self.policy == 'block':
+                self._queue.put((rows, thread_id))
+                return
+            try:
+                self._queue.put_nowait((rows, thread_id))
+                return
+            except queue.Full:
+                pass
+        # Dropped, or recorded after close() (e.g. during interpreter shutdown)
+        with self._lock:
+            self.dropped += len(rows)
+
+    def _run(self):
+        # Bound here, as a forked child replaces the queue and starts its own writer
+        batches_queue = self._queue
+        last_drain = time.monotonic()
+        while True:
+            try:
+                item = batches_queue.get(timeout=self.interval)
+            except queue.Empty:
+                item = None
+            batches, requests, stopping = [], [], False
+            while item is not None:
+                if item is _STOP:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    requests.append(item)
+                else:
+                    batches.append(item)
+                try:
+                    item = batches_queue.get_nowait()
+                except queue.Empty:
+                    item = None
+            if requests or time.monotonic() - last_drain >= self.interval:
+                batches += self._drain_threads()
+                last_drain = time.monotonic()
+            self._write(batches)
+            for request in requests:
+                request.set()
+            if stopping:
+                return
+
+    def _drain_threads(self):
+        # The deques of threads that have ended are drained one last time and dropped
+        pendings = self._pending.remove_dead() + list(self._pending.shards)
+        return [(rows, pending.thread_id) for pending in pendings for rows in [_drain(pending)] if rows]
+
+    def _write(self, batches):
+        if not batches:
+            return
+        events = EventBuffer()
+        for rows, thread_id in batches:
+            events._append_rows(rows, thread_id)
+        events._pad_extras()
+        with self._write_lock:
+            if self._segment is None:
+                path = os.path.join(self.directory, f"segment-{self._pid}-{self._sequence:08d}.bin")
+                self._segment = _Segment(path, self.compression_level)
+                self._sequence += 1
+                if self.max_segments is not None:
+                    own = [path for pid, path in _segment_paths(self.directory) if pid == self._pid]
+                    for old_path in own[:-self.max_segments]:
+                        os.remove(old_path)
+            self._segment.write(events)
+            if self._segment.size >= self.segment_size:
+                self._segment.close()
+                self._segment = None
+
+    def flush(self):
+        """Write every event recorded so far by this process, waiting for the writer thread to do so."""
+        if self._pid != os.getpid() or self._closed:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        while not done.wait(self.interval):
+            if not self._writer.is_alive():
+                break
+
+    def close(self):
+        """Stop the writer thread, write the events still buffered and close the current segment.
+
+        Events recorded afterwards are counted in `dropped`.
+        """
+        if self._pid != os.getpid() or self._closed:
+            return
+        self._closed = True
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+        batches = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, tuple):
+                batches.append(item)
+            elif isinstance(item, threading.Event):
+                item.set()
+        self._write(batches + self._drain_threads())
+        with self._write_lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+
+
+class _Segment:
+    """An open segment file, with the names and columns already written to it."""
+
+    def __init__(self, path, compression_level):
+        self.compression_level = compression_level
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._file.flush()
+        self._name_ids = {}
+        self._specs = None
+        self.size = len(MAGIC)
+
+    def write(self, events):
+        new_names = [name for name in events.names if name not in self._name_ids]
+        if new_names:
+            for name in new_names:
+                self._name_ids[name] = len(self._name_ids)
+            self._write_chunk(b'NAME', len(new_names), _encode_names(new_names))
+        columns = events.keys()
+        specs = [f"{column}:{_column_values(events, column).typecode}" for column in columns]
+        if specs != self._specs:
+            self._write_chunk(b'COLS', len(specs), '\n'.join(specs).encode('utf-8'))
+            self._specs = specs
+        # Map the batch's name ids onto the segment's
+        id_map = [self._name_ids[name] for name in events.names]
+        payload = b''.join(_le_bytes(array('q', [id_map[i] if i >= 0 else -1 for i in ids]))
+                           for ids in (events.task_ids, events.parent_ids))
+        payload += b''.join(_le_bytes(_column_values(events, column)) for column in columns[2:])
+        self._write_chunk(b'EVTS', len(events.task_ids), payload)
+        # Hand complete chunks over to the OS, for readers of the directory
+        self._file.flush()
+
+    def _write_chunk(self, tag, count, payload):
+        payload = zlib.compress(payload, self.compression_level)
+        self._file.write(CHUNK.pack(tag, count, len(payload)) + payload)
+        self.size += CHUNK.size + len(payload)
+
+    def close(self):
+        self._file.close()
+
+
+def _drain(pending):
+    # The writer thread drains every thread's deque too: popleft is atomic, so each row is taken exactly once
+    rows = []
+    try:
+        for _ in range(len(pending)):
+            rows.append(pending.popleft())
+    except IndexError:
+        pass
+    return rows
+
+
+def _segment_paths(directory):
+    """Return (pid, path) for the segment files in `directory`, in order of pid then sequence."""
+    segments = []
+    for path in glob.glob(os.path.join(directory, "segment-*-*.bin")):
+        pid, sequence = os.path.basename(path)[len("segment-"):-len(".bin")].split('-')
+        segments.append((int(pid), int(sequence), path))
+    return [(pid, path) for pid, _, path in sorted(segments)]
+
+
+def _count_events(path):
+    n_events = 0
+    try:
+        with open(path, 'rb') as file:
+            file_size = os.fstat(file.fileno()).st_size
+            offset = file.seek(len(MAGIC))
+            while offset + CHUNK.size <= file_size:
+                tag, count, size = CHUNK.unpack(file.read(CHUNK.size))
+                offset += CHUNK.size + size
+                if offset > file_size:
+                    break
+                if tag == b'EVTS':
+                    n_events += count
+                file.seek(offset)
+    except FileNotFoundError:
+        pass
+    return n_events
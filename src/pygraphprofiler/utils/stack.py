@@ -0,0 +1,109 @@
+import contextvars
+import hashlib
+import re
+import sys
+
+
+# Path id of the (empty) calling context of top-level monitored calls.
+ROOT_PATH_ID = 0
+
+# Innermost active monitored call as an immutable linked list of frames (task, parent_frame, depth, path_id,
+# child_time), where child_time is a list [time spent in monitored children, start, end of the span they last covered],
+# see _charge_parent. Living in a
+# ContextVar, the stack is private to each thread and to each asyncio task, which inherits a snapshot of its
+# creator's stack.
+_call_stack = contextvars.ContextVar('pygraphprofiler_call_stack', default=None)
+
+_path_ids = {}
+# code object -> task name, see _code_name
+_code_names = {}
+_MODULE_PREFIX = re.compile(r'^[\w.]+:(?=[\w<])')
+
+
+def _current_frame():
+    """Return the innermost active monitored frame in the current context, or None."""
+    return _call_stack.get()
+
+
+def _current_task():
+    """Return the name of the innermost active monitored call in the current context, or None."""
+    frame = _call_stack.get()
+    return frame[0] if frame is not None else None
+
+
+def _push_task(task: str):
+    """Enter a monitored call, returning its frame and the token to pass to _pop_task."""
+    parent = _call_stack.get()
+    if parent is None:
+        frame = (task, None, 0, _path_id(ROOT_PATH_ID, task), [0, 0, 0])
+    else:
+        frame = (task, parent, parent[2] + 1, _path_id(parent[3], task), [0, 0, 0])
+    return frame, _call_stack.set(frame)
+
+
+def _pop_task(token: contextvars.Token):
+    _call_stack.reset(token)
+
+
+def _charge_parent(parent_frame, start_time, end_time, weight=1):
+    """Add a child call from start_time to end_time to the child time of its parent frame, `weight` times.
+
+    Children of a coroutine run concurrently when started with asyncio.gather: the time during which a child overlaps
+    the span covered by the previous ones is only charged once, so that the parent's self time never goes negative.
+    Sequential children never overlap and are charged in full.
+    """
+    child_time = parent_frame[4]
+    _, covered_start, covered_end = child_time
+    if start_time >= covered_end or end_time <= covered_start:
+        charged = end_time - start_time
+        child_time[1], child_time[2] = start_time, end_time
+    else:
+        charged = end_time - start_time - (min(end_time, covered_end) - max(start_time, covered_start))
+        child_time[1], child_time[2] = min(start_time, covered_start), max(end_time, covered_end)
+    child_time[0] += weight * charged
+
+
+def _path_id(parent_path_id: int, task: str):
+    """Return the id of the calling context reached by calling `task` from `parent_path_id`.
+
+    Ids are derived from a hash of the path rather than allocated, so they agree across processes and captures.
+    """
+    key = (parent_path_id, task)
+    path_id = _path_ids.get(key)
+    if path_id is None:
+        digest = hashlib.blake2b(f"{parent_path_id}/{task}".encode('utf-8'), digest_size=8).digest()
+        path_id = _path_ids[key] = int.from_bytes(digest, 'little', signed=True)
+    return path_id
+
+
+def _task_name(func):
+    """Return the task name of a function: its module and qualified name, e.g. 'app.models:User.save'.
+
+    Qualified names tell apart methods of different classes and functions of different modules sharing a name.
+    """
+    qualname = getattr(func, '__qualname__', None) or func.__name__
+    module = getattr(func, '__module__', None)
+    return qualname if module is None else f"{module}:{qualname}"
+
+
+def _code_name(code, module: str):
+    """Return the task name of the function running `code` in `module`, as _task_name of that function."""
+    name = _code_names.get(code)
+    if name is None:
+        # co_qualname is new in Python 3.11
+        qualname = getattr(code, 'co_qualname', code.co_name)
+        name = _code_names[code] = qualname if module is None else f"{module}:{qualname}"
+    return name
+
+
+def _caller_name(depth: int):
+    """Return the task name of the frame `depth` levels above the caller, in constant time."""
+    frame = sys._getframe(depth + 1)
+    return _code_name(frame.f_code, frame.f_globals.get('__name__'))
+
+
+def _short_name(task: str):
+    """Return a task name without its module and enclosing functions, e.g. 'User.save', for labels."""
+    # Only a module prefix is removed: block names are free text
+    name = _MODULE_PREFIX.sub('', str(task), count=1)
+    return name.rsplit('<locals>.', 1)[-1]
@@ -0,0 +1,177 @@
+import glob
+import json
+import os
+
+from .aggregate import AggregateBuffer
+from .sink import RECORD, RECORD_DTYPE, FileSink, _read_names
+from .spill import SegmentDirectory
+from .stack import ROOT_PATH_ID
+
+
+# Number of events read at once by the exporters: their memory is bounded by one chunk plus one entry per distinct
+# calling context (collapsed stacks) or nothing at all (Chrome trace), however many events were recorded.
+CHUNK_SIZE = 65536
+
+
+def write_collapsed_stacks(data, path, chunk_size=CHUNK_SIZE):
+    """Write the self time of every calling context in collapsed-stack format, one `root;caller;callee <ns>` line each.
+
+    The output is read by flamegraph.pl and speedscope. Calling contexts come from the `path_id` column; events recorded
+    without one are attributed to a two-level `parent_task;task` stack. Times are weighted nanoseconds.
+    """
+    import numpy as np
+
+    _check_events(data)
+    # path_id -> [parent_path_id, task, self time]
+    paths = {}
+    # (parent_task, task) -> self time, for events without a calling context
+    pairs = {}
+    for names, columns in _event_chunks(data, chunk_size):
+        exec_times = columns['end_time'] - columns['start_time']
+        self_times = columns.get('self_time', exec_times)
+        # The sink stores -1 for events recorded without a self time
+        self_times = np.where(self_times < 0, exec_times, self_times) * columns.get('weight', 1.0)
+        path_ids = columns.get('path_id', np.zeros_like(exec_times))
+        has_path = (path_ids != ROOT_PATH_ID) & (path_ids != -1)
+        unique_paths, first, inverse = np.unique(path_ids[has_path], return_index=True, return_inverse=True)
+        totals = np.bincount(inverse, weights=self_times[has_path], minlength=len(unique_paths))
+        tasks = columns['task'][has_path][first]
+        parent_path_ids = columns.get('parent_path_id', path_ids)[has_path][first]
+        for path_id, parent_path_id, task, total in zip(
+                unique_paths.tolist(), parent_path_ids.tolist(), tasks.tolist(), totals.tolist()):
+            entry = paths.get(path_id)
+            if entry is None:
+                paths[path_id] = [parent_path_id, names[task], total]
+            else:
+                entry[2] += total
+        no_path = ~has_path
+        for parent_task, task, self_time in zip(
+                columns['parent_task'][no_path].tolist(), columns['task'][no_path].tolist(), self_times[no_path].tolist()):
+            key = (names[parent_task] if parent_task >= 0 else None, names[task])
+            pairs[key] = pairs.get(key, 0) + self_time
+
+    stacks = {}
+
+    def stack(path_id):
+        # Iterative, as call paths can be deeper than the recursion limit
+        chain = []
+        while path_id in paths and path_id not in stacks:
+            chain.append(path_id)
+            path_id = paths[path_id][0]
+        prefix = stacks.get(path_id)
+        for path_id in reversed(chain):
+            frame = _frame_name(paths[path_id][1])
+            prefix = stacks[path_id] = frame if prefix is None else f"{prefix};{frame}"
+        return prefix
+
+    with open(path, 'w') as stacks_file:
+        for path_id, (_, _, total) in paths.items():
+            if round(total) > 0:
+                stacks_file.write(f"{stack(path_id)} {round(total)}\n")
+        for (parent_task, task), total in pairs.items():
+            if round(total) > 0:
+                frames = [_frame_name(task)] if parent_task is None else [_frame_name(parent_task), _frame_name(task)]
+                stacks_file.write(f"{';'.join(frames)} {round(total)}\n")
+
+
+def write_chrome_trace(data, path, chunk_size=CHUNK_SIZE):
+    """Write every event as a complete ('X') event of the Chrome Trace Event format, one track per process and thread.
+
+    The output opens in Perfetto (ui.perfetto.dev) and chrome://tracing. Events are written as they are read, so the
+    file can be far larger than memory.
+    """
+    _check_events(data)
+    pid = os.getpid()
+    with open(path, 'w') as trace_file:
+        trace_file.write('{"displayTimeUnit": "ns", "traceEvents": [')
+        separator = '\n'
+        quoted, quoted_names = [], None
+        for names, columns in _event_chunks(data, chunk_size):
+            n_events = len(columns['task'])
+            # Names are quoted once, chunks of a buffer sharing its growing name table
+            if names is not quoted_names:
+                quoted, quoted_names = [], names
+            quoted += [json.dumps(name) for name in names[len(quoted):]]
+            weights = columns.get('weight')
+            self_times = columns.get('self_time')
+            rows = zip(
+                columns['task'].tolist(),
+                (columns['start_time'] / 1e3).tolist(),
+                ((columns['end_time'] - columns['start_time']) / 1e3).tolist(),
+                columns['pid'].tolist() if 'pid' in columns else [pid] * n_events,
+                columns['thread_id'].tolist() if 'thread_id' in columns else [0] * n_events,
+                (self_times / 1e3).tolist() if self_times is not None else [-1] * n_events,
+                weights.tolist() if weights is not None else [1] * n_events,
+            )
+            lines = []
+            for task, start, duration, event_pid, thread_id, self_time, weight in rows:
+                args = f'"self_time_us": {self_time:.3f}' if self_time >= 0 else ''
+                if weight != 1:
+                    args += f'{", " if args else ""}"weight": {weight!r}'
+                lines.append(f'{{"name": {quoted[task]}, "ph": "X", "ts": {start:.3f}, "dur": {duration:.3f}, '
+                             f'"pid": {event_pid}, "tid": {thread_id}, "args": {{{args}}}}}')
+            if lines:
+                trace_file.write(separator + ',\n'.join(lines))
+                separator = ',\n'
+        trace_file.write('\n]}\n')
+
+
+def _check_events(data):
+    if isinstance(data, AggregateBuffer):
+        raise ValueError("Flame graphs and traces can only be written in 'events' mode")
+
+
+def _frame_name(name):
+    # ';' separates frames and the last space the value in collapsed stacks
+    return str(name).replace(';', ':').replace('\n', ' ')
+
+
+def _event_chunks(data, chunk_size):
+    """Yield (names, columns) for successive chunks of at most chunk_size events, columns being numpy arrays.
+
+    Task and parent task columns hold indices into names, -1 for a missing name; names may hold more names than the
+    chunk refers to, as chunks share their source's name table. In-memory buffers are copied one chunk at a time, so
+    recording can go on meanwhile; sink directories are read straight from their memory-mapped files, and segment
+    directories one segment at a time.
+    """
+    import numpy as np
+
+    if isinstance(data, FileSink):
+        data.flush()
+        yield from _sink_chunks(data.directory, chunk_size)
+        return
+    if isinstance(data, SegmentDirectory):
+        for events in data.buffers():
+            yield from _event_chunks(events, chunk_size)
+        return
+    n_events = len(data)
+    for start in range(0, n_events, chunk_size):
+        # Chunks share the buffer's name table, which only grows, rather than each copying it
+        events = data.slice(start, min(start + chunk_size, n_events), share_names=True)
+        columns = {
+            'task': np.frombuffer(events.task_ids, dtype=np.int64),
+            'parent_task': np.frombuffer(events.parent_ids, dtype=np.int64),
+            'start_time': np.frombuffer(events.start_times, dtype=np.int64),
+            'end_time': np.frombuffer(events.end_times, dtype=np.int64),
+            **{column: np.frombuffer(values, dtype=values.typecode) for column, values in events.extras.items()},
+        }
+        yield events.names, columns
+
+
+def _sink_chunks(directory, chunk_size):
+    import numpy as np
+
+    for events_path in sorted(glob.glob(os.path.join(directory, "events-*.bin"))):
+        pid = int(os.path.basename(events_path)[len("events-"):-len(".bin")])
+        n_records = os.path.getsize(events_path) // RECORD.size
+        if n_records == 0:
+            continue
+        names = _read_names(directory, pid)
+        records = np.memmap(events_path, dtype=RECORD_DTYPE, mode='r', shape=(n_records,))
+        for start in range(0, n_records, chunk_size):
+            chunk = records[start:start + chunk_size]
+            columns = {column: np.ascontiguousarray(chunk[column]).astype(np.float64 if column == 'weight' else np.int64)
+                       for column, _ in RECORD_DTYPE}
+            columns['pid'] = np.full(len(chunk), pid, dtype=np.int64)
+            yield names, columns
+        del records
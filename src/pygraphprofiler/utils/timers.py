@@ -0,0 +1,22 @@
+import time
+
+
+# Integer nanosecond clocks: 'perf_counter' measures wall time, 'process_time'
+# and 'thread_time' measure CPU time only.
+TIMERS = {
+    'perf_counter': time.perf_counter_ns,
+    'process_time': time.process_time_ns,
+    'thread_time': time.thread_time_ns,
+}
+
+DEFAULT_TIMER = 'perf_counter'
+
+
+def _get_timer(timer):
+    """Resolve a timer name from TIMERS, or a zero-argument callable returning integer nanoseconds."""
+    if callable(timer):
+        return timer
+    try:
+        return TIMERS[timer]
+    except KeyError:
+        raise ValueError(f"Unknown timer {timer!r}, available options: {', '.join(TIMERS)}") from None
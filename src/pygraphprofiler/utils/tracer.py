@@ -0,0 +1,180 @@
+import sys
+import threading
+
+from .stack import _call_stack, _code_name, _current_frame, _push_task
+
+
+# Modules of this package are never traced, so that the profiler does not record itself
+_PACKAGE = __name__.rsplit('.', 2)[0]
+
+# Placeholder for code objects not classified yet in Tracer._tasks
+_UNKNOWN = object()
+
+
+class Tracer:
+    """Record every Python function call and return while active, without decorating anything.
+
+    On Python 3.12+ calls are observed through `sys.monitoring`, in every thread; code objects left out by the filters
+    are switched off at the interpreter level after their first call, so they cost (almost) nothing afterwards. On older
+    versions the tracer falls back to `sys.setprofile`, in the thread that starts it and the threads started while it
+    is active. Calls are pushed on the same call stack as monitored calls and recorded with `record`, so traced and
+    decorated calls nest in a single graph; calls made through a `monitor` decorator are left to the decorator.
+
+    `include` and `exclude` are module or package names: a package name matches every module below it. A function is
+    traced when its module matches some `include` name (any module if None) and no `exclude` name.
+    """
+
+    def __init__(self, profiling_data, record, timer, include=None, exclude=None):
+        self.profiling_data = profiling_data
+        self._record = record
+        self.timer = timer
+        self.include = _as_names(include)
+        self.exclude = (_as_names(exclude) or ()) + (_PACKAGE,)
+        # code -> task name, or None for code left out by the filters
+        self._tasks = {}
+        self._local = threading.local()
+        self._active = False
+
+    def start(self):
+        if self._active:
+            raise RuntimeError("Tracer already started")
+        self._active = True
+        if hasattr(sys, 'monitoring'):
+            self._start_monitoring()
+        else:
+            threading.setprofile(self._profile)
+            sys.setprofile(self._profile)
+        return self
+
+    def stop(self):
+        if not self._active:
+            return
+        self._active = False
+        if hasattr(sys, 'monitoring'):
+            self._stop_monitoring()
+        else:
+            # Threads still running with the hook remove it on their next event
+            sys.setprofile(None)
+            threading.setprofile(None)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _classify(self, code, module):
+        if not _matches(module, self.include, self.exclude):
+            task = None
+        else:
+            task = _code_name(code, module)
+        self._tasks[code] = task
+        return task
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            return stack
+
+    def _enter(self, key, task, caller):
+        parent = _current_frame()
+        if parent is not None:
+            # A call made by a monitor wrapper, which has just pushed the frame of the same task, is recorded by it
+            if parent[0] == task and caller is not None and _matches(caller.f_globals.get('__name__', ''), (_PACKAGE,), ()):
+                return
+            parent_task = parent[0]
+        else:
+            parent_task = _code_name(caller.f_code, caller.f_globals.get('__name__')) if caller is not None else None
+        frame, _ = _push_task(task)
+        self._stack().append((key, frame, parent_task, self.timer()))
+
+    def _exit(self, key):
+        end_time = self.timer()
+        stack = self._stack()
+        # Returns from calls entered before the tracer started have no entry
+        if not stack or stack[-1][0] is not key:
+            return
+        _, frame, parent_task, start_time = stack.pop()
+        _call_stack.set(frame[1])
+        self._record(self.profiling_data, frame, parent_task, start_time, end_time, None, 1)
+
+    # sys.setprofile backend, keyed by frame: generators report a call on every resume and a return on every yield
+
+    def _profile(self, frame, event, arg):
+        if not self._active:
+            sys.setprofile(None)
+            return
+        if event == 'call':
+            code = frame.f_code
+            task = self._tasks.get(code, _UNKNOWN)
+            if task is _UNKNOWN:
+                task = self._classify(code, frame.f_globals.get('__name__', ''))
+            if task is not None:
+                self._enter(frame, task, frame.f_back)
+        elif event == 'return':
+            self._exit(frame)
+
+    # sys.monitoring backend, keyed by code object; callbacks run as if called from the instrumented frame
+
+    def _start_monitoring(self):
+        monitoring = sys.monitoring
+        events = monitoring.events
+        try:
+            monitoring.use_tool_id(monitoring.PROFILER_ID, "pygraphprofiler")
+        except ValueError:
+            self._active = False
+            raise RuntimeError("sys.monitoring's profiler tool id is already in use by another tool")
+        for event in (events.PY_START, events.PY_RESUME):
+            monitoring.register_callback(monitoring.PROFILER_ID, event, self._monitoring_start)
+        for event in (events.PY_RETURN, events.PY_YIELD):
+            monitoring.register_callback(monitoring.PROFILER_ID, event, self._monitoring_return)
+        monitoring.register_callback(monitoring.PROFILER_ID, events.PY_UNWIND, self._monitoring_unwind)
+        # Code switched off by an earlier tracer may pass this one's filters
+        monitoring.restart_events()
+        monitoring.set_events(monitoring.PROFILER_ID, events.PY_START | events.PY_RESUME | events.PY_RETURN
+                              | events.PY_YIELD | events.PY_UNWIND)
+
+    def _stop_monitoring(self):
+        monitoring = sys.monitoring
+        events = monitoring.events
+        monitoring.set_events(monitoring.PROFILER_ID, 0)
+        for event in (events.PY_START, events.PY_RESUME, events.PY_RETURN, events.PY_YIELD, events.PY_UNWIND):
+            monitoring.register_callback(monitoring.PROFILER_ID, event, None)
+        monitoring.free_tool_id(monitoring.PROFILER_ID)
+
+    def _monitoring_start(self, code, instruction_offset):
+        task = self._tasks.get(code, _UNKNOWN)
+        if task is _UNKNOWN:
+            task = self._classify(code, sys._getframe(1).f_globals.get('__name__', ''))
+        if task is None:
+            return sys.monitoring.DISABLE
+        self._enter(code, task, sys._getframe(1).f_back)
+
+    def _monitoring_return(self, code, instruction_offset, value):
+        if self._tasks.get(code, _UNKNOWN) is None:
+            return sys.monitoring.DISABLE
+        self._exit(code)
+
+    def _monitoring_unwind(self, code, instruction_offset, exception):
+        # Unwinding is not a local event and cannot be switched off
+        if self._tasks.get(code) is not None:
+            self._exit(code)
+
+
+def _as_names(names):
+    if names is None:
+        return None
+    if isinstance(names, str):
+        return (names,)
+    return tuple(names)
+
+
+def _matches(module, include, exclude):
+    def matches(names):
+        return any(module == name or module.startswith(name + '.') for name in names)
+
+    if include is not None and not matches(include):
+        return False
+    return not matches(exclude)
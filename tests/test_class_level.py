@@ -1,11 +1,31 @@
+import asyncio
+import json
+import importlib.util
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+import urllib.error
+import urllib.request
 import time
-from src.pygraphprofiler import Profiler, merge_profiler_instances, monitor, plot_graph, to_dataframe, to_graph, to_json
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from src.pygraphprofiler import Profiler, diff_profiler_instances, merge_profiler_instances, monitor, plot_graph, to_dataframe, to_graph, to_json
 from src.pygraphprofiler import profiler as profiler_lib
+from src.pygraphprofiler.utils import chunked
+from src.pygraphprofiler import EveryN, MinDuration, Probability, RateLimit
 
 
 class TestClassLevel(unittest.TestCase):
 
+    def task(self, name):
+        # Task name of a function `name` defined in the running test
+        return f"{__name__}:{type(self).__name__}.{self._testMethodName}.<locals>.{name}"
+
     def test_monitor(self):
         profiler = Profiler()
 
@@ -78,6 +98,1204 @@ class TestClassLevel(unittest.TestCase):
         self.assertIn('start_time', df.columns)
         self.assertIn('end_time', df.columns)
 
+    def test_parent_task(self):
+        profiler = Profiler()
+
+        @profiler.monitor
+        def test_func_sub():
+            pass
+
+        def helper():
+            test_func_sub()
+
+        @profiler.monitor
+        def test_func():
+            helper()
+
+        test_func()
+
+        self.assertEqual(profiler.profiling_data["task"], [self.task('test_func_sub'), self.task('test_func')])
+        self.assertEqual(profiler.profiling_data["parent_task"],
+                         [self.task('test_func'), f"{__name__}:TestClassLevel.test_parent_task"])
+
+    def test_timer(self):
+        for timer in ('perf_counter', 'process_time', 'thread_time'):
+            profiler = Profiler(timer=timer)
+
+            @profiler.monitor
+            def test_func():
+                pass
+
+            test_func()
+
+            df = profiler.to_dataframe()
+            self.assertTrue(pd.api.types.is_integer_dtype(df['start_time']))
+            self.assertGreaterEqual(df['end_time'][0], df['start_time'][0])
+            self.assertIsInstance(profiler.to_graph().nodes[self.task('test_func')]['total_exec_time'], int)
+
+        with self.assertRaises(ValueError):
+            Profiler(timer='wall_clock')
+
+    def test_aggregate_mode(self):
+        profiler = Profiler(mode='aggregate')
+
+        @profiler.monitor
+        def test_func_sub():
+            pass
+
+        @profiler.monitor
+        def test_func():
+            test_func_sub()
+            test_func_sub()
+
+        test_func()
+        test_func()
+
+        self.assertEqual(profiler.profiling_data.nodes[self.task('test_func_sub')][0], 4)
+        self.assertEqual(profiler.profiling_data.edges[(self.task('test_func'), self.task('test_func_sub'))], 4)
+
+        graph = profiler.to_graph()
+        self.assertEqual(graph.nodes[self.task('test_func')]['count'], 2)
+        self.assertEqual(graph.edges[self.task('test_func'), self.task('test_func_sub')]['calls'], 4)
+        self.assertLessEqual(graph.nodes[self.task('test_func_sub')]['min_exec_time'], graph.nodes[self.task('test_func_sub')]['max_exec_time'])
+
+        df = profiler.to_dataframe()
+        self.assertEqual(sorted(df['task']), [self.task('test_func'), self.task('test_func_sub')])
+        self.assertIn('average_exec_time', df.columns)
+        self.assertIn('p99_exec_time', df.columns)
+        self.assertIn('p50_exec_time', graph.edges[self.task('test_func'), self.task('test_func_sub')])
+
+        new_profiler = Profiler.from_json(profiler.to_json())
+        self.assertEqual(new_profiler.mode, 'aggregate')
+        self.assertEqual(new_profiler.profiling_data.nodes, profiler.profiling_data.nodes)
+
+        merged_profiler = merge_profiler_instances(profiler, Profiler.from_json(profiler.to_json()))
+        self.assertEqual(merged_profiler.to_graph().nodes[self.task('test_func')]['count'], 4)
+        self.assertEqual(merged_profiler.profiling_data.node_sketches[self.task('test_func_sub')].count, 8)
+
+        filename = "test_aggregate_plot_graph.png"
+        profiler.plot_graph(filename, weight_node_on='p99_exec_time')
+        self.assertTrue(os.path.exists(filename))
+        os.remove(filename)
+
+        # The statistics of threads that have ended are kept in a single shard, whatever the number of threads
+        for _ in range(200):
+            thread = threading.Thread(target=test_func)
+            thread.start()
+            thread.join()
+        self.assertLessEqual(len(profiler.profiling_data._shards.shards), 2)
+        self.assertEqual(profiler.profiling_data.nodes[self.task('test_func')][0], 202)
+        self.assertEqual(profiler.profiling_data.edges[(self.task('test_func'), self.task('test_func_sub'))], 404)
+        self.assertEqual(profiler.profiling_data.node_sketches[self.task('test_func_sub')].count, 404)
+
+    def test_monitor_threads(self):
+        profiler = Profiler()
+
+        @profiler.monitor
+        def test_func_sub():
+            pass
+
+        @profiler.monitor
+        def test_func():
+            for _ in range(100):
+                test_func_sub()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for _ in range(16):
+                executor.submit(test_func)
+
+        df = profiler.to_dataframe()
+        self.assertEqual(len(df), 16 * 101)
+        sub_df = df[df['task'] == self.task('test_func_sub')]
+        self.assertEqual(len(sub_df), 1600)
+        self.assertTrue((sub_df['parent_task'] == self.task('test_func')).all())
+        self.assertTrue((df['end_time'] >= df['start_time']).all())
+
+        # The rows of threads that have ended are kept, their per-thread deques are not
+        for _ in range(200):
+            thread = threading.Thread(target=test_func_sub)
+            thread.start()
+            thread.join()
+        self.assertLessEqual(len(profiler.profiling_data._pending.shards), 2)
+        self.assertEqual(len(profiler.to_dataframe()), 16 * 101 + 200)
+        self.assertLessEqual(len(profiler.profiling_data._pending.shards), 1)
+
+    def test_monitor_async(self):
+        profiler = Profiler()
+
+        @profiler.monitor
+        async def test_func_sub():
+            await asyncio.sleep(0.01)
+            return 'sub'
+
+        @profiler.monitor
+        async def test_func_a():
+            await asyncio.sleep(0.05)
+            return 'a_' + await test_func_sub()
+
+        @profiler.monitor
+        async def test_func_b():
+            return 'b_' + await test_func_sub()
+
+        async def main():
+            return await asyncio.gather(test_func_a(), test_func_b())
+
+        self.assertEqual(asyncio.run(main()), ['a_sub', 'b_sub'])
+
+        df = profiler.to_dataframe().set_index('task')
+        self.assertEqual(sorted(df.loc[self.task('test_func_sub'), 'parent_task']), [self.task('test_func_a'), self.task('test_func_b')])
+        exec_time = df['end_time'] - df['start_time']
+        self.assertGreaterEqual(exec_time[self.task('test_func_a')], 0.05 * 1e9)
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), "requires the fork start method")
+    def test_sink(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(sink=directory)
+
+            @profiler.monitor
+            def test_func_sub():
+                pass
+
+            @profiler.monitor
+            def test_func():
+                test_func_sub()
+
+            def worker():
+                for _ in range(10):
+                    test_func()
+
+            context = multiprocessing.get_context('fork')
+            processes = [context.Process(target=worker) for _ in range(3)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            test_func()
+            profiler.profiling_data.flush()
+
+            df = Profiler.from_sink(directory).to_dataframe()
+            self.assertEqual(len(df), 3 * 20 + 2)
+            self.assertEqual(df['pid'].nunique(), 4)
+            self.assertEqual(sorted(df['worker'].unique()), [0, 1, 2, 3])
+            self.assertTrue((df.loc[df['task'] == self.task('test_func_sub'), 'parent_task'] == self.task('test_func')).all())
+
+            graph = profiler.to_graph()
+            self.assertEqual(graph.nodes[self.task('test_func')]['count'], 31)
+            self.assertEqual(graph.edges[self.task('test_func'), self.task('test_func_sub')]['calls'], 31)
+
+        # Names may contain newlines, and rows recorded by threads that have ended are written too
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(sink=directory)
+            with profiler.block("first\nblock"):
+                with profiler.block("second"):
+                    pass
+
+            def record():
+                with profiler.block("thread"):
+                    pass
+
+            for _ in range(50):
+                thread = threading.Thread(target=record)
+                thread.start()
+                thread.join()
+            profiler.profiling_data.flush()
+            self.assertLessEqual(len(profiler.profiling_data._pending.shards), 1)
+            df = Profiler.from_sink(directory).to_dataframe()
+            self.assertEqual(df['task'].astype(object).value_counts().to_dict(), {'thread': 50, 'second': 1, 'first\nblock': 1})
+            self.assertEqual(df.loc[df['task'] == 'second', 'parent_task'].tolist(), ['first\nblock'])
+            self.assertEqual(profiler.to_graph().nodes['thread']['count'], 50)
+
+    def test_spill(self):
+        from src.pygraphprofiler import SpillingBuffer
+        from src.pygraphprofiler.utils.recorder import FLUSH_SIZE
+
+        for policy in ('drop', 'block'):
+            with tempfile.TemporaryDirectory() as directory:
+                spill = SpillingBuffer(directory, policy=policy, queue_size=1, interval=0.01)
+                profiler = Profiler(spill=spill)
+
+                @profiler.monitor
+                def test_func():
+                    pass
+
+                def record():
+                    for _ in range(4 * FLUSH_SIZE):
+                        test_func()
+
+                # Stall the writer thread: once it holds its batches and another waits in the queue, the rest are
+                # either dropped or waited for
+                with spill._write_lock:
+                    recorder = threading.Thread(target=record)
+                    recorder.start()
+                    recorder.join(timeout=1)
+                    if policy == 'block':
+                        self.assertTrue(recorder.is_alive())
+                        self.assertEqual(spill.dropped, 0)
+                    else:
+                        self.assertFalse(recorder.is_alive())
+                        self.assertIn(spill.dropped, (FLUSH_SIZE, 2 * FLUSH_SIZE, 3 * FLUSH_SIZE))
+                recorder.join()
+                test_func()
+                spill.close()
+
+                n_events = 4 * FLUSH_SIZE + 1 - spill.dropped
+                self.assertEqual(len(spill), n_events)
+                new_profiler = Profiler.from_segments(directory)
+                self.assertEqual(new_profiler.to_graph().nodes[self.task('test_func')]['count'], n_events)
+                df = new_profiler.to_dataframe()
+                self.assertEqual(len(df), n_events)
+                self.assertEqual(df['pid'].unique().tolist(), [os.getpid()])
+                self.assertEqual(df['thread_id'].nunique(), 2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Every write fills a segment; only the last two are kept
+            spill = SpillingBuffer(directory, segment_size=1, max_segments=2)
+            profiler = Profiler(spill=spill)
+
+            @profiler.monitor
+            def test_func():
+                pass
+
+            for _ in range(4):
+                test_func()
+                spill.flush()
+            self.assertEqual([os.path.basename(path) for path in spill.segments()],
+                             [f"segment-{os.getpid()}-00000002.bin", f"segment-{os.getpid()}-00000003.bin"])
+            self.assertEqual(len(profiler.profiling_data), 2)
+            self.assertEqual(profiler.to_graph().nodes[self.task('test_func')]['count'], 2)
+            spill.close()
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Batches spilled to one segment with different extra columns
+            spill = SpillingBuffer(directory)
+            profiler = Profiler(spill=spill)
+
+            @profiler.monitor
+            def test_func():
+                pass
+
+            @profiler.monitor(sampling=EveryN(1))
+            def test_func_sampled():
+                pass
+
+            test_func()
+            spill.flush()
+            test_func_sampled()
+            spill.flush()
+            test_func()
+            # Deques of threads that have ended are dropped once spilled
+            for _ in range(50):
+                thread = threading.Thread(target=test_func)
+                thread.start()
+                thread.join()
+            spill.flush()
+            self.assertLessEqual(len(spill._pending.shards), 1)
+            spill.close()
+            self.assertEqual(len(spill.segments()), 1)
+            df = Profiler.from_segments(directory).to_dataframe()
+            self.assertEqual(df['task'].tolist(), [self.task('test_func'), self.task('test_func_sampled')]
+                             + [self.task('test_func')] * 51)
+            self.assertEqual(df['weight'].tolist(), [1.0] * 53)
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Names may contain newlines, in every segment holding them
+            spill = SpillingBuffer(directory, segment_size=1)
+            profiler = Profiler(spill=spill)
+            for _ in range(2):
+                with profiler.block("first\nblock"):
+                    with profiler.block("second"):
+                        pass
+                spill.flush()
+            spill.close()
+            self.assertEqual(len(spill.segments()), 2)
+            df = Profiler.from_segments(directory).to_dataframe()
+            self.assertEqual(df['task'].tolist(), ["second", "first\nblock"] * 2)
+            self.assertEqual(df['parent_task'].tolist()[::2], ["first\nblock"] * 2)
+
+        with self.assertRaises(ValueError):
+            SpillingBuffer(directory, policy='wait')
+        with self.assertRaises(ValueError):
+            Profiler(spill=directory, mode='aggregate')
+
+    def test_to_file_from_file(self):
+        formats = ['binary']
+        if importlib.util.find_spec('pyarrow') is not None:
+            formats.append('parquet')
+        for format in formats:
+            profiler = Profiler()
+
+            @profiler.monitor
+            def test_func_sub():
+                pass
+
+            @profiler.monitor
+            def test_func():
+                test_func_sub()
+
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'profile')
+                with profiler.stream_to_file(path, format=format) as writer:
+                    test_func()
+                    self.assertEqual(writer.write(), 2)
+                    self.assertEqual(writer.write(), 0)
+                    test_func()
+                new_profiler = Profiler.from_file(path)
+
+                self.assertEqual(new_profiler.profiling_data.to_dict(), profiler.profiling_data.to_dict())
+
+                profiler.profiling_data.set_extra('pid', [1, 2, 3, 4])
+                profiler.to_file(path, format=format)
+                self.assertEqual(Profiler.from_file(path).profiling_data['pid'], [1, 2, 3, 4])
+
+                # Columns first recorded between two writes read as their default for the events written before
+                profiler = Profiler()
+
+                @profiler.monitor
+                def test_func_plain():
+                    pass
+
+                @profiler.monitor(sampling=EveryN(1), key=lambda: 'key')
+                def test_func_sampled():
+                    pass
+
+                @profiler.monitor(memory=True)
+                def test_func_measured():
+                    return bytearray(1000)
+
+                with profiler.stream_to_file(path, format=format) as writer:
+                    test_func_plain()
+                    writer.write()
+                    test_func_sampled()
+                    writer.write()
+                    test_func_measured()
+                data = Profiler.from_file(path).profiling_data
+                self.assertEqual(data['task'], [self.task(name) for name in
+                                                ('test_func_plain', 'test_func_sampled', 'test_func_measured')])
+                self.assertEqual(data['weight'], [1.0, 1.0, 1.0])
+                self.assertEqual(data['alloc_bytes'][:2], [0, 0])
+                self.assertGreater(data['peak_alloc_bytes'][2], 0)
+
+                # An empty profile still round trips
+                Profiler().to_file(path, format=format)
+                self.assertEqual(len(Profiler.from_file(path).profiling_data), 0)
+                self.assertEqual(len(Profiler.from_file(path).to_dataframe()), 0)
+                self.assertEqual(os.listdir(directory), ['profile'])
+
+                # Names may contain newlines
+                profiler = Profiler()
+                with profiler.block("first\nblock"):
+                    with profiler.block("second"):
+                        pass
+                profiler.to_file(path, format=format)
+                data = Profiler.from_file(path).profiling_data
+                self.assertEqual(data['task'], ["second", "first\nblock"])
+                self.assertEqual(data['parent_task'][0], "first\nblock")
+                graph = Profiler.graph_from_files(path)
+                self.assertEqual(graph.edges["first\nblock", "second"]['calls'], 1)
+
+    def test_sampling(self):
+        for mode in ('events', 'aggregate'):
+            profiler = Profiler(mode=mode)
+
+            @profiler.monitor(sampling=EveryN(10))
+            def test_func_sub():
+                pass
+
+            @profiler.monitor
+            def test_func():
+                for _ in range(100):
+                    test_func_sub()
+
+            for _ in range(10):
+                test_func()
+
+            graph = profiler.to_graph()
+            self.assertEqual(graph.nodes[self.task('test_func_sub')]['count'], 1000)
+            self.assertEqual(graph.edges[self.task('test_func'), self.task('test_func_sub')]['calls'], 1000)
+            if mode == 'events':
+                self.assertEqual(len(profiler.profiling_data), 100 + 10)
+
+    def test_sampling_policies(self):
+        policy = EveryN(3)
+        self.assertEqual([policy.before() for _ in range(6)], [3.0, None, None, 3.0, None, None])
+
+        self.assertEqual(Probability(0.25).after(4.0, 100), 4.0)
+        self.assertIn(Probability(0.25).before(), (None, 4.0))
+
+        policy = RateLimit(rate=0, burst=2)
+        self.assertEqual([policy.before() for _ in range(4)], [1.0, 1.0, None, None])
+
+        policy = MinDuration(threshold=1000)
+        self.assertEqual(policy.after(1.0, 5000), 1.0)
+        self.assertEqual(policy.after(1.0, 0), 0)
+        weights = [policy.after(1.0, 100) for _ in range(10000)]
+        self.assertTrue(all(weight in (0, 10.0) for weight in weights))
+        self.assertAlmostEqual(sum(weights) / len(weights), 1.0, delta=0.3)
+
+    def test_self_time_and_call_tree(self):
+        for mode in ('events', 'aggregate'):
+            clock = [0]
+            profiler = Profiler(timer=lambda: clock[0], mode=mode)
+
+            @profiler.monitor
+            def test_func_leaf():
+                clock[0] += 10
+
+            @profiler.monitor
+            def test_func_mid():
+                clock[0] += 5
+                test_func_leaf()
+
+            @profiler.monitor
+            def test_func():
+                clock[0] += 1
+                test_func_mid()
+                test_func_leaf()
+
+            test_func()
+
+            graph = profiler.to_graph()
+            self.assertEqual(graph.nodes[self.task('test_func')]['total_exec_time'], 26)
+            self.assertEqual(graph.nodes[self.task('test_func')]['total_self_time'], 1)
+            self.assertEqual(graph.nodes[self.task('test_func_mid')]['total_self_time'], 5)
+            self.assertEqual(graph.nodes[self.task('test_func_leaf')]['total_self_time'], 20)
+
+            tree = profiler.to_call_tree()
+            self.assertEqual(tree.number_of_nodes(), 4)
+            self.assertEqual(tree.number_of_edges(), 3)
+            leaves = [node for node in tree.nodes.values() if node['task'] == self.task('test_func_leaf')]
+            self.assertEqual(sorted(node['depth'] for node in leaves), [1, 2])
+            self.assertEqual([node['total_exec_time'] for node in leaves], [10, 10])
+            root, = [path_id for path_id, node in tree.nodes.items() if node['task'] == self.task('test_func')]
+            self.assertEqual(tree.in_degree(root), 0)
+            self.assertEqual(tree.out_degree(root), 2)
+
+        # Children run concurrently with asyncio.gather only charge their parent once for the time they overlap
+        profiler = Profiler()
+
+        @profiler.monitor
+        async def test_func_child(delay):
+            await asyncio.sleep(delay)
+
+        @profiler.monitor
+        async def test_func_gather():
+            await asyncio.gather(test_func_child(0.05), test_func_child(0.03), test_func_child(0.04))
+            await test_func_child(0.01)
+
+        asyncio.run(test_func_gather())
+        df = profiler.to_dataframe().set_index('task')
+        self.assertGreaterEqual(df.loc[self.task('test_func_gather'), 'self_time'], 0)
+        self.assertLess(df.loc[self.task('test_func_gather'), 'self_time'], 0.02 * 1e9)
+        self.assertGreaterEqual(df['self_time'].min(), 0)
+
+    def test_incremental_graph(self):
+        profiler = Profiler()
+
+        @profiler.monitor
+        def test_func_sub():
+            pass
+
+        @profiler.monitor
+        def test_func():
+            test_func_sub()
+            test_func_sub()
+
+        test_func()
+        graph = profiler.to_graph()
+        self.assertEqual(graph.graph['version'], 1)
+        self.assertEqual(graph.graph['events'], 3)
+        graph.nodes[self.task('test_func')]['count'] = 100
+        self.assertEqual(profiler.to_graph().nodes[self.task('test_func')]['count'], 1)
+        self.assertEqual(profiler.to_graph().graph['version'], 1)
+
+        for _ in range(3):
+            test_func()
+            graph = profiler.to_graph()
+        self.assertEqual(graph.graph['version'], 4)
+        rebuilt = Profiler._to_graph(profiler.profiling_data)
+        self.assertEqual(dict(graph.nodes(data=True)), dict(rebuilt.nodes(data=True)))
+        self.assertEqual({(parent, node): attributes for parent, node, attributes in graph.edges(data=True)},
+                         {(parent, node): attributes for parent, node, attributes in rebuilt.edges(data=True)})
+        self.assertEqual(graph.nodes[self.task('test_func_sub')]['count'], 8)
+        self.assertEqual(graph.edges[self.task('test_func'), self.task('test_func_sub')]['calls'], 8)
+
+        # A new buffer starts the snapshots over
+        profiler.profiling_data = Profiler.from_json(profiler.to_json()).profiling_data
+        self.assertEqual(profiler.to_graph().nodes[self.task('test_func')]['count'], 4)
+
+    def test_plot_graph_formats(self):
+        profiler = Profiler()
+
+        @profiler.monitor
+        def test_func_sub():
+            pass
+
+        @profiler.monitor
+        def test_func():
+            test_func_sub()
+
+        test_func()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "graph.svg")
+            profiler.plot_graph(path, layout='spring', top_k=2)
+            with open(path) as svg_file:
+                self.assertIn("<svg", svg_file.read())
+
+            path = os.path.join(directory, "graph.dot")
+            profiler.plot_graph(path, weight_node_on='total_exec_time')
+            with open(path) as dot_file:
+                dot = dot_file.read()
+            self.assertTrue(dot.startswith("digraph {"))
+            self.assertIn(f'"{self.task("test_func")}" -> "{self.task("test_func_sub")}" [label="1"];', dot)
+            self.assertIn(f'"{self.task("test_func")}" [label="test_func\\n', dot)
+
+    def test_trace(self):
+        profiler = Profiler()
+
+        def test_func_leaf():
+            return 1
+
+        def test_func_fail():
+            raise KeyError
+
+        @profiler.monitor
+        def test_func_mid():
+            return test_func_leaf() + test_func_leaf()
+
+        def test_func():
+            test_func_mid()
+            try:
+                test_func_fail()
+            except KeyError:
+                pass
+            json.dumps([1])
+
+        with profiler.trace(include=__name__):
+            test_func()
+        test_func_leaf()
+
+        graph = profiler.to_graph()
+        self.assertEqual(graph.nodes[self.task('test_func')]['count'], 1)
+        self.assertEqual(graph.nodes[self.task('test_func_mid')]['count'], 1)
+        self.assertEqual(graph.nodes[self.task('test_func_leaf')]['count'], 2)
+        self.assertEqual(graph.edges[self.task('test_func_mid'), self.task('test_func_leaf')]['calls'], 2)
+        self.assertEqual(graph.edges[self.task('test_func'), self.task('test_func_fail')]['calls'], 1)
+        self.assertNotIn('json:dumps', graph)
+        self.assertGreaterEqual(graph.nodes[self.task('test_func')]['total_exec_time'], graph.nodes[self.task('test_func_mid')]['total_exec_time'])
+
+        with profiler.trace(include='json', exclude='json.encoder'):
+            test_func()
+        graph = profiler.to_graph()
+        self.assertEqual(graph.nodes['json:dumps']['count'], 1)
+        self.assertNotIn('json.encoder:JSONEncoder.encode', graph)
+        self.assertEqual(graph.nodes[self.task('test_func_mid')]['count'], 2)
+
+    def test_serve_metrics(self):
+        for mode in ('events', 'aggregate'):
+            profiler = Profiler(mode=mode)
+
+            @profiler.monitor
+            def test_func_sub():
+                pass
+
+            @profiler.monitor
+            def test_func():
+                test_func_sub()
+
+            with profiler.serve_metrics() as exporter:
+                test_func()
+                with urllib.request.urlopen(exporter.url + "/metrics") as response:
+                    self.assertTrue(response.headers['Content-Type'].startswith('application/openmetrics-text'))
+                    metrics = response.read().decode('utf-8')
+                self.assertIn(f'pygraphprofiler_calls_total{{task="{self.task("test_func_sub")}"}} 1\n', metrics)
+                self.assertIn(f'pygraphprofiler_edge_calls_total{{parent_task="{self.task("test_func")}",'
+                              f'task="{self.task("test_func_sub")}"}} 1\n', metrics)
+                self.assertIn(f'pygraphprofiler_latency_seconds_bucket{{task="{self.task("test_func")}",le="+Inf"}} 1\n',
+                              metrics)
+                self.assertTrue(metrics.endswith("# EOF\n"))
+
+                test_func()
+                with urllib.request.urlopen(exporter.url + "/graph") as response:
+                    graph = json.loads(response.read())
+                nodes = {node['task']: node for node in graph['nodes']}
+                self.assertEqual(nodes[self.task('test_func_sub')]['count'], 2)
+                self.assertIn('p99_exec_time', nodes[self.task('test_func')])
+                self.assertEqual(graph['edges'][0]['calls'], 2)
+
+                with self.assertRaises(urllib.error.HTTPError):
+                    urllib.request.urlopen(exporter.url + "/missing")
+
+                # Every scrape runs on a new thread, which leaves no state behind
+                for _ in range(20):
+                    test_func()
+                    urllib.request.urlopen(exporter.url + "/metrics").close()
+                if mode == 'events':
+                    self.assertEqual(len(exporter._aggregates._shards.shards), 1)
+                self.assertEqual(exporter.aggregates().nodes[self.task('test_func')][0], 22)
+
+        # http.server is only loaded once metrics are served, not by importing the package
+        code = ("import sys, src.pygraphprofiler as pgp; loaded = 'http.server' in sys.modules; "
+                "pgp.MetricsExporter; print(loaded, 'http.server' in sys.modules)")
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(result.stdout.split(), ["False", "True"])
+
+    def test_flamegraph_and_chrome_trace(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for sink in (None, os.path.join(directory, "sink")):
+                clock = [0]
+                profiler = Profiler(timer=lambda: clock[0], sink=sink)
+
+                @profiler.monitor
+                def test_func_leaf():
+                    clock[0] += 10
+
+                @profiler.monitor
+                def test_func():
+                    clock[0] += 1
+                    test_func_leaf()
+
+                test_func()
+                test_func()
+                thread = threading.Thread(target=test_func_leaf)
+                thread.start()
+                thread.join()
+
+                path = os.path.join(directory, "profile.folded")
+                profiler.to_flamegraph(path)
+                with open(path) as stacks_file:
+                    stacks = dict(line.rsplit(' ', 1) for line in stacks_file.read().splitlines())
+                self.assertEqual(stacks, {self.task('test_func'): '2', f"{self.task('test_func')};{self.task('test_func_leaf')}": '20', self.task('test_func_leaf'): '10'})
+
+                path = os.path.join(directory, "profile.json")
+                profiler.to_chrome_trace(path)
+                with open(path) as trace_file:
+                    events = json.load(trace_file)['traceEvents']
+                self.assertEqual(len(events), 5)
+                self.assertEqual(sorted(event['name'] for event in events),
+                                 [self.task('test_func'), self.task('test_func'), self.task('test_func_leaf'), self.task('test_func_leaf'), self.task('test_func_leaf')])
+                self.assertEqual({event['dur'] for event in events}, {0.011, 0.01})
+                if sink is None:
+                    self.assertEqual(len({event['tid'] for event in events}), 2)
+
+        with self.assertRaises(ValueError):
+            Profiler(mode='aggregate').to_chrome_trace(os.path.join(directory, "profile.json"))
+
+    def test_monitor_arguments(self):
+        profiler = Profiler()
+
+        @profiler.monitor
+        def test_func(a, b=1, *args, timer=None, sampling=None, **kwargs):
+            return a, b, args, timer, sampling, kwargs
+
+        @profiler.monitor
+        async def test_func_async(a, *, timer):
+            return a + timer
+
+        self.assertEqual(test_func(1), (1, 1, (), None, None, {}))
+        self.assertEqual(test_func(1, 2, 3, timer='t', sampling='s', c=4), (1, 2, (3,), 't', 's', {'c': 4}))
+        self.assertEqual(asyncio.run(test_func_async(1, timer=2)), 3)
+        self.assertEqual(test_func.__name__, 'test_func')
+        self.assertEqual(len(profiler.to_dataframe()), 3)
+
+    def test_breakdown(self):
+        clock = [0]
+        profiler = Profiler(timer=lambda: clock[0])
+
+        @profiler.monitor(key=lambda rows, tenant=None: len(rows))
+        def test_func(rows, tenant=None):
+            clock[0] += 10 * len(rows)
+            return len(rows)
+
+        @profiler.monitor(key=lambda tenant: tenant)
+        def test_func_tenant(tenant):
+            clock[0] += 1
+
+        self.assertEqual(test_func([0] * 3), 3)
+        test_func([0] * 2, tenant='a')
+        test_func([0] * 5)
+        test_func([])
+        for tenant in range(100):
+            test_func_tenant(f"tenant-{tenant}")
+            test_func_tenant("tenant-0")
+
+        breakdown_df = profiler.breakdown()
+        rows = breakdown_df[breakdown_df['task'] == self.task('test_func')].set_index('key')
+        self.assertEqual(list(rows.index), [0, 2, 4])
+        self.assertEqual(rows['count'].tolist(), [1, 2, 1])
+        self.assertEqual(rows['total_exec_time'].tolist(), [0, 50, 50])
+        self.assertEqual(rows.loc[2, 'average_exec_time'], 25)
+
+        # The number of keys per task is bounded, the calls with any further key are counted together
+        rows = breakdown_df[breakdown_df['task'] == self.task('test_func_tenant')].set_index('key')
+        self.assertEqual(len(rows), 64)
+        self.assertEqual(rows.loc['tenant-0', 'count'], 101)
+        self.assertEqual(rows.loc['other', 'count'], 100 - 63)
+        self.assertEqual(rows['count'].sum(), 200)
+
+        # Calls dropped by a sampling policy are not broken down either, recorded ones carry their weight
+        profiler = Profiler(timer=lambda: clock[0])
+
+        @profiler.monitor(sampling=EveryN(2), key=lambda size: size)
+        def test_func_sampled(size):
+            clock[0] += size
+
+        for _ in range(4):
+            test_func_sampled(100)
+        self.assertEqual(profiler.breakdown()['count'].tolist(), [4])
+        self.assertEqual(profiler.breakdown()['key'].tolist(), [64])
+
+        merged_profiler = merge_profiler_instances(profiler, profiler)
+        self.assertEqual(merged_profiler.breakdown()['count'].tolist(), [8])
+
+        # Breakdowns of threads that have ended are kept in a single shard, still bounded to MAX_KEYS keys per task
+        profiler = Profiler()
+
+        @profiler.monitor(key=lambda tenant: tenant)
+        def test_func_tenant(tenant):
+            pass
+
+        for tenant in range(100):
+            thread = threading.Thread(target=test_func_tenant, args=(f"tenant-{tenant}",))
+            thread.start()
+            thread.join()
+        self.assertLessEqual(len(profiler.breakdowns._shards.shards), 1)
+        self.assertEqual(len(profiler.breakdowns._retired.tasks[self.task('test_func_tenant')]), 64)
+        self.assertEqual(profiler.breakdown()['count'].sum(), 100)
+
+        # A key function that raises only loses the breakdown: the call runs, is recorded and leaves the stack as it was
+        profiler = Profiler()
+
+        def failing_key(size):
+            raise ValueError(size)
+
+        @profiler.monitor(key=failing_key)
+        def test_func_failing(size):
+            return size
+
+        @profiler.monitor(key=failing_key)
+        async def test_func_failing_async(size):
+            return size
+
+        @profiler.monitor(key=failing_key)
+        def test_func_failing_generator(size):
+            yield size
+
+        self.assertEqual(test_func_failing(1), 1)
+        self.assertEqual(asyncio.run(test_func_failing_async(2)), 2)
+        self.assertEqual(list(test_func_failing_generator(3)), [3])
+        self.assertIsNone(profiler_lib._current_task())
+        self.assertEqual(len(profiler.breakdown()), 0)
+
+        # As does one returning an unhashable key
+        @profiler.monitor(key=lambda rows: [len(rows)])
+        def test_func_unhashable(rows):
+            return len(rows)
+
+        self.assertEqual(test_func_unhashable([1, 2]), 2)
+        self.assertIsNone(profiler_lib._current_task())
+        self.assertEqual(len(profiler.breakdown()), 0)
+        df = profiler.to_dataframe()
+        self.assertEqual(len(df), 4)
+        self.assertEqual(df['depth'].tolist(), [0, 0, 0, 0])
+
+    def test_graph_from_files(self):
+        def assert_graphs_equal(graph, expected):
+            self.assertEqual(set(graph.nodes), set(expected.nodes))
+            self.assertEqual(set(graph.edges), set(expected.edges))
+            for items, expected_items in ((graph.nodes, expected.nodes), (graph.edges, expected.edges)):
+                for key, attributes in items.items():
+                    self.assertEqual(set(attributes), set(expected_items[key]))
+                    for name, value in attributes.items():
+                        self.assertAlmostEqual(value, expected_items[key][name], places=6)
+
+        with tempfile.TemporaryDirectory() as directory:
+            clock = [0]
+            sink = os.path.join(directory, "sink")
+            profilers = [Profiler(timer=lambda: clock[0]), Profiler(timer=lambda: clock[0], sink=sink)]
+            for profiler in profilers:
+                @profiler.monitor
+                def test_func_leaf(n):
+                    clock[0] += n
+
+                @profiler.monitor(sampling=EveryN(3))
+                def test_func_sampled(n):
+                    clock[0] += n
+
+                @profiler.monitor
+                def test_func(n):
+                    clock[0] += 1
+                    for i in range(n):
+                        test_func_leaf(i)
+                        test_func_sampled(i)
+
+                for n in range(20):
+                    test_func(n)
+            profiler = profilers[0]
+            expected = profiler.to_graph()
+
+            formats = ["binary"]
+            if importlib.util.find_spec('pyarrow') is not None:
+                formats.append("parquet")
+            paths = []
+            for format in formats:
+                path = os.path.join(directory, f"profile.{format}")
+                with profiler.stream_to_file(path, format=format) as writer:
+                    writer.write()
+                paths.append(path)
+                assert_graphs_equal(Profiler.graph_from_files(path), expected)
+                assert_graphs_equal(Profiler.graph_from_files(path, chunk_size=37), expected)
+
+            profilers[1].profiling_data.flush()
+            assert_graphs_equal(Profiler.graph_from_files(sink, chunk_size=37), expected)
+            expected_sink = Profiler.from_sink(sink).to_graph()
+            assert_graphs_equal(Profiler.graph_from_files(sink), expected_sink)
+
+            # Profiles merged across hosts, aggregated in worker processes
+            merged = merge_profiler_instances(*[profiler] * len(paths), Profiler.from_sink(sink)).to_graph()
+            assert_graphs_equal(Profiler.graph_from_files(*paths, sink, chunk_size=100, processes=2), merged)
+
+            # Streamed in many small writes: jobs are generated lazily and share the file's growing name table
+            streamed = Profiler()
+            path = os.path.join(directory, "streamed.bin")
+            with streamed.stream_to_file(path, format="binary") as writer:
+                for i in range(10):
+                    with streamed.block(f"block-{i}"):
+                        pass
+                    writer.write()
+            jobs = chunked._jobs(path, 1000, directory)
+            self.assertNotIsInstance(jobs, list)
+            jobs = list(jobs)
+            self.assertEqual(len(jobs), 10)
+            self.assertTrue(all(job[-1] is jobs[0][-1] for job in jobs))
+            graph = Profiler.graph_from_files(path, processes=2)
+            self.assertEqual([graph.nodes[f"block-{i}"]['count'] for i in range(10)], [1] * 10)
+            trace_path = os.path.join(directory, "trace.json")
+            streamed.to_chrome_trace(trace_path)
+            with open(trace_path) as trace_file:
+                self.assertEqual(sorted(event['name'] for event in json.load(trace_file)['traceEvents']
+                                        if event.get('ph') == 'X'), [f"block-{i}" for i in range(10)])
+
+            with self.assertRaises(ValueError):
+                Profiler.graph_from_files(__file__)
+
+    def test_memory(self):
+        for mode in ('events', 'aggregate'):
+            profiler = Profiler(mode=mode)
+            kept = []
+
+            @profiler.monitor(memory=True)
+            def test_func_leaf():
+                temporary = bytearray(1_000_000)
+                del temporary
+                return bytearray(100_000)
+
+            @profiler.monitor(memory=True, sampling=EveryN(2))
+            def test_func():
+                kept.append(test_func_leaf())
+                temporary = bytearray(3_000_000)
+                del temporary
+
+            @profiler.monitor
+            def test_func_untracked():
+                test_func()
+
+            for _ in range(4):
+                test_func_untracked()
+            self.assertFalse(tracemalloc.is_tracing())
+
+            graph = profiler.to_graph()
+            leaf, func, untracked = (graph.nodes[task] for task in (self.task('test_func_leaf'), self.task('test_func'), self.task('test_func_untracked')))
+            self.assertGreaterEqual(leaf['total_alloc_bytes'], 4 * 100_000)
+            self.assertLess(leaf['total_alloc_bytes'], 4 * 110_000)
+            self.assertGreaterEqual(leaf['peak_alloc_bytes'], 1_000_000)
+            self.assertLess(leaf['peak_alloc_bytes'], 1_100_000)
+            # Sampled calls stand for `weight` calls; the peak of the caller covers that of its callees
+            self.assertGreaterEqual(func['total_alloc_bytes'], 4 * 100_000)
+            self.assertGreaterEqual(func['peak_alloc_bytes'], 3_100_000)
+            self.assertLess(func['peak_alloc_bytes'], 3_200_000)
+            self.assertEqual(untracked['total_alloc_bytes'], 0)
+
+        tracemalloc.start()
+        try:
+            test_func_untracked()
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+
+        with tempfile.TemporaryDirectory() as directory:
+            for weight_node_on in ('total_alloc_bytes', 'peak_alloc_bytes'):
+                path = os.path.join(directory, f"{weight_node_on}.dot")
+                profiler.plot_graph(path, weight_node_on=weight_node_on)
+                with open(path) as dot_file:
+                    self.assertRegex(dot_file.read(), r'"test_func_leaf\\n[0-9.]+[kM]B"')
+
+            # Without weighting, nodes are still labeled
+            path = os.path.join(directory, "unweighted.dot")
+            profiler.plot_graph(path, weight_node_on=None)
+            with open(path) as dot_file:
+                self.assertIn('"test_func_leaf\\n', dot_file.read())
+
+    def test_diff(self):
+        def task(name):
+            return self.task(f"record.<locals>.{name}")
+
+        def record(profiler, clock, slow):
+            @profiler.monitor
+            def test_func_leaf(i):
+                clock[0] += 1000 + i % 10 + (200 if slow else 0)
+
+            @profiler.monitor
+            def test_func_stable(i):
+                clock[0] += 1000 + i % 10
+
+            @profiler.monitor
+            def test_func_removed():
+                clock[0] += 10
+
+            @profiler.monitor
+            def test_func():
+                for i in range(50):
+                    test_func_leaf(i)
+                    test_func_stable(i)
+                if not slow:
+                    test_func_removed()
+
+            for _ in range(20):
+                test_func()
+
+        baseline_clock, candidate_clock = [0], [0]
+        baseline = Profiler(timer=lambda: baseline_clock[0])
+        candidate = Profiler(timer=lambda: candidate_clock[0], mode='aggregate')
+        record(baseline, baseline_clock, False)
+        record(candidate, candidate_clock, True)
+
+        diff = diff_profiler_instances(baseline, candidate)
+        nodes = diff.nodes.set_index('task')
+        self.assertEqual(nodes.loc[task('test_func_removed'), 'status'], 'removed')
+        self.assertEqual(nodes.loc[task('test_func_leaf'), 'delta_count'], 0)
+        self.assertAlmostEqual(nodes.loc[task('test_func_leaf'), 'delta_total_exec_time'], 1000 * 200)
+        self.assertAlmostEqual(nodes.loc[task('test_func_leaf'), 'slowdown'], 1204.5 / 1004.5)
+        self.assertLess(nodes.loc[task('test_func_leaf'), 'adjusted_p_value'], 1e-6)
+        self.assertEqual(nodes.loc[task('test_func_leaf'), 'superiority'], 1)
+        self.assertGreater(nodes.loc[task('test_func_stable'), 'p_value'], 0.5)
+        self.assertEqual(list(diff.regressions['task']), [task('test_func_leaf'), task('test_func')])
+        self.assertEqual(len(diff.improvements), 0)
+        edges = diff.edges.set_index(['parent_task', 'task'])
+        self.assertEqual(edges.loc[(task('test_func'), task('test_func_removed')), 'baseline_calls'], 20)
+        self.assertTrue(pd.isna(edges.loc[(task('test_func'), task('test_func_removed')), 'candidate_calls']))
+
+        graph = diff.to_graph()
+        self.assertTrue(graph.graph['diff'])
+        self.assertEqual(graph.nodes[task('test_func_removed')]['count'], 20)
+        self.assertNotIn('slowdown', graph.nodes[task('test_func_removed')])
+        self.assertTrue(graph.nodes[task('test_func_leaf')]['regression'])
+        self.assertEqual(graph.edges[task('test_func'), task('test_func_leaf')]['calls'], 1000)
+
+        # Comparing a profile against itself, whatever its storage, finds nothing
+        with tempfile.TemporaryDirectory() as directory:
+            sink_clock = [0]
+            sink = Profiler(timer=lambda: sink_clock[0], sink=os.path.join(directory, "sink"))
+            record(sink, sink_clock, False)
+            same = diff_profiler_instances(baseline, sink)
+            self.assertTrue((same.nodes['delta_total_exec_time'] == 0).all())
+            self.assertTrue((same.nodes['p_value'] == 1).all())
+            self.assertEqual(len(same.regressions), 0)
+
+            path = os.path.join(directory, "diff.dot")
+            diff.plot_graph(path)
+            with open(path) as dot_file:
+                dot = dot_file.read()
+            self.assertRegex(dot, r'"test_func_leaf\\n[0-9.]+s\\n\+20%", fillcolor="#[0-9a-f]{6}"')
+            self.assertIn('fillcolor="lightgrey"', dot)
+            diff.plot_graph(os.path.join(directory, "diff.png"))
+
+        # Sampled calls are tested as the calls actually recorded, not as many as their weight stands for
+        def record_sampled(profiler, clock, n_calls, slow, sampling=None):
+            @profiler.monitor(sampling=sampling)
+            def test_func_sampled(i):
+                clock[0] += 1000 + i // (n_calls // 10) * 3 + (20 if slow else 0)
+
+            for i in range(n_calls):
+                test_func_sampled(i)
+
+        p_values = []
+        for mode in ('events', 'aggregate'):
+            for n_calls, sampling in ((100, EveryN(10)), (10, None)):
+                profilers = []
+                for slow in (False, True):
+                    clock = [0]
+                    profiler = Profiler(timer=lambda clock=clock: clock[0], mode=mode)
+                    record_sampled(profiler, clock, n_calls, slow, sampling)
+                    profilers.append(profiler)
+                p_values.append(diff_profiler_instances(*profilers).nodes['p_value'].iloc[0])
+        self.assertGreater(p_values[1], 1e-4)
+        for p_value in p_values:
+            self.assertAlmostEqual(p_value, p_values[1])
+
+    def test_generators(self):
+        clock = [0]
+        profiler = Profiler(timer=lambda: clock[0])
+
+        @profiler.monitor
+        def test_func_leaf():
+            clock[0] += 1
+
+        @profiler.monitor
+        def test_func_produce(n):
+            for i in range(n):
+                clock[0] += 10
+                test_func_leaf()
+                yield i
+            clock[0] += 5
+
+        @profiler.monitor
+        def test_func_consume(items):
+            total = 0
+            for item in items:
+                clock[0] += 100
+                total += item
+            return total
+
+        self.assertEqual(test_func_consume(test_func_produce(3)), 3)
+        df = profiler.to_dataframe().set_index('task')
+        produce = df.loc[self.task('test_func_produce')]
+        self.assertEqual(produce['parent_task'], self.task('test_func_consume'))
+        self.assertEqual(produce['end_time'] - produce['start_time'], 3 * 11 + 5)
+        self.assertEqual(produce['self_time'], 3 * 10 + 5)
+        consume = df.loc[self.task('test_func_consume')]
+        self.assertEqual(consume['end_time'] - consume['start_time'], 3 * 100 + 3 * 11 + 5)
+        self.assertEqual(consume['self_time'], 3 * 100)
+
+        # Resumes are recorded once per consumer
+        profiler = Profiler(timer=lambda: clock[0])
+        produce = profiler.monitor(test_func_produce.__wrapped__)
+        consume = profiler.monitor(test_func_consume.__wrapped__)
+        generator = produce(4)
+        self.assertEqual(next(generator), 0)
+        self.assertEqual(consume(generator), 6)
+        df = profiler.to_dataframe()
+        df = df[df['task'] == self.task('test_func_produce')]
+        self.assertEqual(list(df['parent_task']), [f"{__name__}:TestClassLevel.test_generators",
+                                                   self.task('test_func_consume')])
+        self.assertEqual(list(df['end_time'] - df['start_time']), [11, 3 * 11 + 5])
+
+        @profiler.monitor
+        def test_func_echo():
+            received = yield 1
+            try:
+                yield received * 2
+            except ValueError:
+                yield -1
+            return 'done'
+
+        generator = test_func_echo()
+        self.assertEqual(next(generator), 1)
+        self.assertEqual(generator.send(5), 10)
+        self.assertEqual(generator.throw(ValueError), -1)
+        with self.assertRaises(StopIteration) as stop:
+            next(generator)
+        self.assertEqual(stop.exception.value, 'done')
+        generator = produce(5)
+        next(generator)
+        generator.close()
+        self.assertEqual(profiler.to_graph().nodes[self.task('test_func_produce')]['count'], 3)
+        self.assertEqual(profiler.to_graph().nodes[self.task('test_func_echo')]['count'], 1)
+
+        @profiler.monitor
+        async def test_func_async_produce(n):
+            for i in range(n):
+                clock[0] += 10
+                await asyncio.sleep(0)
+                yield i
+
+        @profiler.monitor
+        async def test_func_async_consume():
+            return [item async for item in test_func_async_produce(3)]
+
+        self.assertEqual(asyncio.run(test_func_async_consume()), [0, 1, 2])
+        graph = profiler.to_graph()
+        self.assertEqual(graph.edges[self.task('test_func_async_consume'), self.task('test_func_async_produce')]['calls'], 1)
+        self.assertEqual(graph.nodes[self.task('test_func_async_produce')]['total_exec_time'], 30)
+
+        # Generators closed early, or whose key raises, leave no task pushed behind
+        @profiler.monitor(key=lambda n: 1 // n)
+        def test_func_keyed(n):
+            for i in range(3):
+                clock[0] += 10
+                yield i
+
+        @profiler.monitor(key=lambda n: 1 // n)
+        async def test_func_async_keyed(n):
+            for i in range(3):
+                clock[0] += 10
+                yield i
+
+        async def close_early(generator):
+            self.assertEqual(await generator.__anext__(), 0)
+            await generator.aclose()
+
+        for n in (1, 0):
+            generator = test_func_keyed(n)
+            self.assertEqual(next(generator), 0)
+            generator.close()
+            self.assertIsNone(profiler_lib._current_task())
+            self.assertEqual(list(test_func_keyed(n)), [0, 1, 2])
+            self.assertIsNone(profiler_lib._current_task())
+            asyncio.run(close_early(test_func_async_keyed(n)))
+            self.assertIsNone(profiler_lib._current_task())
+        graph = profiler.to_graph()
+        self.assertEqual(graph.nodes[self.task('test_func_keyed')]['count'], 4)
+        self.assertEqual(graph.nodes[self.task('test_func_async_keyed')]['count'], 2)
+        self.assertEqual(list(profiler.breakdown()['key'].unique()), [1])
+
+    def test_block(self):
+        clock = [0]
+        profiler = Profiler(timer=lambda: clock[0])
+
+        @profiler.monitor
+        def test_func():
+            clock[0] += 3
+            with profiler.block("inner block"):
+                clock[0] += 2
+
+        with profiler.block("parse headers"):
+            clock[0] += 7
+            test_func()
+        profiler.disable()
+        with profiler.block("parse headers"):
+            test_func()
+        profiler.enable()
+
+        graph = profiler.to_graph()
+        self.assertEqual(graph.nodes["parse headers"]['count'], 1)
+        self.assertEqual(graph.nodes["parse headers"]['total_exec_time'], 12)
+        self.assertEqual(graph.nodes["parse headers"]['total_self_time'], 7)
+        self.assertEqual(graph.nodes[self.task('test_func')]['total_self_time'], 3)
+        self.assertEqual(graph.edges["parse headers", self.task('test_func')]['calls'], 1)
+        self.assertEqual(graph.edges[self.task('test_func'), "inner block"]['calls'], 1)
+        self.assertEqual(graph.edges[f"{__name__}:TestClassLevel.test_block", "parse headers"]['calls'], 1)
+
+    def test_qualified_names(self):
+        profiler = Profiler()
+
+        class Reader:
+            @profiler.monitor
+            def run(self):
+                pass
+
+        class Writer:
+            @profiler.monitor
+            def run(self):
+                Reader().run()
+
+        Writer().run()
+        with profiler.trace(include=__name__):
+            Writer().run()
+        graph = profiler.to_graph()
+        self.assertEqual(graph.nodes[self.task('Reader.run')]['count'], 2)
+        self.assertEqual(graph.nodes[self.task('Writer.run')]['count'], 2)
+        self.assertEqual(graph.edges[self.task('Writer.run'), self.task('Reader.run')]['calls'], 2)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,13 @@
 import json
 import os
+import subprocess
+import sys
 import unittest
 import networkx as nx
 
 import pandas as pd
 from src.pygraphprofiler import monitor, plot_graph, to_dataframe, to_graph, to_json
+from src.pygraphprofiler import PROFILERS, Profiler, disable, enable, getProfiler, setProfiler
 
 
 class TestModuleLevel(unittest.TestCase):
@@ -80,6 +83,68 @@ class TestModuleLevel(unittest.TestCase):
         self.assertTrue(os.path.exists(filename))
         os.remove(filename)
 
+    def test_profiler_registry(self):
+        app = setProfiler('test_app', mode='aggregate')
+        self.assertIs(getProfiler('test_app'), app)
+        self.assertEqual(app.name, 'test_app')
+        self.assertEqual(app.mode, 'aggregate')
+        db = getProfiler('test_app.db')
+        self.assertIs(PROFILERS['test_app.db'], db)
+        self.assertIsNot(db.profiling_data, app.profiling_data)
+
+        @db.monitor
+        def test_func():
+            return 1
+
+        @monitor
+        def test_func_global():
+            return 2
+
+        self.assertEqual(test_func(), 1)
+        app.disable()
+        self.assertFalse(db.is_enabled)
+        self.assertEqual(test_func(), 1)
+        app.enable()
+        db.disable()
+        self.assertTrue(app.is_enabled)
+        test_func()
+        db.enable()
+        test_func()
+        self.assertEqual(len(db.profiling_data["task"]), 2)
+
+        n_events = len(to_dataframe())
+        disable()
+        try:
+            self.assertFalse(db.is_enabled)
+            self.assertFalse(Profiler().is_enabled)
+            self.assertEqual(test_func(), 1)
+            self.assertEqual(test_func_global(), 2)
+        finally:
+            enable()
+        self.assertTrue(db.is_enabled)
+        self.assertEqual(len(db.profiling_data["task"]), 2)
+        self.assertEqual(len(to_dataframe()), n_events)
+
+        script = (
+            "from src.pygraphprofiler import monitor, Profiler\n"
+            "func = lambda: None\n"
+            "print(monitor(func) is func, Profiler().monitor(func) is func)\n"
+        )
+        env = {**os.environ, 'PYGRAPHPROFILER_DISABLE': '1'}
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True, env=env).stdout
+        self.assertEqual(output.strip(), 'True True')
+
+    def test_lazy_imports(self):
+        script = (
+            "import sys\n"
+            "from src.pygraphprofiler import monitor, Profiler\n"
+            "monitor(lambda: None)()\n"
+            "Profiler().monitor(lambda: None)()\n"
+            "print(*[m for m in ('pandas', 'networkx', 'matplotlib') if m in sys.modules])\n"
+        )
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), '')
+
 
 if __name__ == '__main__':
     unittest.main()
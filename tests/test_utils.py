@@ -3,9 +3,11 @@ import unittest
 import networkx as nx
 import pandas as pd
 from src.pygraphprofiler.utils.scc import assign_scc
-from src.pygraphprofiler.utils.plot import _draw_graph_to_file, _set_node_sizes, _set_edge_labels, _set_node_labels, _set_graph_layout
+from src.pygraphprofiler.utils.plot import _draw_graph_to_file, _set_node_sizes, _set_edge_labels, _set_node_labels, _set_graph_layout, _prune_graph
 from src.pygraphprofiler.utils.graph import _add_graph_edges, _add_graph_nodes
 from src.pygraphprofiler.profiler import Profiler
+from src.pygraphprofiler.utils.recorder import EventBuffer
+from src.pygraphprofiler.utils.sketch import LatencySketch
 
 class TestUtils(unittest.TestCase):
 
@@ -39,6 +41,33 @@ class TestUtils(unittest.TestCase):
         _draw_graph_to_file('test.png', self.graph, pos, node_labels, edge_labels, node_sizes, True)
         os.remove('test.png')
 
+    def test_prune_graph(self):
+        graph = nx.DiGraph()
+        graph.add_node('a', count=2, total_exec_time=100, average_exec_time=50)
+        graph.add_node('b', count=1, total_exec_time=1, average_exec_time=1)
+        graph.add_node('c', count=2, total_exec_time=2, average_exec_time=1)
+        graph.add_node('d', count=1, total_exec_time=0.5, average_exec_time=0.5)
+        graph.add_edges_from([('main', 'a', {'calls': 2}), ('a', 'b', {'calls': 1}), ('a', 'c', {'calls': 2}),
+                              ('b', 'd', {'calls': 1})])
+
+        collapsed = _prune_graph(graph, 'total_exec_time', min_time=10)
+        self.assertEqual(sorted(collapsed.nodes), ['a', 'a/<2 collapsed>', 'main'])
+        self.assertEqual(collapsed.nodes['a/<2 collapsed>']['count'], 3)
+        self.assertEqual(collapsed.nodes['a/<2 collapsed>']['total_exec_time'], 3)
+        self.assertEqual(collapsed.edges['a', 'a/<2 collapsed>']['calls'], 3)
+
+        top = _prune_graph(graph, 'total_exec_time', top_k=2, min_time=10)
+        self.assertEqual(sorted(top.nodes), ['a', 'a/<2 collapsed>'])
+        self.assertEqual(graph.number_of_nodes(), 5)
+
+    def test_graph_layout(self):
+        pos = _set_graph_layout(self.graph, 'spring')
+        self.assertEqual(set(pos), set(self.graph.nodes))
+        self.assertIs(_set_graph_layout(self.graph.copy(), 'spring'), pos)
+        self.assertEqual(set(_set_graph_layout(self.graph, 'sfdp')), set(self.graph.nodes))
+        with self.assertRaises(ValueError):
+            _set_graph_layout(self.graph, 'circle')
+
     def test_add_graph_edges(self):
         result = _add_graph_edges(self.task_df, self.graph)
         self.assertEqual(result.number_of_edges(), 3)
@@ -46,3 +75,64 @@ class TestUtils(unittest.TestCase):
     def test_add_graph_nodes(self):
         result = _add_graph_edges(self.task_df, self.graph)
         self.assertEqual(result.number_of_nodes(), 5)
+
+    def test_event_buffer(self):
+        buffer = EventBuffer.from_dict({
+            'task': ['A', 'B', 'A'],
+            'parent_task': [None, 'A', 'B'],
+            'start_time': [0, 1, 2],
+            'end_time': [3, 2, 2],
+        })
+        self.assertEqual(buffer.names, ['A', 'B'])
+        self.assertEqual(list(buffer.task_ids), [0, 1, 0])
+        self.assertEqual(list(buffer.parent_ids), [-1, 0, 1])
+
+        other = EventBuffer()
+        other.append('C', 'A', 4, 5)
+        buffer.extend(other)
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(buffer['task'], ['A', 'B', 'A', 'C'])
+        self.assertEqual(buffer['parent_task'], [None, 'A', 'B', 'A'])
+
+        df = buffer.to_dataframe()
+        self.assertIsInstance(df['task'].dtype, pd.CategoricalDtype)
+        self.assertEqual(df['end_time'].tolist(), [3, 2, 2, 5])
+        buffer.append('A', 'C', 6, 7)
+        self.assertEqual(len(buffer), 5)
+
+    def test_event_buffer_legacy_seconds(self):
+        buffer = EventBuffer.from_dict({'task': ['A'], 'parent_task': ['B'], 'start_time': [1.5], 'end_time': [2.0]})
+        self.assertEqual(buffer['start_time'], [1500000000])
+        self.assertEqual(buffer['end_time'], [2000000000])
+
+    def test_graph_attributes(self):
+        task_df = pd.DataFrame({
+            'task': ['A', 'B', 'B', 'C'],
+            'parent_task': [None, 'A', 'A', ''],
+            'start_time': [0, 1, 3, 5],
+            'end_time': [10, 2, 6, 6],
+        })
+        graph = _add_graph_edges(task_df, _add_graph_nodes(task_df, nx.DiGraph()))
+        self.assertEqual(graph.nodes['B']['total_exec_time'], 4)
+        self.assertEqual(graph.nodes['B']['count'], 2)
+        self.assertEqual(graph.nodes['B']['average_exec_time'], 2.0)
+        self.assertAlmostEqual(graph.nodes['B']['p50_exec_time'], 3, delta=0.03)
+        self.assertAlmostEqual(graph.nodes['A']['p99_exec_time'], 10, delta=0.1)
+        self.assertEqual(list(graph.edges), [('A', 'B')])
+        self.assertEqual(graph.edges['A', 'B']['calls'], 2)
+        self.assertAlmostEqual(graph.edges['A', 'B']['p90_exec_time'], 3, delta=0.03)
+
+    def test_latency_sketch(self):
+        sketch = LatencySketch()
+        for value in range(1, 10001):
+            sketch.add(value)
+        self.assertAlmostEqual(sketch.quantile(0.5), 5000, delta=5000 * 0.01)
+        self.assertAlmostEqual(sketch.quantile(0.99), 9901, delta=9901 * 0.01)
+
+        other = LatencySketch()
+        for value in range(10001, 20001):
+            other.add(value, weight=2)
+        merged = LatencySketch.from_dict(sketch.to_dict()).merge(other)
+        self.assertEqual(merged.count, 30000)
+        self.assertAlmostEqual(merged.quantile(0.5), 12500, delta=12500 * 0.01)
+        self.assertIsNone(LatencySketch().quantile(0.5))